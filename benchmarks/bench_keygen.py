@@ -0,0 +1,66 @@
+# benchmarks/bench_keygen.py
+"""
+Микробенчмарк генерации WireGuard-ключей: пар/с.
+Запуск из корня репозитория: python -m benchmarks.bench_keygen [N]
+
+  baseline    — исходный gen_wg_keypair(): __import__ модуля serialization и поиск
+                перечислений на каждый вызов, затем base64 (в оригинале лишний
+                `.serialization` после __import__ падал — здесь он убран)
+  inline b64  — gen_wg_keypair() на каждую пару (перечисления разрешены при импорте)
+  inline raw  — gen_wg_keypair_raw() без base64
+  bulk        — gen_wg_keypairs(N) одной пачкой
+  pool pop    — KeypairPool.pop() из заранее заполненного пула (путь активации сейчас)
+"""
+import asyncio, base64, sys, time
+
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from vpn_bot.wg_utils import KeypairPool, gen_wg_keypair, gen_wg_keypair_raw, gen_wg_keypairs
+
+
+def _baseline_keypair() -> tuple[str, str]:
+    """Путь генерации до пула ключей — для сравнения."""
+    priv = X25519PrivateKey.generate()
+    pub = priv.public_key()
+    priv_b64 = base64.b64encode(priv.private_bytes(
+        encoding=__import__("cryptography.hazmat.primitives.serialization", fromlist=["serialization"]).Encoding.Raw,
+        format=__import__("cryptography.hazmat.primitives.serialization", fromlist=["serialization"]).PrivateFormat.Raw,
+        encryption_algorithm=__import__("cryptography.hazmat.primitives.serialization", fromlist=["serialization"]).NoEncryption(),
+    )).decode("ascii")
+    pub_b64 = base64.b64encode(pub.public_bytes(
+        encoding=__import__("cryptography.hazmat.primitives.serialization", fromlist=["serialization"]).Encoding.Raw,
+        format=__import__("cryptography.hazmat.primitives.serialization", fromlist=["serialization"]).PublicFormat.Raw,
+    )).decode("ascii")
+    return priv_b64, pub_b64
+
+
+def _rate(n: int, fn) -> float:
+    t0 = time.perf_counter()
+    fn()
+    return n / (time.perf_counter() - t0)
+
+
+async def _filled_pool(n: int) -> KeypairPool:
+    pool = KeypairPool(low=0, high=n, batch=256)
+    task = asyncio.create_task(pool.run())
+    while len(pool) < n:
+        await asyncio.sleep(0.01)
+    task.cancel()
+    return pool
+
+
+def main(n: int = 20_000) -> None:
+    results = {
+        "baseline": _rate(n, lambda: [_baseline_keypair() for _ in range(n)]),
+        "inline b64": _rate(n, lambda: [gen_wg_keypair() for _ in range(n)]),
+        "inline raw": _rate(n, lambda: [gen_wg_keypair_raw() for _ in range(n)]),
+        "bulk": _rate(n, lambda: gen_wg_keypairs(n)),
+    }
+    pool = asyncio.run(_filled_pool(n))
+    results["pool pop"] = _rate(n, lambda: [pool.pop() for _ in range(n)])
+    for name, rate in results.items():
+        print(f"{name:<12} {rate:>14,.0f} пар/с")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000)
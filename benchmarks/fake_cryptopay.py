@@ -0,0 +1,268 @@
+# benchmarks/fake_cryptopay.py
+"""
+Локальная подмена Crypto Pay API для нагрузочных прогонов и ручной отладки без реальных денег.
+
+    python -m benchmarks.fake_cryptopay [--port 8090] [--latency 0.05] [--jitter 0.02]
+        [--error-rate 0.01] [--throttle-rate 0.0] [--webhook http://127.0.0.1:8080/api/cryptopay/webhook]
+        [--auto-pay SEC]
+
+Бот направляется сюда через CRYPTOPAY_API_URL=http://127.0.0.1:8090/api/.
+Поддерживаются getMe, createInvoice, getInvoices (в том числе пачкой invoice_ids=1,2,3).
+Оплата — POST /fake/pay/<invoice_id> (или FakeCryptoPay.pay() из кода): счёт становится
+paid и, если задан webhook, на него уходит подписанный invoice_paid, как от настоящего Crypto Pay.
+"""
+from __future__ import annotations
+import argparse, asyncio, itertools, json, random, time
+from datetime import datetime, timezone
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+from vpn_bot.cryptopay import webhook_signature
+
+
+def _iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
+
+
+class FakeCryptoPay:
+    """
+    Состояние и поведение подменного API. latency/jitter — задержка каждого ответа,
+    error_rate — доля ответов HTTP 500, throttle_rate — доля ответов 429 с Retry-After.
+    Параметры можно менять на лету (например, посреди прогона включить ошибки).
+    """
+
+    def __init__(
+        self,
+        token: str,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        webhook_url: Optional[str] = None,
+        auto_pay: Optional[float] = None,
+        seed: Optional[int] = None,
+    ):
+        self.token = token
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.webhook_url = webhook_url
+        self.auto_pay = auto_pay
+        self.invoices: dict[int, dict] = {}
+        self._ids = itertools.count(1)
+        self._updates = itertools.count(1)
+        self._rnd = random.Random(seed)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._tasks: set[asyncio.Task] = set()
+        # счётчики для отчёта
+        self.calls: dict[str, int] = {}
+        self.errors = 0
+        self.throttled = 0
+        self.webhooks_sent = 0
+        self.webhooks_failed = 0
+
+    # --- HTTP ---
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/api/{method}", self._api)
+        app.router.add_post("/fake/pay/{invoice_id}", self._pay_route)
+        app.router.add_get("/fake/stats", self._stats_route)
+        app.on_cleanup.append(self._cleanup)
+        return app
+
+    async def _cleanup(self, app: web.Application) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        if self._session is not None:
+            await self._session.close()
+
+    @staticmethod
+    def _error(status: int, name: str, headers: Optional[dict] = None) -> web.Response:
+        return web.json_response({"ok": False, "error": {"code": status, "name": name}}, status=status, headers=headers)
+
+    async def _api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if request.headers.get("Crypto-Pay-API-Token") != self.token:
+            return self._error(401, "UNAUTHORIZED")
+        delay = self.latency + (self._rnd.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        roll = self._rnd.random()
+        if roll < self.throttle_rate:
+            self.throttled += 1
+            return self._error(429, "TOO_MANY_REQUESTS", headers={"Retry-After": "1"})
+        if roll < self.throttle_rate + self.error_rate:
+            self.errors += 1
+            return self._error(500, "INTERNAL_ERROR")
+        # параметры принимаются и из query, и из JSON-тела — как у настоящего API
+        params = dict(request.query)
+        if request.can_read_body:
+            try:
+                params.update(await request.json())
+            except ValueError:
+                return self._error(400, "BAD_REQUEST")
+        handler = {"getMe": self._get_me, "createInvoice": self._create_invoice, "getInvoices": self._get_invoices}.get(method)
+        if handler is None:
+            return self._error(405, "METHOD_NOT_FOUND")
+        try:
+            result = handler(params)
+        except (KeyError, ValueError) as e:
+            return self._error(400, f"BAD_REQUEST: {e}")
+        return web.json_response({"ok": True, "result": result})
+
+    async def _pay_route(self, request: web.Request) -> web.Response:
+        invoice = await self.pay(int(request.match_info["invoice_id"]))
+        if invoice is None:
+            return web.json_response({"ok": False}, status=404)
+        return web.json_response({"ok": True, "result": invoice})
+
+    async def _stats_route(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    # --- методы API ---
+    def _get_me(self, params: dict) -> dict:
+        return {"app_id": 1, "name": "fake-cryptopay", "payment_processing_bot_username": "CryptoTestnetBot"}
+
+    def _create_invoice(self, params: dict) -> dict:
+        invoice_id = next(self._ids)
+        now = time.time()
+        invoice = {
+            "invoice_id": invoice_id,
+            "hash": f"IV{invoice_id:010d}",
+            "currency_type": params.get("currency_type", "crypto"),
+            "asset": params.get("asset", "USDT"),
+            "amount": str(params["amount"]),
+            "description": params.get("description", ""),
+            "status": "active",
+            "created_at": _iso(now),
+            "allow_comments": params.get("allow_comments", True),
+            "allow_anonymous": params.get("allow_anonymous", True),
+            "bot_invoice_url": f"https://t.me/CryptoTestnetBot?start=IV{invoice_id:010d}",
+            "pay_url": f"https://t.me/CryptoTestnetBot?start=IV{invoice_id:010d}",
+        }
+        if params.get("payload") is not None:
+            invoice["payload"] = str(params["payload"])
+        if params.get("expires_in"):
+            invoice["expiration_date"] = _iso(now + int(params["expires_in"]))
+            invoice["_expires_at"] = now + int(params["expires_in"])
+        self.invoices[invoice_id] = invoice
+        if self.auto_pay is not None:
+            self._spawn(self._pay_later(invoice_id, self.auto_pay))
+        return self._public(invoice)
+
+    def _get_invoices(self, params: dict) -> dict:
+        ids = params.get("invoice_ids")
+        status = params.get("status")
+        count = min(int(params.get("count", 100)), 1000)
+        offset = int(params.get("offset", 0))
+        if ids:
+            items = [self.invoices[i] for i in map(int, str(ids).split(",")) if i in self.invoices]
+        else:
+            items = list(self.invoices.values())
+        self._expire(items)
+        if status:
+            items = [inv for inv in items if inv["status"] == status]
+        return {"items": [self._public(inv) for inv in items[offset:offset + count]]}
+
+    @staticmethod
+    def _public(invoice: dict) -> dict:
+        return {k: v for k, v in invoice.items() if not k.startswith("_")}
+
+    @staticmethod
+    def _expire(items: list[dict]) -> None:
+        now = time.time()
+        for inv in items:
+            if inv["status"] == "active" and inv.get("_expires_at", now + 1) <= now:
+                inv["status"] = "expired"
+
+    # --- оплата и вебхук ---
+    def _spawn(self, coro) -> None:
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _pay_later(self, invoice_id: int, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self.pay(invoice_id)
+
+    async def pay(self, invoice_id: int) -> Optional[dict]:
+        """Отмечает счёт оплаченным и (если задан webhook_url) дожидается доставки вебхука."""
+        invoice = self.invoices.get(invoice_id)
+        if invoice is None:
+            return None
+        if invoice["status"] != "paid":
+            invoice.update(status="paid", paid_asset=invoice["asset"], paid_amount=invoice["amount"], paid_at=_iso(time.time()))
+        if self.webhook_url:
+            await self.send_webhook(invoice)
+        return self._public(invoice)
+
+    async def send_webhook(self, invoice: dict) -> bool:
+        body = json.dumps({
+            "update_id": next(self._updates),
+            "update_type": "invoice_paid",
+            "request_date": _iso(time.time()),
+            "payload": self._public(invoice),
+        }).encode()
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        try:
+            async with self._session.post(
+                self.webhook_url, data=body,
+                headers={"Content-Type": "application/json", "crypto-pay-api-signature": webhook_signature(body, self.token)},
+            ) as resp:
+                await resp.read()
+                ok = resp.status == 200
+        except aiohttp.ClientError:
+            ok = False
+        if ok:
+            self.webhooks_sent += 1
+        else:
+            self.webhooks_failed += 1
+        return ok
+
+    def stats(self) -> dict:
+        return {
+            "invoices": len(self.invoices),
+            "paid": sum(inv["status"] == "paid" for inv in self.invoices.values()),
+            "calls": dict(self.calls),
+            "errors": self.errors,
+            "throttled": self.throttled,
+            "webhooks_sent": self.webhooks_sent,
+            "webhooks_failed": self.webhooks_failed,
+        }
+
+
+async def serve(fake: FakeCryptoPay, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(fake.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    return runner
+
+
+def main() -> None:
+    from vpn_bot.config import CRYPTOBOT_TOKEN
+    ap = argparse.ArgumentParser(description="Локальный Crypto Pay API")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8090)
+    ap.add_argument("--token", default=CRYPTOBOT_TOKEN, help="ожидаемый Crypto-Pay-API-Token (он же ключ подписи вебхука)")
+    ap.add_argument("--latency", type=float, default=0.0, help="задержка ответа, сек")
+    ap.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, сек")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    ap.add_argument("--throttle-rate", type=float, default=0.0, help="доля ответов 429")
+    ap.add_argument("--webhook", help="URL вебхука бота (…/api/cryptopay/webhook)")
+    ap.add_argument("--auto-pay", type=float, help="оплачивать каждый счёт через столько секунд")
+    args = ap.parse_args()
+    fake = FakeCryptoPay(
+        args.token, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, webhook_url=args.webhook, auto_pay=args.auto_pay,
+    )
+    print(f"fake Crypto Pay: http://{args.host}:{args.port}/api/  (CRYPTOPAY_API_URL)")
+    web.run_app(fake.make_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
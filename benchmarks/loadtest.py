@@ -0,0 +1,308 @@
+# benchmarks/loadtest.py
+"""
+Сквозной нагрузочный прогон: N пользователей одновременно проходят
+/start → /buy → оплата (вебхук) → /check → /vpn_wg → /app_code → /api/validate → /api/config.
+
+Команды идут через настоящие обработчики PTB (транспорт Bot API подменён, в Telegram ничего
+не уходит), оплата — через локальный fake Crypto Pay с вебхуком на HTTP API бота.
+Всё состояние бота — во временном каталоге.
+
+    python -m benchmarks.loadtest [--users 500] [--concurrency 50]
+        [--cp-latency 0.05] [--cp-jitter 0.02] [--cp-error-rate 0.01] [--tg-latency 0.03] [--out report.json]
+
+Отчёт: по каждому этапу — число, ошибки, p50/p99/max (мс) и пропускная способность (вызовов в секунду за окно активности этапа — от начала первого до конца последнего вызова).
+"""
+from __future__ import annotations
+import argparse, asyncio, itertools, json, os, re, shutil, socket, sys, tempfile, time
+from pathlib import Path
+from typing import Optional
+
+import aiohttp
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+from benchmarks.suite import _isolate_env
+
+STAGES = ("start", "buy", "pay_webhook", "check", "vpn_wg", "app_code", "http_validate", "http_config")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+class FakeTelegram(BaseRequest):
+    """Транспорт Bot API без сети: отвечает как Telegram и запоминает последнее сообщение в каждый чат."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.last_text: dict[int, str] = {}
+        self.calls: dict[str, int] = {}
+        self._ids = itertools.count(1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None, **timeouts):
+        api = url.rsplit("/", 1)[-1]
+        self.calls[api] = self.calls.get(api, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.json_parameters if request_data is not None else {}
+        if api == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Load", "username": "loadtest_bot"}
+        elif api in ("sendMessage", "sendDocument"):
+            chat_id = int(params["chat_id"])
+            n = next(self._ids)
+            result = {"message_id": n, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+            if api == "sendMessage":
+                result["text"] = self.last_text[chat_id] = params.get("text", "")
+            else:
+                result["document"] = {"file_id": f"doc{n}", "file_unique_id": f"u{n}"}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class LoadTest:
+    def __init__(self, bot, app, tg: FakeTelegram, fake, http_url: str):
+        self.bot = bot
+        self.app = app
+        self.tg = tg
+        self.fake = fake
+        self.http_url = http_url
+        self.latencies: dict[str, list[float]] = {s: [] for s in STAGES}
+        self.errors: dict[str, int] = {s: 0 for s in STAGES}
+        # окно активности этапа: начало первого и конец последнего вызова — для пропускной способности
+        self.windows: dict[str, list[float]] = {}
+        self.completed = 0
+        self._update_ids = itertools.count(1)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def send(self, user_id: int, text: str) -> str:
+        """Команда от пользователя через обработчики PTB; возвращает последний ответ бота."""
+        command = text.split()[0]
+        update = Update.de_json({
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._update_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+            },
+        }, self.app.bot)
+        await self.app.process_update(update)
+        return self.tg.last_text.get(user_id, "")
+
+    async def _stage(self, name: str, coro):
+        t0 = time.perf_counter()
+        window = self.windows.setdefault(name, [t0, t0])
+        window[0] = min(window[0], t0)
+        try:
+            result = await coro
+        except Exception:
+            self.errors[name] += 1
+            raise
+        t1 = time.perf_counter()
+        window[1] = max(window[1], t1)
+        self.latencies[name].append(t1 - t0)
+        return result
+
+    async def _http(self, method: str, path: str, **kwargs) -> str:
+        async with self._session.request(method, self.http_url + path, **kwargs) as resp:
+            body = await resp.text()
+            if resp.status != 200:
+                raise RuntimeError(f"{path}: HTTP {resp.status} {body[:80]}")
+            return body
+
+    async def user_flow(self, user_id: int) -> None:
+        await self._stage("start", self.send(user_id, "/start"))
+        reply = await self._stage("buy", self.send(user_id, "/buy"))
+        m = re.search(r"ID счёта: `(\d+)`", reply)
+        if not m:
+            self.errors["buy"] += 1
+            raise RuntimeError(f"/buy: {reply[:80]!r}")
+        invoice_id = int(m.group(1))
+        # бот отвечает на вебхук после активации и подготовки конфигов
+        await self._stage("pay_webhook", self.fake.pay(invoice_id))
+        if not self.bot.is_subscription_active(self.bot.USERS, user_id):
+            self.errors["pay_webhook"] += 1
+            raise RuntimeError("подписка не активировалась")
+        await self._stage("check", self.send(user_id, f"/check {invoice_id}"))
+        await self._stage("vpn_wg", self.send(user_id, "/vpn_wg"))
+        reply = await self._stage("app_code", self.send(user_id, "/app_code"))
+        m = re.search(r"Код для входа в приложение: (\d+)", reply)
+        if not m:
+            self.errors["app_code"] += 1
+            raise RuntimeError(f"/app_code: {reply[:80]!r}")
+        code = m.group(1)
+        await self._stage("http_validate", self._http("POST", "/api/validate", json={"code": code}))
+        await self._stage("http_config", self._http("GET", "/api/config", params={"code": code}))
+        self.completed += 1
+
+    async def run(self, users: int, concurrency: int, first_uid: int = 1_000_000) -> float:
+        sem = asyncio.Semaphore(concurrency)
+        failures: dict[str, int] = {}
+
+        async def one(uid: int) -> None:
+            async with sem:
+                try:
+                    await self.user_flow(uid)
+                except Exception as e:
+                    key = type(e).__name__
+                    failures[key] = failures.get(key, 0) + 1
+
+        self._session = aiohttp.ClientSession()
+        try:
+            t0 = time.perf_counter()
+            await asyncio.gather(*(one(first_uid + i) for i in range(users)))
+            wall = time.perf_counter() - t0
+        finally:
+            await self._session.close()
+        if failures:
+            print(f"сбои пользователей: {failures}")
+        return wall
+
+    def report(self, wall: float) -> dict:
+        stages = {}
+        for name in STAGES:
+            values = sorted(self.latencies[name])
+            start, end = self.windows.get(name, (0.0, 0.0))
+            active = end - start
+            stages[name] = {
+                "count": len(values),
+                "errors": self.errors[name],
+                "p50_ms": _percentile(values, 0.50) * 1000,
+                "p99_ms": _percentile(values, 0.99) * 1000,
+                "max_ms": (values[-1] if values else 0.0) * 1000,
+                "active_sec": active,
+                "per_sec": len(values) / active if active > 0 else 0.0,
+            }
+        return {
+            "wall_sec": wall,
+            "users_completed": self.completed,
+            "users_per_sec": self.completed / wall if wall > 0 else 0.0,
+            "stages": stages,
+            "cryptopay": self.fake.stats(),
+            "telegram_calls": dict(self.tg.calls),
+            "nodes": {n.name: n.used for n in self.bot.NODES},
+            "wg_peers": None if not self.bot.PEERS else {
+                "desired": sum(len(s) for s in self.bot.PEERS.values()),
+                "applied": sum(s.applied for s in self.bot.PEERS.values()),
+                "commands": sum(len(getattr(s.executor, "commands_run", ())) for s in self.bot.PEERS.values()),
+            },
+        }
+
+
+def print_report(report: dict) -> None:
+    print(f"\n{'этап':<14} {'n':>7} {'ошибок':>7} {'p50 мс':>9} {'p99 мс':>9} {'max мс':>9} {'в сек':>9}")
+    for name, s in report["stages"].items():
+        print(f"{name:<14} {s['count']:>7} {s['errors']:>7} {s['p50_ms']:>9.1f} {s['p99_ms']:>9.1f} "
+              f"{s['max_ms']:>9.1f} {s['per_sec']:>9.1f}")
+    print(f"\nпользователей: {report['users_completed']} за {report['wall_sec']:.2f} с "
+          f"({report['users_per_sec']:.1f} польз./с)")
+    cp = report["cryptopay"]
+    print(f"Crypto Pay: вызовы {cp['calls']}, 500: {cp['errors']}, 429: {cp['throttled']}, "
+          f"вебхуков {cp['webhooks_sent']} (+{cp['webhooks_failed']} неудачных)")
+    if report["wg_peers"]:
+        wg = report["wg_peers"]
+        print(f"WG-пиры: {wg['desired']} на серверах, применено {wg['applied']} за {wg['commands']} вызовов wg")
+    if len(report["nodes"]) > 1:
+        print("узлы: " + ", ".join(f"{name} {used}" for name, used in report["nodes"].items()))
+
+
+async def _main(args, workdir: Path) -> dict:
+    from benchmarks.fake_cryptopay import FakeCryptoPay, serve
+    import vpn_bot.bot as bot
+
+    bot.NOTIFIER.blocked_path = str(workdir / "blocked.json")
+    # все HTTP-запросы стенда идут с одного адреса — анти-спам снимаем
+    bot.RATE_LIMITS.budgets.clear()
+    bot.RATE_LIMITS.default = (1e9, 1e9)
+
+    fake = FakeCryptoPay(
+        os.environ["CRYPTOBOT_TOKEN"], latency=args.cp_latency, jitter=args.cp_jitter,
+        error_rate=args.cp_error_rate, throttle_rate=args.cp_throttle_rate,
+        webhook_url=f"http://127.0.0.1:{bot.HTTP_PORT}/api/cryptopay/webhook", seed=1,
+    )
+    fake_runner = await serve(fake, "127.0.0.1", args.cp_port)
+
+    tg = FakeTelegram(latency=args.tg_latency)
+    app = bot.build_app(request=tg)
+    await app.initialize()
+    try:
+        # как в run_webhook: post_init до start, фоновые задачи бота не ждут остановки
+        await bot._post_init(app)
+        await app.start()
+        while bot._http_runner is None or not bot._http_runner.sites:
+            await asyncio.sleep(0.01)
+        lt = LoadTest(bot, app, tg, fake, f"http://127.0.0.1:{bot.HTTP_PORT}")
+        wall = await lt.run(args.users, args.concurrency)
+        await bot.NOTIFIER.join()
+        for sync in bot.PEERS.values():
+            await sync.flush(bot.WORKERS)
+        return lt.report(wall)
+    finally:
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        await bot._post_shutdown(app)
+        await fake_runner.cleanup()
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Сквозной нагрузочный прогон бота")
+    ap.add_argument("--users", type=int, default=500)
+    ap.add_argument("--concurrency", type=int, default=50, help="одновременно активных пользователей")
+    ap.add_argument("--cp-latency", type=float, default=0.05, help="задержка Crypto Pay, сек")
+    ap.add_argument("--cp-jitter", type=float, default=0.02)
+    ap.add_argument("--cp-error-rate", type=float, default=0.0, help="доля ответов 500 от Crypto Pay")
+    ap.add_argument("--cp-throttle-rate", type=float, default=0.0, help="доля ответов 429 от Crypto Pay")
+    ap.add_argument("--cp-port", type=int, default=0, help="порт fake Crypto Pay (0 — свободный)")
+    ap.add_argument("--tg-latency", type=float, default=0.03, help="задержка ответа Bot API, сек")
+    ap.add_argument("--nodes", type=int, default=1, help="число VPN-узлов (пользователи распределяются по ним)")
+    ap.add_argument("--out", help="куда записать JSON-отчёт")
+    args = ap.parse_args(argv)
+
+    args.cp_port = args.cp_port or _free_port()
+    workdir = Path(tempfile.mkdtemp(prefix="vpn_load_"))
+    # до первого импорта vpn_bot.config
+    _isolate_env(workdir)
+    os.environ["CRYPTOPAY_API_URL"] = f"http://127.0.0.1:{args.cp_port}/api/"
+    os.environ["HTTP_HOST"] = "127.0.0.1"
+    os.environ["HTTP_PORT"] = str(_free_port())
+    os.environ["TG_WEBHOOK_URL"] = ""
+    os.environ["INVOICE_POLL_SEC"] = "0"  # оплату подтверждает вебхук
+    os.environ["WG_SYNC"] = "record"  # пиры WG-сервера — в памяти, без wg
+    if args.nodes > 1:
+        nodes = [
+            {"name": f"node{i}", "endpoint_host": f"node{i}.test", "public_key": "", "pool": f"10.{66 + i}.0.0/16"}
+            for i in range(args.nodes)
+        ]
+        (workdir / "nodes.json").write_text(json.dumps(nodes), encoding="utf-8")
+        os.environ["WG_NODES_FILE"] = str(workdir / "nodes.json")
+    try:
+        report = asyncio.run(_main(args, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print_report(report)
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"отчёт: {args.out}")
+    return 0 if report["users_completed"] == args.users else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,407 @@
+# benchmarks/suite.py
+"""
+Офлайн-набор бенчмарков горячих путей. Сеть и настоящие данные бота не трогаются:
+всё пишется во временный каталог.
+
+    python -m benchmarks.suite                              # всё, пользователи 1k/100k/1M
+    python -m benchmarks.suite --sizes 1000,100000 --only users,tokens
+    python -m benchmarks.suite --out benchmarks/baseline.json   # сохранить базу
+    python -m benchmarks.suite --baseline benchmarks/baseline.json  # сравнить с базой
+
+Группы: users, alloc, render, keygen, tokens, http, startup.
+Результат — JSON {"meta": ..., "results": {имя: {"n", "seconds", "ops_per_sec"}}}.
+С --baseline сравнивается ops_per_sec: падение больше --threshold (по умолчанию 20%)
+считается регрессией, код выхода 1.
+"""
+from __future__ import annotations
+import argparse, asyncio, json, os, platform, random, shutil, subprocess, sys, tempfile, time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable
+
+GROUPS = ("users", "alloc", "render", "keygen", "tokens", "http", "startup")
+DEFAULT_SIZES = (1_000, 100_000, 1_000_000)
+
+
+class Suite:
+    def __init__(self, workdir: Path, repeat: int = 3):
+        self.workdir = workdir
+        self.repeat = repeat
+        self.results: dict[str, dict] = {}
+
+    def record(self, name: str, n: int, seconds: float) -> None:
+        self.results[name] = {"n": n, "seconds": seconds, "ops_per_sec": n / seconds if seconds > 0 else None}
+        rate = self.results[name]["ops_per_sec"]
+        print(f"  {name:<40} {seconds * 1000:>10.2f} мс {rate or 0:>14,.0f} оп/с", flush=True)
+
+    def measure(self, name: str, n: int, fn: Callable[[], object], setup: Callable[[], object] | None = None,
+                repeat: int | None = None) -> None:
+        """Лучшее время из repeat прогонов fn(); setup() — перед каждым прогоном, вне замера."""
+        best = float("inf")
+        for _ in range(repeat or self.repeat):
+            if setup is not None:
+                setup()
+            t0 = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - t0)
+        self.record(name, n, best)
+
+
+# --- хранилище пользователей ---
+def _synthetic_users(n: int):
+    from vpn_bot.users import User
+    from vpn_bot.wg_utils import gen_wg_keypair_raw
+    now = int(time.time())
+    priv, pub = gen_wg_keypair_raw()  # одна пара на всех: ключи здесь — просто 32 байта
+    rnd = random.Random(n)
+    for i in range(n):
+        active = rnd.random() < 0.7
+        end = now + rnd.randint(-30, 30) * 86400
+        yield 100_000_000 + i, User(
+            subscribed=active, subscription_start=end - 7 * 86400, subscription_end=end,
+            wg_private_key=priv, wg_public_key=pub, wg_address=(10 << 24) + i + 2,
+        )
+
+
+def bench_users(suite: Suite, sizes) -> None:
+    from vpn_bot.users import JsonUserStore, save_users, user_from_json
+    for n in sizes:
+        d = suite.workdir / f"users_{n}"
+        d.mkdir()
+        path, journal = str(d / "users.json"), str(d / "users.journal")
+        store = JsonUserStore(path, journal)
+        for uid, u in _synthetic_users(n):
+            store._set(uid, u)  # без журнала: сразу пишем снапшот
+        repeat = 1 if n >= 1_000_000 else suite.repeat
+        suite.measure(f"users.save[{n}]", n, lambda: save_users(store), repeat=repeat)
+        store.close()
+
+        holder = []
+
+        def close_loaded():
+            while holder:
+                holder.pop().close()
+        suite.measure(f"users.load[{n}]", n, lambda: holder.append(JsonUserStore(path, journal)),
+                      setup=close_loaded, repeat=repeat)
+        store = holder.pop()
+
+        # JSON — формат экспорта и прежний снапшот; для сравнения со снапшотом
+        export = str(d / "export.json")
+        suite.measure(f"users.export_json[{n}]", n, lambda: store.export_json(export), repeat=1)
+
+        def parse_json():
+            with open(export, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            return {int(k): user_from_json(v) for k, v in raw.items()}
+        suite.measure(f"users.parse_json[{n}]", n, parse_json, repeat=1)
+
+        # типичная запись: 1000 изменённых пользователей дописываются в журнал
+        ids = [uid for uid, _ in zip(store._users, range(1000))]
+
+        def touch():
+            for uid in ids:
+                store._dirty.add(uid)
+        suite.measure(f"users.flush_journal[{n}]", len(ids), store.flush, setup=touch)
+        suite.measure(f"users.take_expired[{n}]", n, lambda: store.take_expired(time.time()), repeat=1)
+        store.close()
+        shutil.rmtree(d)
+
+
+# --- пул WG-адресов ---
+def bench_alloc(suite: Suite, sizes) -> None:
+    from vpn_bot.wg_pool import WgAddressPool
+    rnd = random.Random(1)
+    net = "10.64.0.0/12"  # ~1M адресов
+    probe = WgAddressPool(net)
+    cap = probe.capacity
+    free = 1000
+    keep_free = set(rnd.sample(range(cap), free))
+    base = int(probe.network.network_address) + 2
+    addrs = [base + i for i in range(cap) if i not in keep_free]
+
+    state = {}
+
+    def fresh():
+        pool = WgAddressPool(net)
+        pool.load(addrs)
+        state["pool"] = pool
+
+    # почти полный пул: свободные адреса разбросаны по всему диапазону, курсор их ищет
+    suite.measure(f"alloc.scan_near_full[{cap}]", free,
+                  lambda: [state["pool"].allocate() for _ in range(free)], setup=fresh)
+
+    # оборот: освобождение + выдача из free-list в почти полном пуле
+    fresh()
+    pool = state["pool"]
+    for _ in range(free - 1):
+        pool.allocate()
+    used = rnd.sample(addrs, 10_000)
+
+    def churn():
+        for a in used:
+            pool.release(a)
+            pool.allocate()
+    suite.measure(f"alloc.churn_near_full[{cap}]", len(used), churn)
+    suite.measure(f"alloc.load[{cap}]", len(addrs), fresh, repeat=1)
+
+    # выбор наименее загруженного узла: 64 узла по /20, выдача и возврат вперемешку
+    from vpn_bot.nodes import Node, NodeRegistry
+    n_nodes = 64
+
+    def registry():
+        nodes = []
+        for i in range(n_nodes):
+            p = WgAddressPool(f"10.{64 + i // 16}.{(i % 16) * 16}.0/20")
+            nodes.append(Node(f"n{i}", f"n{i}.example", 51820, "", p, p.capacity, f"n{i}.example", 1194))
+        reg = NodeRegistry(nodes)
+        state["nodes"] = reg
+        state["given"] = [reg.allocate() for _ in range(50_000)]
+
+    def node_churn():
+        reg, given = state["nodes"], state["given"]
+        for i in range(0, len(given), 2):
+            node, addr = given[i]
+            reg.release(node.name, addr)
+            given[i] = reg.allocate()
+    registry()
+    suite.measure(f"alloc.nodes.churn[{n_nodes}]", len(state["given"]) // 2, node_churn)
+
+
+# --- рендеринг конфигов ---
+def bench_render(suite: Suite, sizes) -> None:
+    from vpn_bot.nodes import load_nodes
+    from vpn_bot.render import TEMPLATE_OVPN, TEMPLATE_WG, ovpn_values, render_config, wg_values
+    users = list(_synthetic_users(10_000))
+    node = load_nodes().default
+    for kind, tf, values_fn in (("wg", TEMPLATE_WG, wg_values), ("ovpn", TEMPLATE_OVPN, ovpn_values)):
+        try:
+            tpl = tf.get()
+        except FileNotFoundError:
+            print(f"  render.{kind}: нет шаблона {tf.path}, пропуск")
+            continue
+        values = [values_fn(uid, u, node) for uid, u in users]
+        suite.measure(f"render.{kind}.stamp", len(values), lambda: [tpl.stamp(v) for v in values])
+        suite.measure(f"render.{kind}.render", len(values),
+                      lambda: [render_config(tpl, v, tpl.stamp(v)) for v in values])
+
+
+# --- ключи ---
+def bench_keygen(suite: Suite, sizes) -> None:
+    from vpn_bot.wg_utils import gen_wg_keypair, gen_wg_keypairs
+    n = 2000
+    suite.measure("keygen.gen_wg_keypair", n, lambda: [gen_wg_keypair() for _ in range(n)])
+    suite.measure("keygen.gen_wg_keypairs", n, lambda: gen_wg_keypairs(n))
+
+
+# --- коды входа ---
+def bench_tokens(suite: Suite, sizes) -> None:
+    from vpn_bot.login_codes import LoginCodeStore
+    n = 50_000
+    state = {}
+
+    def fresh():
+        state["store"] = LoginCodeStore(ttl=600, capacity=n * 2)
+
+    def issue():
+        store = state["store"]
+        state["codes"] = [store.issue(uid) for uid in range(n)]
+
+    def refill():
+        fresh()
+        issue()
+
+    def take():
+        store = state["store"]
+        for c in state["codes"]:
+            store.take(c)
+
+    suite.measure("tokens.issue", n, issue, setup=fresh)
+    suite.measure("tokens.peek", n, lambda: [state["store"].peek(c) for c in state["codes"]])
+    suite.measure("tokens.take", n, take, setup=refill)
+    refill()
+    suite.measure("tokens.sweep", n, lambda: state["store"].sweep(time.time() + 3600), repeat=1)
+
+
+# --- HTTP API ---
+def _isolate_env(workdir: Path) -> None:
+    """До первого импорта vpn_bot.config: всё состояние бота — во временном каталоге."""
+    os.environ.setdefault("BOT_TOKEN", "bench")  # config требует токены; в сеть бенчмарки не ходят
+    os.environ.setdefault("CRYPTOBOT_TOKEN", "bench")
+    os.environ["USER_STORE"] = "json"
+    os.environ["USERS_FILE"] = str(workdir / "bot_users.json")
+    os.environ["INVOICES_FILE"] = str(workdir / "invoices.journal")
+    os.environ["CONFIG_PACK"] = str(workdir / "bot_configs.pack")
+    os.environ["WG_POOL"] = "10.66.0.0/16"
+    os.environ["WG_NODES_FILE"] = ""  # один узел из WG_POOL
+
+
+def _import_bot(workdir: Path):
+    import vpn_bot.bot as bot
+    bot.load_state()
+    bot.NOTIFIER.blocked_path = str(workdir / "blocked.json")
+    # бенчмарк ходит с одного адреса — снимаем анти-спам
+    bot.RATE_LIMITS.budgets.clear()
+    bot.RATE_LIMITS.default = (1e9, 1e9)
+    return bot
+
+
+async def _http(suite: Suite, bot, users: int, concurrency: int) -> None:
+    from aiohttp.test_utils import TestClient, TestServer
+    from vpn_bot.users import activate_subscription
+    for uid in range(1, users + 1):
+        activate_subscription(bot.USERS, uid, days=7)
+
+    async def run(name: str, n: int, make_request) -> None:
+        sem = asyncio.Semaphore(concurrency)
+
+        async def one(i):
+            async with sem:
+                resp = await make_request(i)
+                await resp.read()
+                assert resp.status == 200, (name, resp.status)
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(n)))
+        suite.record(name, n, time.perf_counter() - t0)
+
+    async with TestClient(TestServer(bot.make_http_app(None))) as client:
+        codes = [bot.create_login_code(uid) for uid in range(1, users + 1)]
+        await run("http.validate", users, lambda i: client.post("/api/validate", json={"code": codes[i]}))
+        # первый запрос: генерация профиля, рендер, запись в пак
+        await run("http.config.cold", users, lambda i: client.get("/api/config", params={"code": codes[i]}))
+        codes = [bot.create_login_code(uid) for uid in range(1, users + 1)]
+        # повторный: из кэша
+        await run("http.config.warm", users, lambda i: client.get("/api/config", params={"code": codes[i]}))
+
+
+def bench_http(suite: Suite, sizes) -> None:
+    bot = _import_bot(suite.workdir)
+    try:
+        asyncio.run(_http(suite, bot, users=2000, concurrency=32))
+    finally:
+        # до удаления временного каталога, а не в atexit
+        bot.WORKERS.shutdown()
+        for close in (bot.NOTIFIER.close, bot.INVOICES.close, bot.USERS.close, bot.PACK.close):
+            close()
+
+
+# --- холодный старт ---
+def _startup_probe() -> None:
+    """Выполняется в дочернем процессе: импорт бота и загрузка состояния, результат — JSON в stdout."""
+    t0 = time.perf_counter()
+    import vpn_bot.bot as bot
+    t1 = time.perf_counter()
+    workdir = os.path.dirname(os.environ["USERS_FILE"])
+    bot.INVOICES.path = os.path.join(workdir, "invoices.journal")
+    bot.NOTIFIER.blocked_path = os.path.join(workdir, "blocked.json")
+    bot.load_state()
+    t2 = time.perf_counter()
+    print(json.dumps({"import": t1 - t0, "load_state": t2 - t1, "users": len(bot.USERS)}))
+
+
+def _run_probe(env: dict) -> tuple[float, dict]:
+    t0 = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", "from benchmarks.suite import _startup_probe; _startup_probe()"],
+        env=env, cwd=str(Path(__file__).resolve().parent.parent),
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return time.perf_counter() - t0, json.loads(out.strip().splitlines()[-1])
+
+
+def bench_startup(suite: Suite, sizes) -> None:
+    """От запуска процесса до готовности (/readyz): отдельным процессом, чтобы старт был холодным."""
+    from vpn_bot.users import JsonUserStore
+    for n in sizes:
+        d = suite.workdir / f"startup_{n}"
+        d.mkdir()
+        users_file = d / "users.json"
+        store = JsonUserStore(str(users_file), str(d / "users.journal"))
+        for uid, u in _synthetic_users(n):
+            store._set(uid, u)
+        store.compact()
+        store.close()
+        env = dict(os.environ, USERS_FILE=str(users_file), CONFIG_PACK=str(d / "configs.pack"))
+        repeat = 1 if n >= 1_000_000 else suite.repeat
+        best = min((_run_probe(env) for _ in range(repeat)), key=lambda r: r[0])
+        wall, phases = best
+        assert phases["users"] == n, phases
+        suite.record(f"startup.import[{n}]", 1, phases["import"])
+        suite.record(f"startup.load_state[{n}]", n, phases["load_state"])
+        suite.record(f"startup.total[{n}]", n, wall)
+        shutil.rmtree(d)
+
+
+BENCHES = {
+    "users": bench_users, "alloc": bench_alloc, "render": bench_render,
+    "keygen": bench_keygen, "tokens": bench_tokens, "http": bench_http,
+    "startup": bench_startup,
+}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Сравнение с базой по ops_per_sec; возвращает имена регрессий."""
+    regressions = []
+    print(f"\n{'бенчмарк':<40} {'база оп/с':>14} {'сейчас оп/с':>14} {'изм.':>8}")
+    for name, cur in results.items():
+        old = baseline.get(name)
+        if not old or not old.get("ops_per_sec") or not cur.get("ops_per_sec"):
+            continue
+        change = cur["ops_per_sec"] / old["ops_per_sec"] - 1
+        mark = ""
+        if change < -threshold:
+            regressions.append(name)
+            mark = "  РЕГРЕССИЯ"
+        print(f"{name:<40} {old['ops_per_sec']:>14,.0f} {cur['ops_per_sec']:>14,.0f} {change:>+7.1%}{mark}")
+    return regressions
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Офлайн-бенчмарки vpn_bot")
+    ap.add_argument("--only", default=",".join(GROUPS), help="группы через запятую: " + ",".join(GROUPS))
+    ap.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="число пользователей для users")
+    ap.add_argument("--repeat", type=int, default=3, help="прогонов на замер (берётся лучший)")
+    ap.add_argument("--out", help="куда записать JSON с результатами")
+    ap.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    ap.add_argument("--threshold", type=float, default=0.2, help="допустимое падение ops/s (0.2 = 20%%)")
+    args = ap.parse_args(argv)
+
+    groups = [g.strip() for g in args.only.split(",") if g.strip()]
+    unknown = set(groups) - set(GROUPS)
+    if unknown:
+        ap.error(f"неизвестные группы: {', '.join(sorted(unknown))}")
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+
+    workdir = Path(tempfile.mkdtemp(prefix="vpn_bench_"))
+    _isolate_env(workdir)
+    suite = Suite(workdir, repeat=args.repeat)
+    try:
+        for g in groups:
+            print(f"[{g}]", flush=True)
+            BENCHES[g](suite, sizes)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": suite.results,
+    }
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"\nрезультаты: {args.out}")
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))["results"]
+        regressions = compare(suite.results, baseline, args.threshold)
+        if regressions:
+            print(f"\nрегрессии ({len(regressions)}): {', '.join(regressions)}")
+            return 1
+        print("\nрегрессий нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
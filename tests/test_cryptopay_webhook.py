@@ -0,0 +1,79 @@
+import asyncio, atexit, json, os, shutil, tempfile, types
+
+# до первого импорта vpn_bot.config: состояние бота — во временном каталоге
+_WORKDIR = tempfile.mkdtemp(prefix="vpn_test_")
+atexit.register(shutil.rmtree, _WORKDIR, ignore_errors=True)  # после финальных сбросов бота
+os.environ.setdefault("BOT_TOKEN", "test")
+os.environ.setdefault("CRYPTOBOT_TOKEN", "test")
+os.environ.update({
+    "USER_STORE": "json",
+    "USERS_FILE": os.path.join(_WORKDIR, "users.json"),
+    "INVOICES_FILE": os.path.join(_WORKDIR, "invoices.journal"),
+    "CONFIG_PACK": os.path.join(_WORKDIR, "configs.pack"),
+    "WG_NODES_FILE": "",
+    "WG_SYNC": "off",
+    "TG_WEBHOOK_URL": "",
+})
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import vpn_bot.bot as bot
+from vpn_bot.cryptopay import webhook_signature
+
+bot.load_state()
+bot.NOTIFIER.blocked_path = os.path.join(_WORKDIR, "blocked.json")
+
+
+class FakeTgApp:
+    """Достаточно для вебхука: задачи не запускаются, а только собираются."""
+
+    def __init__(self):
+        self.job_queue = None
+        self.bot = types.SimpleNamespace()
+        self.tasks = []
+
+    def create_task(self, coro):
+        self.tasks.append(coro.cr_code.co_name)
+        coro.close()
+
+
+def invoice_paid(invoice_id: int, user_id: int) -> bytes:
+    return json.dumps({
+        "update_type": "invoice_paid",
+        "payload": {"invoice_id": invoice_id, "status": "paid", "payload": str(user_id)},
+    }).encode()
+
+
+async def post(tg_app, body: bytes, headers: dict) -> tuple[int, str]:
+    async with TestClient(TestServer(bot.make_http_app(tg_app))) as client:
+        resp = await client.post("/api/cryptopay/webhook", data=body, headers=headers)
+        return resp.status, await resp.text()
+
+
+def sign(body: bytes) -> dict:
+    return {"crypto-pay-api-signature": webhook_signature(body, bot.CRYPTOBOT_TOKEN)}
+
+
+def test_unsigned_invoice_paid_is_rejected():
+    tg_app = FakeTgApp()
+    body = invoice_paid(1001, 42)
+    assert asyncio.run(post(tg_app, body, {})) == (401, "bad signature")
+    assert asyncio.run(post(tg_app, body, {"crypto-pay-api-signature": "0" * 64}))[0] == 401
+    assert not bot.INVOICES.is_paid(1001)
+    assert not bot.is_subscription_active(bot.USERS, 42)
+    assert tg_app.tasks == []
+
+
+def test_signed_invoice_paid_activates_once():
+    tg_app = FakeTgApp()
+    body = invoice_paid(1002, 43)
+    assert asyncio.run(post(tg_app, body, sign(body))) == (200, "ok")
+    assert bot.INVOICES.is_paid(1002)
+    assert bot.is_subscription_active(bot.USERS, 43)
+    assert tg_app.tasks == ["push_configs"]
+
+    # повторная доставка того же счёта ничего не продлевает
+    end = bot.USERS.get(43).subscription_end
+    assert asyncio.run(post(tg_app, body, sign(body))) == (200, "ok")
+    assert bot.USERS.get(43).subscription_end == end
+    assert tg_app.tasks == ["push_configs"]
@@ -0,0 +1,65 @@
+import asyncio, types
+from functools import partial
+
+from telegram.error import BadRequest
+
+from vpn_bot.tg_files import FileIdCache, content_hash, send_config
+
+
+class FakeBot:
+    """send_document как у Bot API: загрузка возвращает новый file_id, известные file_id принимаются."""
+
+    def __init__(self):
+        self.calls = []
+        self.file_ids: set[str] = set()
+        self.uploaded = 0
+
+    async def send_document(self, chat_id, document, filename=None, **kwargs):
+        self.calls.append((chat_id, document, filename))
+        if isinstance(document, str):
+            if document not in self.file_ids:
+                raise BadRequest("Wrong file identifier/http url specified")
+            file_id = document
+        else:
+            self.uploaded += 1
+            file_id = f"file-{self.uploaded}"
+            self.file_ids.add(file_id)
+        return types.SimpleNamespace(document=types.SimpleNamespace(file_id=file_id))
+
+
+def send(bot, cache, data: bytes):
+    send_document = partial(bot.send_document, chat_id=42)
+    return asyncio.run(send_config(send_document, cache, 42, "wg", memoryview(data), "vpn.conf"))
+
+
+def test_first_upload_stores_file_id():
+    bot, cache = FakeBot(), FileIdCache()
+    msg = send(bot, cache, b"[Interface]\n")
+    assert bot.calls == [(42, b"[Interface]\n", "vpn.conf")]
+    assert msg.document.file_id == "file-1"
+    assert (cache.uploads, cache.hits, len(cache)) == (1, 0, 1)
+
+
+def test_unchanged_bytes_are_resent_by_file_id():
+    bot, cache = FakeBot(), FileIdCache()
+    send(bot, cache, b"[Interface]\n")
+    send(bot, cache, b"[Interface]\n")
+    assert bot.calls[1] == (42, "file-1", None)
+    assert (cache.uploads, cache.hits) == (1, 1)
+
+    # изменился конфиг — снова загрузка
+    send(bot, cache, b"[Interface]\nDNS = 1.1.1.1\n")
+    assert bot.calls[2] == (42, b"[Interface]\nDNS = 1.1.1.1\n", "vpn.conf")
+    assert (cache.uploads, cache.hits) == (2, 1)
+
+
+def test_rejected_file_id_falls_back_to_upload():
+    bot, cache = FakeBot(), FileIdCache()
+    send(bot, cache, b"[Interface]\n")
+    bot.file_ids.clear()  # Telegram больше не принимает file_id
+    msg = send(bot, cache, b"[Interface]\n")
+    assert bot.calls[1] == (42, "file-1", None)
+    assert bot.calls[2] == (42, b"[Interface]\n", "vpn.conf")
+    assert msg.document.file_id == "file-2"
+    assert cache.get(42, "wg", content_hash(b"[Interface]\n")) == "file-2"
+    assert (cache.uploads, cache.hits) == (2, 0)
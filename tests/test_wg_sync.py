@@ -0,0 +1,130 @@
+import asyncio, base64, ipaddress
+
+from vpn_bot.wg_sync import PeerSync, RecordingExecutor, SyncConfExecutor
+
+NET = "10.66.0.0/16"
+
+
+def key(i: int) -> bytes:
+    return bytes([i]) * 32
+
+
+def b64(i: int) -> str:
+    return base64.b64encode(key(i)).decode()
+
+
+def addr(host: int) -> int:
+    return int(ipaddress.IPv4Address("10.66.0.0")) + host
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_delta_batches_only_changed_peers():
+    ex = RecordingExecutor("wg0", batch=2)
+    sync = PeerSync(ex, NET)
+    sync.load([(key(1), addr(2))])  # уже на сервере — не отправляется
+    sync.add(key(2), addr(3))
+    sync.add(key(3), addr(4))
+    sync.add(key(4), addr(5))
+    sync.remove(key(1))
+    assert sync.pending == 4
+
+    assert run(sync.flush()) == 4
+    # 3 upsert + 1 remove, по 2 пира на вызов
+    assert len(ex.commands_run) == 2
+    assert all(cmd[:3] == ["wg", "set", "wg0"] for cmd in ex.commands_run)
+    flat = [arg for cmd in ex.commands_run for arg in cmd]
+    assert flat.count("allowed-ips") == 3 and flat.count("remove") == 1
+    assert ex.peers == {key(2): "10.66.0.3/32", key(3): "10.66.0.4/32", key(4): "10.66.0.5/32"}
+
+    # без изменений — ни одного вызова
+    assert run(sync.flush()) == 0
+    assert len(ex.commands_run) == 2
+
+
+def test_add_then_remove_in_one_window_is_a_single_remove():
+    ex = RecordingExecutor("wg0")
+    sync = PeerSync(ex, NET)
+    sync.add(key(1), addr(2))
+    sync.remove(key(1))
+    run(sync.flush())
+    assert ex.commands_run == [["wg", "set", "wg0", "peer", b64(1), "remove"]]
+
+
+def test_full_resync_fixes_drift_and_keeps_foreign_peers():
+    ex = RecordingExecutor("wg0", wg="ssh node1 wg")
+    ex.peers = {
+        key(1): "10.66.0.2/32",   # желаемый, совпадает
+        key(2): "10.66.0.99/32",  # желаемый, но не тот адрес
+        key(3): "10.66.0.7/32",   # лишний из нашего пула — удалить
+        key(9): "10.0.0.1/32",    # чужой: вне пула
+        key(8): "0.0.0.0/0",      # чужой: не один /32
+    }
+    sync = PeerSync(ex, NET)
+    sync.load([(key(1), addr(2)), (key(2), addr(3)), (key(4), addr(5))])
+
+    assert run(sync.resync()) == (2, 1)
+    assert ex.commands_run[0] == ["ssh", "node1", "wg", "show", "wg0", "dump"]
+    assert ex.commands_run[1][:5] == ["ssh", "node1", "wg", "set", "wg0"]
+    assert ex.peers == {
+        key(1): "10.66.0.2/32", key(2): "10.66.0.3/32", key(4): "10.66.0.5/32",
+        key(9): "10.0.0.1/32", key(8): "0.0.0.0/0",
+    }
+    assert sync.pending == 0 and sync.last_full is not None
+
+
+def test_failed_apply_requeues_keys():
+    class Failing(RecordingExecutor):
+        fail = True
+
+        def _run(self, args):
+            if self.fail:
+                raise OSError("wg unavailable")
+            return super()._run(args)
+
+    ex = Failing("wg0")
+    sync = PeerSync(ex, NET)
+    sync.add(key(1), addr(2))
+    try:
+        run(sync.flush())
+    except OSError:
+        pass
+    assert sync.pending == 1 and sync.failures == 1
+    ex.fail = False
+    assert run(sync.flush()) == 1
+    assert ex.peers == {key(1): "10.66.0.2/32"}
+
+
+def test_syncconf_keeps_foreign_peers(tmp_path):
+    showconf = (
+        "[Interface]\nListenPort = 51820\nPrivateKey = c2VydmVy\n\n"
+        f"[Peer]\nPublicKey = {b64(9)}\nAllowedIPs = 10.0.0.0/24\nEndpoint = 192.0.2.1:51820\n\n"
+        f"[Peer]\nPublicKey = {b64(3)}\nAllowedIPs = 10.66.0.7/32\n\n"
+        f"[Peer]\nPublicKey = {b64(1)}\nAllowedIPs = 10.66.0.2/32\n"
+    )
+
+    class Fake(SyncConfExecutor):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.commands_run = []
+
+        def _run(self, args):
+            self.commands_run.append(list(args))
+            return showconf if args[1] == "showconf" else ""
+
+    path = tmp_path / "wg0.peers.conf"
+    ex = Fake(str(path), "wg0", network=NET)
+    sync = PeerSync(ex, NET)
+    sync.add(key(1), addr(2))
+    sync.add(key(2), addr(3))
+    run(sync.flush())
+
+    assert ex.commands_run == [["wg", "showconf", "wg0"], ["wg", "syncconf", "wg0", str(path)]]
+    text = path.read_text()
+    # чужой пир перенесён целиком, бывший наш (10.66.0.7) — нет, желаемые — по разу
+    assert f"PublicKey = {b64(9)}\nAllowedIPs = 10.0.0.0/24\nEndpoint = 192.0.2.1:51820" in text
+    assert b64(3) not in text
+    assert text.count(b64(1)) == 1 and text.count(b64(2)) == 1
+    assert "[Interface]" not in text
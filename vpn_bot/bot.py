@@ -1,13 +1,20 @@
 # vpn_bot/bot.py
-import secrets
+import asyncio
+import atexit
+import hmac
+import ipaddress
+import json
+import signal
 from aiohttp import web
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
 from datetime import datetime, timezone
-import shutil
-from pathlib import Path
-import logging, os
+import logging
 from telegram import Update
+from telegram.request import BaseRequest
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     ContextTypes,
@@ -15,17 +22,35 @@ from telegram.ext import (
     filters,
 )
 from vpn_bot.config import (
-    BOT_TOKEN, PRICE_USDT, SUB_DAYS, DEV_MODE, OWNER_ID,
-    SERVER_HOST, SERVER_PORT,
-    WG_ENDPOINT_HOST, WG_ENDPOINT_PORT, WG_ALLOWED_IPS, WG_DNS, WG_SERVER_PUBLIC_KEY,
-    WG_ADDRESS_PREFIX, WG_ADDRESS_CIDR, WG_START_HOST,
+    BOT_TOKEN, CRYPTOBOT_TOKEN, PRICE_USDT, SUB_DAYS, DEV_MODE, OWNER_ID,
+    WG_RECLAIM_DAYS, INVOICE_POLL_SEC,
+    WG_KEYPOOL_LOW, WG_KEYPOOL_HIGH,
+    USER_STORE, USERS_DB, CONFIG_CACHE_MAX_BYTES, CONFIG_PACK,
+    HTTP_HOST, HTTP_PORT, HTTP_TRUSTED_PROXIES,
+    TG_WEBHOOK_URL, TG_WEBHOOK_PATH, TG_WEBHOOK_SECRET, TG_CONCURRENT_UPDATES,
+    WORKER_THREADS, METRICS_TOKEN,
+    WG_SYNC, WG_SYNC_BATCH, WG_SYNC_FULL_ON_START,
 )
-from vpn_bot.cryptopay import create_invoice, get_invoice_status
+from vpn_bot.cryptopay import CryptoPayClient, INVOICES_PAGE_SIZE, verify_webhook_signature
+from vpn_bot.invoices import InvoiceBook
+from vpn_bot.locks import KeyedLocks
+from vpn_bot.metrics import REGISTRY
+from vpn_bot.nodes import Node, load_nodes
+from vpn_bot.login_codes import AttemptLimiter, CodeStoreFull, LoginCodeStore
+from vpn_bot.notify import Notifier
+from vpn_bot.packstore import ConfigPack
+from vpn_bot.ratelimit import RateLimiter
+from vpn_bot.render import (
+    TEMPLATE_OVPN, TEMPLATE_WG, USER_CFG_DIR, ovpn_values, render_config, wg_values,
+)
+from vpn_bot.templates import RenderCache
+from vpn_bot.tg_files import FileIdCache, send_config
 from vpn_bot.users import (
-    load_users, register_user, activate_subscription, is_subscription_active, save_users,
-    set_wg_profile, next_wg_address,
+    UserStore, open_user_store, register_user, activate_subscription, is_subscription_active,
+    set_wg_profile, release_wg_profile, expire_subscription,
 )
-from vpn_bot.wg_utils import gen_wg_keypair
+from vpn_bot.wg_sync import PeerSync, make_peer_sync
+from vpn_bot.wg_utils import KeypairPool
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)s %(name)s: %(message)s",
@@ -33,51 +58,215 @@ logging.basicConfig(
 )
 log = logging.getLogger("vpn_bot")
 
-# Загружаем пользователей при старте
-USERS = load_users()
+# Пользователи, пул адресов и пак конфигов загружаются в load_state() из post_init, а не при импорте:
+# HTTP-сервер к этому моменту уже отвечает на /healthz, а /readyz — 503, пока загрузка не закончится
+USERS: UserStore | None = None
+STATE_LOAD_SECONDS: float | None = None
+
+# Обновления обрабатываются параллельно: запросы одного пользователя — по очереди (USER_LOCKS),
+# записи пользователей и пулы адресов узлов меняются только из потока event loop'а,
+# а генерация ключей, рендеринг и запись конфигов уходят в WORKERS.
+# Запись пользователя меняется под USER_LOCKS.hold(user_id); без лока — только синхронное
+# чтение и запись без await между ними (register_user): на event loop'е это атомарно
+USER_LOCKS = KeyedLocks()
+WORKERS = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="vpn-worker")
+
+async def run_blocking(fn, *args):
+    """Выполняет fn(*args) в WORKERS, не блокируя event loop."""
+    return await asyncio.get_running_loop().run_in_executor(WORKERS, fn, *args)
+
+# VPN-узлы: новый пользователь получает адрес на наименее загруженном;
+# пулы адресов заполняются по уже выданным адресам (в load_state)
+NODES = load_nodes()
+# Готовые пары ключей: активация не ждёт генерации
+KEYPAIRS = KeypairPool(low=WG_KEYPOOL_LOW, high=WG_KEYPOOL_HIGH)
+# Пиры WG-серверов следуют за подписками: по PeerSync на узел (пусто — WG_SYNC=off);
+# наборы заполняются в load_state
+def _peer_sync(node: Node) -> PeerSync | None:
+    return make_peer_sync(
+        WG_SYNC, str(node.pool.network), interface=node.interface, batch=WG_SYNC_BATCH,
+        conf_path=node.sync_conf, header_path=node.sync_header, wg=node.wg,
+    )
+
+PEERS: dict[str, PeerSync] = {n.name: s for n in NODES if (s := _peer_sync(n)) is not None}
 
-# Пути к шаблонам и личным конфигам
-CFG_DIR = Path(__file__).with_name("vpn_configs")
-TEMPLATE_OVPN = CFG_DIR / "default.ovpn"
-USER_CFG_DIR = CFG_DIR / "users"
-USER_CFG_DIR.mkdir(parents=True, exist_ok=True)
+# Рассылка уведомлений: в пределах лимитов Telegram, не блокируя задачи, которые её ставят
+NOTIFIER = Notifier(rate=30.0, per_chat_interval=1.0)
+atexit.register(NOTIFIER.close)
 
-TEMPLATE_WG = CFG_DIR / "default_wg.conf"
-USER_WG_DIR = CFG_DIR / "users"
-USER_WG_DIR.mkdir(parents=True, exist_ok=True)
+# Клиент Crypto Pay: одна aiohttp-сессия на весь процесс
+CRYPTOPAY = CryptoPayClient()
+# Зачтённые оплаты — чтобы один счёт не активировал подписку дважды
+INVOICES = InvoiceBook()
+atexit.register(INVOICES.close)
 
+# Личные конфиги — в одном упакованном файле (открывается в load_state)
+PACK: ConfigPack | None = None
 
+# Отрендеренные конфиги: тёплый кэш отдаётся без обращения к диску
+CONFIGS = RenderCache(CONFIG_CACHE_MAX_BYTES)
+# file_id уже загруженных в Telegram конфигов: неизменённый конфиг не загружается повторно
+TG_FILES = FileIdCache()
 
-# Простейший анти-спам: кулдаун 2 сек на пользователя
-LAST_CALL: dict[int, float] = {}
-COOLDOWN_SEC = 2.0
+
+def load_state() -> None:
+    """
+    Загрузка пользователей, пулов WG-адресов узлов и пака конфигов. Блокирующая: post_init
+    выполняет её в WORKERS. Повторный вызов ничего не делает.
+    """
+    global USERS, PACK, STATE_LOAD_SECONDS
+    if USERS is not None:
+        return
+    start = time.perf_counter()
+    users = open_user_store(USER_STORE, USERS_DB)
+    # изменения пишутся фоновым потоком; при любом выходе — финальный сброс на диск
+    atexit.register(users.close)
+    NODES.load(users.wg_assignments())
+    if NODES.orphans:
+        log.warning(f"{NODES.orphans} WG addresses belong to nodes missing from the node list")
+    if PEERS:
+        for _, u in users.items():
+            if u.subscribed and u.wg_public_key is not None and u.wg_address is not None:
+                if (sync := PEERS.get(NODES.resolve(u.node).name)) is not None:
+                    sync.load(((u.wg_public_key, u.wg_address),))
+    pack = ConfigPack(CONFIG_PACK)
+    # старый каталог users/ импортируется при первом запуске
+    if not len(pack) and USER_CFG_DIR.is_dir():
+        if n := pack.import_dir(USER_CFG_DIR):
+            log.info(f"imported {n} configs from {USER_CFG_DIR} into {CONFIG_PACK}")
+    atexit.register(pack.close)
+    PACK = pack
+    USERS = users  # последним: по нему проверяется готовность
+    STATE_LOAD_SECONDS = time.perf_counter() - start
+    log.info(f"state loaded in {STATE_LOAD_SECONDS:.2f}s: {len(users)} users, {len(pack)} configs")
+
+
+
+# Анти-спам: token bucket на (команду или маршрут, пользователя или IP) — (запросов/сек, запас)
+RATE_LIMITS = RateLimiter(
+    budgets={
+        # дешёвые команды
+        "cmd:start": (1.0, 5), "cmd:status": (1.0, 5), "cmd:help": (1.0, 5),
+        # выдача конфигов
+        "cmd:vpn": (0.2, 3), "cmd:vpn_wg": (0.2, 3),
+        # дорогие: ходят в Crypto Pay или выдают коды
+        "cmd:buy": (1 / 30, 2), "cmd:check": (0.2, 3), "cmd:app_code": (1 / 30, 3),
+        "http:/api/validate": (1.0, 10),
+        "http:/api/config": (0.2, 5), "http:/api/v1/config/wg": (0.2, 5),
+        "http:/api/telegram-link": (2.0, 20),
+    },
+    default=(0.5, 3),  # примерно прежний кулдаун 2 сек
+    max_keys=100_000,
+)
+# Маршруты без ограничения (подпись/секрет проверяются отдельно)
+RATE_LIMIT_EXEMPT = {"/api/cryptopay/webhook", TG_WEBHOOK_PATH, "/healthz", "/readyz"}
+# Маршруты, которые отвечают и до загрузки состояния
+NOT_READY_ROUTES = {"/healthz", "/readyz", "/metrics"}
 
 # Одноразовые коды для входа из приложения
-TOKENS: dict[str, dict] = {}  # code -> {"user_id": int, "exp": float}
 TOKEN_TTL_SEC = 600  # 10 минут
+TOKENS = LoginCodeStore(ttl=TOKEN_TTL_SEC, capacity=100_000)
+# Перебор кодов: не больше 10 неудачных попыток с одного адреса за 10 минут
+LOGIN_ATTEMPTS = AttemptLimiter(limit=10, window=600)
+
+# --- Метрики (/metrics) ---
+COMMAND_SECONDS = REGISTRY.histogram("vpn_command_seconds", "Обработка команд бота", labels=("command",))
+HTTP_SECONDS = REGISTRY.histogram("vpn_http_request_seconds", "Обработка HTTP-запросов", labels=("route", "status"))
+CHECK_SUBS_SECONDS = REGISTRY.histogram("vpn_check_subscriptions_seconds", "Проход check_subscriptions")
+EXPIRED_TOTAL = REGISTRY.counter("vpn_subscriptions_expired_total", "Отключено истёкших подписок")
+RECLAIMED_TOTAL = REGISTRY.counter("vpn_wg_reclaimed_total", "Возвращено WG-адресов в пул")
+
+def _hit_ratio(hits: int, misses: int) -> float | None:
+    return hits / (hits + misses) if hits + misses else None
+
+# остальное модули считают сами — снимаем при запросе /metrics
+REGISTRY.collect("vpn_ready", "Состояние загружено (1) или ещё нет (0)", lambda: int(USERS is not None))
+REGISTRY.collect("vpn_state_load_seconds", "Длительность загрузки состояния при старте", lambda: STATE_LOAD_SECONDS)
+REGISTRY.collect("vpn_users", "Пользователей в хранилище", lambda: len(USERS) if USERS is not None else None)
+REGISTRY.collect("vpn_wg_addresses_used", "Выдано WG-адресов по узлам",
+                 lambda: {n.name: n.used for n in NODES}, label="node")
+REGISTRY.collect("vpn_wg_addresses_capacity", "Ёмкость узлов (пользователей)",
+                 lambda: {n.name: n.capacity for n in NODES}, label="node")
+REGISTRY.collect("vpn_node_drained", "Узел выведен из выдачи (1) или нет (0)",
+                 lambda: {n.name: int(n.drained) for n in NODES}, label="node")
+REGISTRY.collect("vpn_keypool_size", "Готовых пар ключей", lambda: len(KEYPAIRS))
+REGISTRY.collect("vpn_keypool_misses_total", "Пар ключей, сгенерированных на месте", lambda: KEYPAIRS.misses, "counter")
+REGISTRY.collect("vpn_config_cache_hits_total", "Попаданий в кэш конфигов", lambda: CONFIGS.hits, "counter")
+REGISTRY.collect("vpn_config_cache_misses_total", "Промахов кэша конфигов", lambda: CONFIGS.misses, "counter")
+REGISTRY.collect("vpn_config_cache_hit_ratio", "Доля попаданий в кэш конфигов",
+                 lambda: _hit_ratio(CONFIGS.hits, CONFIGS.misses))
+REGISTRY.collect("vpn_config_cache_bytes", "Байт в кэше конфигов", lambda: CONFIGS.size_bytes)
+REGISTRY.collect("vpn_config_pack_records", "Конфигов в паке", lambda: len(PACK) if PACK is not None else None)
+REGISTRY.collect("vpn_config_pack_garbage_bytes", "Устаревших байт в паке", lambda: PACK.garbage if PACK is not None else None)
+REGISTRY.collect("vpn_tg_file_resends_total", "Конфигов, переотправленных по file_id", lambda: TG_FILES.hits, "counter")
+REGISTRY.collect("vpn_tg_file_uploads_total", "Конфигов, загруженных в Telegram", lambda: TG_FILES.uploads, "counter")
+REGISTRY.collect("vpn_login_codes", "Живых кодов входа", lambda: len(TOKENS))
+REGISTRY.collect("vpn_login_codes_total", "Коды входа по событиям", lambda: {
+    k: v for k, v in TOKENS.stats().items() if k in ("issued", "consumed", "expired", "collisions", "rejected")
+}, "counter", "event")
+REGISTRY.collect("vpn_login_attempts_blocked_total", "Отказов из-за перебора кодов", lambda: LOGIN_ATTEMPTS.blocked_total, "counter")
+REGISTRY.collect("vpn_throttled_total", "Запросов, отклонённых анти-спамом", lambda: RATE_LIMITS.rejected, "counter", "scope")
+REGISTRY.collect("vpn_ratelimit_evictions_total", "Вёдер анти-спама, вытесненных из LRU (early — ещё не восполнившихся)",
+                 lambda: RATE_LIMITS.evicted, "counter", "reason")
+REGISTRY.collect("vpn_notify_queue", "Уведомлений в очереди", lambda: len(NOTIFIER))
+REGISTRY.collect("vpn_notify_total", "Уведомления по исходу", lambda: {
+    k: v for k, v in NOTIFIER.stats().items() if k in ("sent", "failed", "retried", "throttled", "dropped")
+}, "counter", "result")
+REGISTRY.collect("vpn_notify_blocked_users", "Пользователей, заблокировавших бота", lambda: NOTIFIER.stats()["blocked"])
+REGISTRY.collect("vpn_invoices_pending", "Неоплаченных счетов в очереди опроса", lambda: len(INVOICES.pending()))
+REGISTRY.collect("vpn_wg_peers_desired", "Пиров, которые должны быть на WG-сервере",
+                 lambda: {name: len(s) for name, s in PEERS.items()} or None, label="node")
+REGISTRY.collect("vpn_wg_sync_pending", "Изменений пиров, ещё не применённых к серверу",
+                 lambda: {name: s.pending for name, s in PEERS.items()} or None, label="node")
+REGISTRY.collect("vpn_user_lock_waits_total", "Ожиданий лока пользователя", lambda: USER_LOCKS.contended, "counter")
+
+def _timed(command: str, callback):
+    """Обёртка обработчика команды: длительность попадает в COMMAND_SECONDS."""
+    @wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        with COMMAND_SECONDS.time(command=command):
+            return await callback(update, context)
+    return wrapper
 
 def create_login_code(user_id: int) -> str:
-    code = f"{secrets.randbelow(1_000_000):06d}"  # 000000..999999
-    TOKENS[code] = {"user_id": user_id, "exp": time.time() + TOKEN_TTL_SEC}
-    return code
-
-def take_token(code: str) -> dict | None:
-    """Вернёт запись и удалит токен, если живой; иначе None."""
-    data = TOKENS.pop(code, None)
-    if not data:
-        return None
-    if data["exp"] < time.time():
-        return None
-    return data
+    """Новый код (старый код пользователя гасится); CodeStoreFull — если кодов слишком много."""
+    return TOKENS.issue(user_id)
 
-def peek_token(code: str) -> dict | None:
-    """Вернёт запись по коду, не удаляя её (для /api/validate)."""
-    data = TOKENS.get(code)
-    if not data:
-        return None
-    if data["exp"] < time.time():
-        return None
-    return data
+def take_token(code: str) -> int | None:
+    """user_id по живому коду; код расходуется."""
+    return TOKENS.take(code)
+
+def peek_token(code: str) -> int | None:
+    """user_id по живому коду, не расходуя его (для /api/validate)."""
+    return TOKENS.peek(code)
+
+TRUSTED_PROXIES = [ipaddress.ip_network(p.strip(), strict=False) for p in HTTP_TRUSTED_PROXIES.split(",") if p.strip()]
+
+def _is_trusted_proxy(addr: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(addr)
+    except ValueError:
+        return False
+    return any(ip in net for net in TRUSTED_PROXIES)
+
+def _client_ip(request: web.Request) -> str:
+    """
+    Адрес клиента. X-Forwarded-For учитывается, только если соединение пришло от доверенного
+    прокси: цепочка читается справа, доверенные прокси пропускаются, первый чужой адрес — клиент.
+    Левее него всё мог дописать сам клиент.
+    """
+    remote = request.remote or "unknown"
+    if not TRUSTED_PROXIES or not _is_trusted_proxy(remote):
+        return remote
+    hops = [h.strip() for v in request.headers.getall("X-Forwarded-For", ()) for h in v.split(",") if h.strip()]
+    for hop in reversed(hops):
+        if not _is_trusted_proxy(hop):
+            return hop
+    return hops[0] if hops else remote
+
+def _too_many_attempts(request: web.Request) -> float:
+    """Сколько секунд клиенту ждать до следующей попытки ввода кода (0 — можно)."""
+    return LOGIN_ATTEMPTS.retry_after(_client_ip(request))
 
 def get_telegram_link_url() -> str:
     try:
@@ -94,94 +283,119 @@ def get_telegram_link_url() -> str:
 
 
 async def _throttle(update: Update) -> bool:
-    """Возвращает True, если надо заблокировать обработку из-за кулдауна."""
+    """Возвращает True, если надо заблокировать обработку: у команды свой бюджет на пользователя."""
     uid = update.effective_user.id if update.effective_user else 0
-    now = time.time()
-    last = LAST_CALL.get(uid, 0.0)
-    if now - last < COOLDOWN_SEC:
+    text = update.message.text if update.message and update.message.text else ""
+    command = text.split(maxsplit=1)[0].lstrip("/").split("@", 1)[0].lower() if text.startswith("/") else ""
+    NOTIFIER.unblock(uid)  # пишет боту — значит, не заблокировал
+    if RATE_LIMITS.check(f"cmd:{command}", uid):
         # молча игнорируем или отправляем мягкий ответ
         if update.message:
             await update.message.reply_text("⏳ Слишком часто. Подождите пару секунд.")
         return True
-    LAST_CALL[uid] = now
     return False
 
-def ensure_user_config(user_id: int) -> Path:
+def _load_or_render(user_id: int, kind: str, tpl, values: dict, stamp: str) -> bytes | memoryview:
+    """Конфиг из пака, если штамп совпал, иначе рендер и дозапись в пак. Выполняется в WORKERS."""
+    if PACK.stamp(user_id, kind) == stamp:
+        data = PACK.get(user_id, kind)
+    else:
+        data = render_config(tpl, values, stamp)
+        PACK.put(user_id, kind, stamp, data)
+    CONFIGS.put(user_id, kind, stamp, data)
+    return data
+
+async def _user_config(user_id: int, kind: str, tpl, values: dict) -> bytes | memoryview:
+    # тёплый кэш отдаём прямо из event loop'а, за диском и рендером — в пул потоков
+    stamp = tpl.stamp(values)
+    data = CONFIGS.get(user_id, kind, stamp)
+    if data is not None:
+        return data
+    return await run_blocking(_load_or_render, user_id, kind, tpl, values, stamp)
+
+async def get_user_config(user_id: int) -> bytes | memoryview:
     """
-    Гарантирует, что у пользователя есть свой файл-конфиг.
-    Если нет — рендерим из шаблона default.ovpn, подставляя плейсхолдеры.
-    Возвращает путь к файлу.
+    Персональный .ovpn пользователя. Берётся из кэша или пака, если штамп
+    (шаблон + входные данные) не изменился; иначе рендерится заново и пишется в пак.
     """
-    dst = USER_CFG_DIR / f"{user_id}.ovpn"
-    if dst.exists():
-        return dst
+    tpl = TEMPLATE_OVPN.get()
+    async with USER_LOCKS.hold(user_id):
+        u = USERS.get(user_id)
+        node = NODES.resolve(u.node if u else None)
+        return await _user_config(user_id, "ovpn", tpl, ovpn_values(user_id, u, node))
 
-    if not TEMPLATE_OVPN.exists():
-        raise FileNotFoundError("Шаблон default.ovpn не найден в vpn_bot/vpn_configs/")
-
-    # берём дату окончания подписки пользователя (если есть)
+async def get_user_wg_config(user_id: int) -> bytes | memoryview:
+    """
+    Для пользователя гарантирует наличие wg-ключей + адреса и отдаёт .conf
+    (из кэша или заново отрендеренный, если устарел).
+    """
+    tpl = TEMPLATE_WG.get()
+    async with USER_LOCKS.hold(user_id):
+        # получаем/генерируем профиль; под локом пользователя — ровно одна пара ключей и один адрес
+        u = USERS.get(user_id)
+        if not u or not u.wg_private_key or not u.wg_public_key:
+            # пул ключей пуст — генерируем в потоке, а не в event loop'е
+            priv, pub = KEYPAIRS.pop() if len(KEYPAIRS) else await run_blocking(KEYPAIRS.pop)
+            # адреса выдаются только из event loop'а: узел — наименее загруженный
+            node, addr = NODES.allocate()
+            set_wg_profile(USERS, user_id, priv, pub, addr, node=node.name)  # сам пишет запись в журнал
+            u = USERS.get(user_id)
+        _sync_peer(user_id)  # новый профиль или продление: пир должен быть на сервере
+        return await _user_config(user_id, "wg", tpl, wg_values(user_id, u, NODES.resolve(u.node)))
+
+def _sync_peer(user_id: int) -> None:
+    """Пир пользователя на WG-сервере его узла: есть при активной подписке с профилем, иначе — нет."""
+    if not PEERS:
+        return
     u = USERS.get(user_id)
-    sub_end = getattr(u, "subscription_end", None) or ""
-
-    # читаем шаблон и подставляем значения
-    text = TEMPLATE_OVPN.read_text(encoding="utf-8")
-    placeholders = {
-        "SERVER_HOST": SERVER_HOST,
-        "SERVER_PORT": str(SERVER_PORT),
-        "USER_ID": str(user_id),
-        "SUB_END": sub_end,
-    }
-    for k, v in placeholders.items():
-        text = text.replace(f"{{{{{k}}}}}", v)
-
-    dst.write_text(text, encoding="utf-8")
-    return dst
-
-def ensure_user_wg_config(user_id: int) -> Path:
-    """
-    Для пользователя гарантирует наличие wg-ключей + адреса, рендерит .conf из шаблона.
-    """
-    dst = USER_WG_DIR / f"{user_id}.conf"
-    # если файл уже есть, просто возвращаем
-    if dst.exists():
-        return dst
-    if not TEMPLATE_WG.exists():
-        raise FileNotFoundError("Шаблон default_wg.conf не найден в vpn_bot/vpn_configs/")
-
-    # получаем/генерируем профиль
-    u = USERS.setdefault(user_id, None)
-    need_save = False
-    if not u or not getattr(u, "wg_private_key", None) or not getattr(u, "wg_public_key", None):
-        priv, pub = gen_wg_keypair()
-        addr = next_wg_address(USERS, WG_ADDRESS_PREFIX, WG_ADDRESS_CIDR, start_host=WG_START_HOST)
-        set_wg_profile(USERS, user_id, priv, pub, addr)
-        need_save = True
-
-    # перечитываем (на случай, если только что создали)
-    u = USERS[user_id]
-    sub_end = getattr(u, "subscription_end", "") or ""
-
-    # готовим плейсхолдеры
-    placeholders = {
-        "USER_ID": str(user_id),
-        "SUB_END": sub_end,
-        "WG_ENDPOINT_HOST": WG_ENDPOINT_HOST,
-        "WG_ENDPOINT_PORT": str(WG_ENDPOINT_PORT),
-        "WG_ALLOWED_IPS": WG_ALLOWED_IPS,
-        "WG_DNS": WG_DNS,
-        "WG_SERVER_PUBLIC_KEY": WG_SERVER_PUBLIC_KEY,
-        "CLIENT_PRIVATE_KEY": u.wg_private_key or "<MISSING_PRIV>",
-        "CLIENT_ADDRESS": u.wg_address or "<MISSING_ADDR>",
-    }
-
-    text = TEMPLATE_WG.read_text(encoding="utf-8")
-    for k, v in placeholders.items():
-        text = text.replace(f"{{{{{k}}}}}", v)
-
-    dst.write_text(text, encoding="utf-8")
-    if need_save:
-        save_users(USERS)
-    return dst
+    if u is None or u.wg_public_key is None:
+        return
+    sync = PEERS.get(NODES.resolve(u.node).name)
+    if sync is None:
+        return
+    if u.subscribed and u.wg_address is not None:
+        sync.add(u.wg_public_key, u.wg_address)
+    else:
+        sync.remove(u.wg_public_key)
+
+async def activate_paid_invoice(invoice_id: int, user_id: int, job_queue) -> bool:
+    """
+    Идемпотентная активация по оплаченному счёту: повторный webhook или /check
+    с тем же счётом ничего не продлевает. True — если активировали сейчас.
+    """
+    if not INVOICES.claim_paid(invoice_id, user_id):
+        return False
+    await activate_user(user_id, SUB_DAYS, job_queue)
+    return True
+
+async def activate_user(user_id: int, days: int, job_queue) -> None:
+    """Включает подписку на days дней (под локом пользователя) и заранее готовит оба конфига."""
+    async with USER_LOCKS.hold(user_id):
+        activate_subscription(USERS, user_id, days=days)
+    schedule_expiry_check(job_queue)
+    try:
+        await get_user_wg_config(user_id)
+    except Exception:
+        log.exception("WG profile prepare failed on activation")
+    try:
+        await get_user_config(user_id)
+    except Exception:
+        log.exception("Не удалось создать персональный конфиг")
+
+
+async def push_configs(bot, user_id: int) -> None:
+    """Сообщает об активации и сразу присылает конфиги — без /vpn и /vpn_wg."""
+    try:
+        await bot.send_message(chat_id=user_id, text="✅ Оплата получена! Подписка активирована.")
+        send = partial(bot.send_document, chat_id=user_id)
+        for kind, get, filename in (
+            ("wg", get_user_wg_config, f"wg_{user_id}.conf"),
+            ("ovpn", get_user_config, f"vpn_{user_id}.ovpn"),
+        ):
+            await send_config(send, TG_FILES, user_id, kind, await get(user_id), filename)
+    except Exception:
+        log.exception("push configs to %s failed", user_id)
+
 
 async def app_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if await _throttle(update): return
@@ -189,7 +403,12 @@ async def app_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_subscription_active(USERS, user_id):
         await update.message.reply_text("⛔ Нет активной подписки. Сначала /buy и /check (или /dev_paid).")
         return
-    code = create_login_code(user_id)
+    try:
+        code = create_login_code(user_id)
+    except CodeStoreFull:
+        log.warning("login code store is full")
+        await update.message.reply_text("⚠️ Сейчас не получается выдать код. Попробуйте через пару минут.")
+        return
     await update.message.reply_text(
         f"🔑 Код для входа в приложение: {code}\n"
         f"Действует {TOKEN_TTL_SEC // 60} мин.\n\n"
@@ -217,24 +436,28 @@ async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if await _throttle(update): return
     user_id = update.effective_user.id
     description = f"VPN подписка на {SUB_DAYS} дней"
+    expires_in = 15 * 60  # 15 минут
     try:
-        url, invoice_id = create_invoice(
+        url, invoice_id = await CRYPTOPAY.create_invoice(
             amount=PRICE_USDT,
             asset="USDT",
             description=description,
             payload=str(user_id),
-            expires_in=15 * 60,  # 15 минут
+            expires_in=expires_in,
         )
     except Exception as e:
         log.exception("Ошибка create_invoice")
         await update.message.reply_text(f"❌ Не удалось создать счёт: {e}")
         return
+    # счёт попадает в очередь фонового опроса — подписка включится сама после оплаты
+    INVOICES.add_pending(invoice_id, user_id, time.time() + expires_in)
 
     await update.message.reply_text(
         f"💳 Счёт на *{PRICE_USDT} USDT* создан.\n\n"
         f"🔗 Оплатить: {url}\n"
         f"🧾 ID счёта: `{invoice_id}`\n\n"
-        f"После оплаты отправьте:\n"
+        f"Подписка активируется автоматически после оплаты.\n"
+        f"Если этого не произошло, отправьте:\n"
         f"`/check {invoice_id}`",
         parse_mode="Markdown",
         disable_web_page_preview=True,
@@ -259,22 +482,26 @@ async def check(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("✅ Подписка уже активна. Используйте /vpn для получения конфига.")
         return
 
+    invoice_id = int(invoice_id_raw)
+    if INVOICES.is_paid(invoice_id):
+        await update.message.reply_text("ℹ️ Этот счёт уже был зачтён. Для продления создайте новый: /buy")
+        return
+
     try:
-        status = get_invoice_status(int(invoice_id_raw))
+        invoice = await CRYPTOPAY.get_invoice(invoice_id)
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка проверки счёта: {e}")
         return
+    status = invoice.get("status")
+
+    if invoice.get("payload") != str(user_id):
+        await update.message.reply_text("❗ Этот счёт выставлен не вам. Создайте свой командой /buy.")
+        return
 
     if status == "paid":
-        activate_subscription(USERS, user_id, days=SUB_DAYS)
-        try:
-            ensure_user_wg_config(user_id)
-        except Exception:
-            log.exception("WG profile prepare failed on activation")
-        try:
-            ensure_user_config(user_id)
-        except Exception as e:
-            log.exception("Не удалось создать персональный конфиг")
+        if not await activate_paid_invoice(invoice_id, user_id, context.job_queue):
+            await update.message.reply_text("ℹ️ Этот счёт уже был зачтён. Для продления создайте новый: /buy")
+            return
         await update.message.reply_text("✅ Оплата получена! Подписка активирована.")
         await update.message.reply_text("✅ Оплата получена! Подписка активирована.")
     elif status == "active":
@@ -291,7 +518,7 @@ async def vpn(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if is_subscription_active(USERS, user_id):
         try:
-            cfg_path = ensure_user_config(user_id)  # берём персональный
+            cfg = await get_user_config(user_id)  # берём персональный
         except FileNotFoundError:
             await update.message.reply_text("⚠️ Не найден шаблон default.ovpn. Положи файл в vpn_bot/vpn_configs/default.ovpn")
             return
@@ -300,15 +527,11 @@ async def vpn(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("⚠️ Не удалось подготовить конфиг. Попробуйте позже.")
             return
 
-        if cfg_path.exists():
-            with cfg_path.open("rb") as f:
-                await update.message.reply_document(
-                    document=f,
-                    filename=f"vpn_{user_id}.ovpn",
-                    caption="🔐 Ваш персональный VPN-конфиг",
-                )
-        else:
-            await update.message.reply_text("⚠️ Конфиг не найден. Попробуйте снова или напишите в поддержку.")
+        await send_config(
+            update.message.reply_document, TG_FILES, user_id, "ovpn", cfg,
+            filename=f"vpn_{user_id}.ovpn",
+            caption="🔐 Ваш персональный VPN-конфиг",
+        )
     else:
         await update.message.reply_text("⛔ У вас нет активной подписки. Создайте счёт командой /buy.")
 
@@ -319,7 +542,7 @@ async def vpn_wg(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ Нет активной подписки. Сначала /buy и /check (или /dev_paid).")
         return
     try:
-        cfg_path = ensure_user_wg_config(user_id)
+        cfg = await get_user_wg_config(user_id)
     except FileNotFoundError:
         await update.message.reply_text("⚠️ Не найден шаблон default_wg.conf. Положи его в vpn_bot/vpn_configs/")
         return
@@ -328,12 +551,11 @@ async def vpn_wg(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ Не удалось подготовить WG-конфиг. Попробуйте позже.")
         return
 
-    with cfg_path.open("rb") as f:
-        await update.message.reply_document(
-            document=f,
-            filename=f"wg_{user_id}.conf",
-            caption="🔐 Ваш персональный WireGuard-конфиг (шаблон)",
-        )
+    await send_config(
+        update.message.reply_document, TG_FILES, user_id, "wg", cfg,
+        filename=f"wg_{user_id}.conf",
+        caption="🔐 Ваш персональный WireGuard-конфиг (шаблон)",
+    )
 
 
 
@@ -354,14 +576,8 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    try:
-        end = datetime.fromisoformat(u.subscription_end)
-    except Exception:
-        await update.message.reply_text("Не удалось прочитать дату подписки. Попробуйте /buy заново.")
-        return
-
-    now = datetime.utcnow().replace(tzinfo=end.tzinfo)
-    if now < end:
+    if time.time() < u.subscription_end:
+        end = datetime.fromtimestamp(u.subscription_end, timezone.utc)
         until = end.strftime("%Y-%m-%d %H:%M UTC")
         await update.message.reply_text(
             "✅ Подписка активна.\n"
@@ -404,15 +620,7 @@ async def dev_paid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(args) != 1:
         await update.message.reply_text("Использование (dev): /dev_paid <invoice_id>")
         return
-    activate_subscription(USERS, user_id, days=SUB_DAYS)
-    try:
-        ensure_user_wg_config(user_id)
-    except Exception:
-        log.exception("WG profile prepare failed on activation")
-    try:
-        ensure_user_config(user_id)
-    except Exception as e:
-        log.exception("Не удалось создать персональный конфиг (dev_paid)")
+    await activate_user(user_id, SUB_DAYS, context.job_queue)
     await update.message.reply_text("✅ (DEV) Оплата имитирована. Подписка активирована.")
     await update.message.reply_text("✅ (DEV) Оплата имитирована. Подписка активирована.")
 
@@ -423,18 +631,153 @@ async def grant(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args or []
     days = int(args[0]) if args else SUB_DAYS
     user_id = update.effective_user.id
-    activate_subscription(USERS, user_id, days=days)
-    try:
-        ensure_user_wg_config(user_id)
-    except Exception:
-        log.exception("WG profile prepare failed on activation")
-    try:
-        ensure_user_config(user_id)
-    except Exception as e:
-        log.exception("Не удалось создать персональный конфиг (grant)")
+    await activate_user(user_id, days, context.job_queue)
     await update.message.reply_text(f"🎁 (DEV) Подписка выдана на {days} дн.")
     await update.message.reply_text(f"🎁 (DEV) Подписка выдана на {days} дн.")
 
+# --- Команды владельца (OWNER_ID), без DEV_MODE ---
+async def wg_sync(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/wg_sync — состояние синхронизации пиров; /wg_sync full — полная сверка с WG-серверами."""
+    if await _throttle(update): return
+    if OWNER_ID is None or update.effective_user.id != OWNER_ID:
+        return
+    if not PEERS:
+        await update.message.reply_text("Синхронизация пиров выключена (WG_SYNC=off).")
+        return
+    lines = []
+    if context.args and context.args[0] == "full":
+        for name, sync in PEERS.items():
+            try:
+                added, removed = await sync.resync(WORKERS)
+            except Exception as e:
+                log.exception(f"WG full resync failed on {name}")
+                lines.append(f"⚠️ {name}: сверка не удалась: {e}")
+                continue
+            lines.append(f"🔄 {name}: добавлено/исправлено {added}, удалено {removed}.")
+        await update.message.reply_text("\n".join(lines))
+        return
+    for name, sync in PEERS.items():
+        last = (
+            datetime.fromtimestamp(sync.last_full, timezone.utc).isoformat(timespec="seconds")
+            if sync.last_full else "не было"
+        )
+        lines.append(
+            f"{name}: пиров {len(sync)}, ждут применения {sync.pending}, применено {sync.applied}, "
+            f"ошибок {sync.failures}, полная сверка: {last}"
+        )
+    await update.message.reply_text("\n".join(lines))
+
+async def nodes_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/nodes — узлы, их загрузка и состояние."""
+    if await _throttle(update): return
+    if OWNER_ID is None or update.effective_user.id != OWNER_ID:
+        return
+    lines = [
+        f"{'⛔' if n.drained else '✅'} {n.name} {n.endpoint_host}:{n.endpoint_port} — "
+        f"{n.used}/{n.capacity} ({n.score:.0%})"
+        + (" · переносится" if n.name in _DRAINING else "")
+        for n in NODES
+    ]
+    lines.append(f"Всего: {NODES.used}/{NODES.capacity}")
+    await update.message.reply_text("\n".join(lines))
+
+# Перенос пользователей с выводимого узла: пачками, с паузой между ними
+DRAIN_BATCH = 200
+DRAIN_PAUSE_SEC = 1.0
+_DRAINING: set[str] = set()  # узлы, с которых сейчас идёт перенос
+
+def _move_user(user_id: int, src: Node) -> Node | None:
+    """
+    Переносит WG-профиль пользователя с узла src на наименее загруженный другой (ключи
+    те же, адрес — из пула нового узла). Только из event loop'а, под локом пользователя.
+    Возвращает новый узел или None, если пользователь уже не на src.
+    """
+    u = USERS.get(user_id)
+    if u is None or u.wg_address is None or NODES.resolve(u.node) is not src:
+        return None
+    old_addr, pub = u.wg_address, u.wg_public_key
+    node, addr = NODES.allocate(exclude=src)  # RuntimeError — места больше нигде нет
+    set_wg_profile(USERS, user_id, u.wg_private_key, pub, addr, node=node.name)
+    NODES.release(src.name, old_addr)
+    if (old := PEERS.get(src.name)) is not None and pub is not None:
+        old.remove(pub)
+    _sync_peer(user_id)
+    CONFIGS.invalidate_user(user_id)
+    return node
+
+async def _drain_node(src: Node, batch: int) -> None:
+    """Фоновый перенос всех пользователей с src; останавливается по /undrain."""
+    _DRAINING.add(src.name)
+    moved = 0
+    error = ""
+    try:
+        user_ids = await run_blocking(USERS.on_node, src.name)
+        if src is NODES.default:
+            # записи без узла (выданные до реестра) тоже на нём
+            user_ids += await run_blocking(USERS.on_node, None)
+        for i in range(0, len(user_ids), batch):
+            if not src.drained:
+                error = "остановлен"
+                break
+            for uid in user_ids[i:i + batch]:
+                async with USER_LOCKS.hold(uid):
+                    node = _move_user(uid, src)
+                if node is None:
+                    continue
+                moved += 1
+                if USERS.is_active(uid, time.time()):
+                    NOTIFIER.submit(uid, "🔁 Ваш VPN-сервер сменился. Получите новый конфиг: /vpn_wg")
+            await asyncio.sleep(DRAIN_PAUSE_SEC)
+    except RuntimeError as e:  # свободных адресов на других узлах не осталось
+        error = str(e)
+    except Exception as e:
+        log.exception(f"drain of node {src.name} failed")
+        error = repr(e)
+    finally:
+        _DRAINING.discard(src.name)
+    log.info(f"node {src.name} drain: {moved} users moved{', ' + error if error else ''}")
+    if OWNER_ID is not None:
+        NOTIFIER.submit(
+            OWNER_ID,
+            f"Узел {src.name}: перенесено {moved}, осталось {src.used}" + (f" ({error})" if error else ""),
+        )
+
+async def drain(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/drain <узел> [пачка] — вывести узел из выдачи и перенести его пользователей на другие."""
+    if await _throttle(update): return
+    if OWNER_ID is None or update.effective_user.id != OWNER_ID:
+        return
+    if not context.args:
+        await update.message.reply_text("Использование: /drain <узел> [размер пачки]")
+        return
+    name = context.args[0]
+    batch = int(context.args[1]) if len(context.args) > 1 and context.args[1].isdigit() else DRAIN_BATCH
+    if NODES.get(name) is None:
+        await update.message.reply_text(f"Нет узла {name}. Узлы: /nodes")
+        return
+    if len(NODES) < 2:
+        await update.message.reply_text("Узел единственный — переносить некуда.")
+        return
+    if name in _DRAINING:
+        await update.message.reply_text(f"Перенос с {name} уже идёт.")
+        return
+    src = NODES.set_drained(name)
+    context.application.create_task(_drain_node(src, max(1, batch)))
+    await update.message.reply_text(
+        f"⛔ {name} выведен из выдачи; переносим {src.used} пользователей пачками по {max(1, batch)}."
+    )
+
+async def undrain(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/undrain <узел> — вернуть узел в выдачу (идущий перенос остановится после текущей пачки)."""
+    if await _throttle(update): return
+    if OWNER_ID is None or update.effective_user.id != OWNER_ID:
+        return
+    if not context.args or NODES.get(context.args[0]) is None:
+        await update.message.reply_text("Использование: /undrain <узел>. Узлы: /nodes")
+        return
+    node = NODES.set_drained(context.args[0], False)
+    await update.message.reply_text(f"✅ {node.name} снова принимает новых пользователей.")
+
 from telegram.error import TelegramError
 
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
@@ -446,60 +789,203 @@ async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
     except TelegramError:
         pass
 
-async def check_subscriptions(context: ContextTypes.DEFAULT_TYPE):
+# Проверка подписок будится к ближайшему истечению; интервал ниже — страховочный максимум
+EXPIRY_MAX_SLEEP_SEC = 3600
+# после сбоя обработки пользователи возвращаются в индекс, повтор — не раньше чем через столько
+EXPIRY_RETRY_SEC = 60
+_expiry_check_at: float | None = None  # когда запланирована следующая проверка (epoch)
+
+
+def schedule_expiry_check(job_queue, not_before: float | None = None) -> None:
     """
-    Периодически проверяет users.json и отключает истёкшие подписки.
-    Отправляет пользователю уведомление об окончании.
+    Ставит check_subscriptions на момент ближайшего истечения подписки (но не раньше not_before).
+    Если уже запланирована более ранняя проверка — ничего не делает.
     """
-    now = datetime.now(timezone.utc)
-    changed = False
-    expired_count = 0
+    global _expiry_check_at
+    if job_queue is None:
+        return
+    now = time.time()
+    nxt = USERS.next_expiry()
+    when = now + EXPIRY_MAX_SLEEP_SEC
+    if nxt is not None:
+        when = min(when, max(float(nxt), now))
+    if not_before is not None:
+        when = max(when, not_before)
+    if _expiry_check_at is not None and _expiry_check_at <= when:
+        return
+    for job in job_queue.get_jobs_by_name("sub_checker"):
+        job.schedule_removal()
+    _expiry_check_at = when
+    job_queue.run_once(check_subscriptions, when=when - now, name="sub_checker")
 
-    # USERS — глобальный dict[int, User]
-    for uid, u in list(USERS.items()):
-        end_iso = getattr(u, "subscription_end", None)
-        if not end_iso:
-            continue
-        try:
-            end = datetime.fromisoformat(end_iso)
-        except Exception:
-            continue
 
-        # если подписка была активна и срок вышел
-        if getattr(u, "subscribed", False) and now >= end:
-            u.subscribed = False
-            changed = True
-            expired_count += 1
-            # пробуем уведомить пользователя; игнорируем любые ошибки отправки
+async def check_subscriptions(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Отключает истёкшие подписки: из индекса истечений берутся только те, чей срок вышел.
+    Отправляет пользователю уведомление об окончании и планирует следующую проверку.
+    """
+    global _expiry_check_at
+    started = time.perf_counter()
+    failed: list[int] = []
+    try:
+        # take_* уже вынули пользователей из индексов: при сбое они возвращаются туда в finally
+        expired = USERS.take_expired(time.time())
+        done = 0
+        for uid in expired:
+            try:
+                async with USER_LOCKS.hold(uid):
+                    # пока ждали лок, подписку могли продлить — она уже снова в индексе
+                    if USERS.is_active(uid, time.time()):
+                        continue
+                    expire_subscription(USERS, uid)
+                    _sync_peer(uid)  # доступ закрывается сразу, а не когда адрес вернётся в пул
+                # уведомление уходит через очередь рассылки, задача не ждёт отправки
+                NOTIFIER.submit(uid, "⛔ Ваша подписка истекла. Чтобы продлить, используйте /buy.")
+            except Exception:
+                log.exception(f"[job] failed to expire subscription of {uid}")
+                failed.append(uid)
+                continue
+            done += 1
+
+        if done:
+            EXPIRED_TOTAL.inc(done)
+            log.info(f"[job] auto-expired {done} subscriptions")
+
+        # давно истёкшие подписки: адрес возвращается в пул, старый WG-конфиг удаляется
+        reclaimed = []
+        for uid in USERS.take_reclaimable(time.time() - WG_RECLAIM_DAYS * 86400):
             try:
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text="⛔ Ваша подписка истекла. Чтобы продлить, используйте /buy."
-                )
+                # под локом: отрендеренный в это время конфиг не переживёт удаление профиля
+                async with USER_LOCKS.hold(uid):
+                    u = USERS.get(uid)
+                    if u is None or u.subscribed:  # продлили, пока ждали лок
+                        continue
+                    node = u.node
+                    addr = release_wg_profile(USERS, uid)
+                    if addr is not None:
+                        NODES.release(node, addr)
+                        CONFIGS.invalidate_user(uid)
+                        reclaimed.append(uid)
             except Exception:
-                pass
+                log.exception(f"[job] failed to reclaim WG address of {uid}")
+                failed.append(uid)
+        if reclaimed:
+            RECLAIMED_TOTAL.inc(len(reclaimed))
+            log.info(f"[job] reclaimed {len(reclaimed)} WG addresses")
+            # адреса уже в пуле; несостоявшееся удаление конфига только оставит файл в паке
+            await run_blocking(_delete_wg_configs, reclaimed)
+    finally:
+        for uid in failed:
+            u = USERS.get(uid)
+            if u is not None:
+                USERS.put(uid, u)  # запись заново попадает в индексы истечения и возврата адресов
+        CHECK_SUBS_SECONDS.observe(time.perf_counter() - started)
+        _expiry_check_at = None
+        schedule_expiry_check(context.job_queue, time.time() + EXPIRY_RETRY_SEC if failed else None)
+
+def _delete_wg_configs(user_ids: list[int]) -> None:
+    for uid in user_ids:
+        PACK.delete(uid, "wg")
+
+# Напоминание о скором окончании подписки
+REMIND_BEFORE_SEC = 24 * 3600
+REMIND_CHECK_SEC = 600
+# Подписки, кончающиеся до этого момента, уже получили напоминание (epoch)
+_reminded_until: float | None = None
+
+
+async def send_expiry_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Раз в REMIND_CHECK_SEC: напоминание тем, чья подписка кончится в ближайшие 24 часа."""
+    global _reminded_until
+    until = time.time() + REMIND_BEFORE_SEC
+    # при старте не шлём повторно тем, кому могли напомнить до перезапуска
+    after = _reminded_until if _reminded_until is not None else until - REMIND_CHECK_SEC
+    _reminded_until = until
+    queued = 0
+    for uid in USERS.expiring_between(after, until):
+        u = USERS.get(uid)
+        if not u or not u.subscription_end:
+            continue
+        end = datetime.fromtimestamp(u.subscription_end, timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+        queued += NOTIFIER.submit(uid, f"⏰ Подписка закончится {end}. Продлить заранее: /buy")
+    if queued:
+        log.info(f"[job] queued {queued} expiry reminders")
+
+async def sweep_login_codes(context: ContextTypes.DEFAULT_TYPE):
+    """Вычищает истёкшие коды входа (иначе неиспользованные копились бы в памяти)."""
+    if n := TOKENS.sweep():
+        log.info(f"[job] login codes: {n} expired, {len(TOKENS)} active")
+
+async def compact_config_pack(context: ContextTypes.DEFAULT_TYPE):
+    """Переписывает пак конфигов, когда устаревших версий в нём больше, чем живых."""
+    if await run_blocking(PACK.maybe_compact):
+        # кэш держит срезы старого mmap — отпускаем их
+        CONFIGS.clear()
+        log.info(f"[job] config pack compacted: {len(PACK)} configs")
+    else:
+        await run_blocking(PACK.flush)
+
+# Счёт, не найденный в API, держим в очереди ещё столько после его истечения
+INVOICE_GRACE_SEC = 10 * 60
 
-    if changed:
-        save_users(USERS)
-        log.info(f"[job] auto-expired {expired_count} subscriptions")
+
+async def poll_pending_invoices(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Опрашивает все ожидающие счета пачками по INVOICES_PAGE_SIZE (один getInvoices на пачку):
+    оплаченные активирует, истёкшие убирает из очереди.
+    """
+    pending = INVOICES.pending()
+    if not pending:
+        return
+    owners = {inv: uid for inv, uid, _ in pending}
+    expires = {inv: exp for inv, _, exp in pending}
+    ids = list(owners)
+    now = time.time()
+    activated = dropped = 0
+    for i in range(0, len(ids), INVOICES_PAGE_SIZE):
+        batch = ids[i:i + INVOICES_PAGE_SIZE]
+        try:
+            items = await CRYPTOPAY.get_invoices(batch)
+        except Exception:
+            log.exception("[job] invoice poll failed")
+            return
+        seen = set()
+        for item in items:
+            inv = int(item["invoice_id"])
+            seen.add(inv)
+            status = item.get("status")
+            if status == "paid":
+                if await activate_paid_invoice(inv, owners[inv], context.job_queue):
+                    activated += 1
+                    context.application.create_task(push_configs(context.bot, owners[inv]))
+            elif status == "expired":
+                INVOICES.drop_pending(inv)
+                dropped += 1
+        for inv in batch:
+            if inv not in seen and expires[inv] + INVOICE_GRACE_SEC < now:
+                INVOICES.drop_pending(inv)
+                dropped += 1
+    if activated or dropped:
+        log.info(f"[job] invoices: {activated} activated, {dropped} dropped, {len(ids)} polled")
 
 # --- HTTP API для приложения ---
 async def http_get_wg_config(request: web.Request) -> web.Response:
     code = request.query.get("code", "").strip()
     if not code:
         return web.Response(status=400, text="missing code")
-    data = take_token(code)
-    if not data:
+    if wait := _too_many_attempts(request):
+        return web.Response(status=429, text="too many attempts", headers={"Retry-After": str(int(wait) + 1)})
+    user_id = take_token(code)
+    if user_id is None:
+        LOGIN_ATTEMPTS.fail(_client_ip(request))
         return web.Response(status=401, text="invalid or expired code")
 
-    user_id = int(data["user_id"])
     if not is_subscription_active(USERS, user_id):
         return web.Response(status=403, text="subscription inactive")
 
     try:
-        cfg_path = ensure_user_wg_config(user_id)
-        txt = cfg_path.read_text(encoding="utf-8")
-        return web.Response(status=200, text=txt, content_type="text/plain")
+        cfg = await get_user_wg_config(user_id)
+        return web.Response(status=200, body=cfg, content_type="text/plain", charset="utf-8")
     except Exception as e:
         log.exception("HTTP config error")
         return web.Response(status=500, text=f"server error: {e}")
@@ -526,14 +1012,19 @@ async def http_validate(request: web.Request) -> web.Response:
             status=400,
         )
 
-    peek = peek_token(code)
-    if not peek:
+    if wait := _too_many_attempts(request):
+        return web.json_response(
+            {"ok": False, "subscriptionActive": False, "message": "too many attempts"},
+            status=429, headers={"Retry-After": str(int(wait) + 1)},
+        )
+    user_id = peek_token(code)
+    if user_id is None:
+        LOGIN_ATTEMPTS.fail(_client_ip(request))
         return web.json_response(
             {"ok": False, "subscriptionActive": False, "message": "invalid or expired code"},
             status=200,
         )
 
-    user_id = int(peek["user_id"])
     active = is_subscription_active(USERS, user_id)
     if not active:
         return web.json_response(
@@ -556,23 +1047,89 @@ async def http_get_config_plain(request: web.Request) -> web.Response:
     if not code:
         return web.Response(status=400, text="missing code")
 
-    data = take_token(code)  # <-- именно расходуем
-    if not data:
+    if wait := _too_many_attempts(request):
+        return web.Response(status=429, text="too many attempts", headers={"Retry-After": str(int(wait) + 1)})
+    user_id = take_token(code)  # <-- именно расходуем
+    if user_id is None:
+        LOGIN_ATTEMPTS.fail(_client_ip(request))
         return web.Response(status=401, text="invalid or expired code")
 
-    user_id = int(data["user_id"])
     if not is_subscription_active(USERS, user_id):
         return web.Response(status=403, text="subscription inactive")
 
     try:
-        cfg_path = ensure_user_wg_config(user_id)
-        txt = cfg_path.read_text(encoding="utf-8")
-        return web.Response(status=200, text=txt, content_type="text/plain")
+        cfg = await get_user_wg_config(user_id)
+        return web.Response(status=200, body=cfg, content_type="text/plain", charset="utf-8")
     except Exception as e:
         log.exception("HTTP config error")
         return web.Response(status=500, text=f"server error: {e}")
 
 
+async def http_cryptopay_webhook(request: web.Request) -> web.Response:
+    """
+    POST /api/cryptopay/webhook
+    Обновления Crypto Pay (invoice_paid). Подпись — заголовок crypto-pay-api-signature.
+    user_id берём из payload счёта (его выставляет /buy). Отвечаем 200 сразу,
+    конфиги отправляем фоном.
+    """
+    body = await request.read()
+    if not verify_webhook_signature(body, request.headers.get("crypto-pay-api-signature", ""), CRYPTOBOT_TOKEN):
+        return web.Response(status=401, text="bad signature")
+    try:
+        update = json.loads(body)
+    except ValueError:
+        return web.Response(status=400, text="invalid json")
+
+    if update.get("update_type") != "invoice_paid":
+        return web.Response(text="ok")
+    invoice = update.get("payload") or {}
+    try:
+        invoice_id = int(invoice["invoice_id"])
+        user_id = int(invoice.get("payload") or "")
+    except (KeyError, TypeError, ValueError):
+        # не наш счёт — подтверждаем, чтобы Crypto Pay не слал его повторно
+        log.warning("cryptopay webhook without user payload: %s", invoice.get("invoice_id"))
+        return web.Response(text="ok")
+    if invoice.get("status", "paid") != "paid":
+        return web.Response(text="ok")
+
+    tg_app = request.app[TG_APP_KEY]
+    if await activate_paid_invoice(invoice_id, user_id, tg_app.job_queue):
+        log.info("invoice %s paid, user %s activated via webhook", invoice_id, user_id)
+        tg_app.create_task(push_configs(tg_app.bot, user_id))
+    return web.Response(text="ok")
+
+
+# Секрет вебхука Telegram: общий для всех экземпляров (config требует его вместе с TG_WEBHOOK_URL)
+WEBHOOK_SECRET = TG_WEBHOOK_SECRET
+
+
+async def http_telegram_webhook(request: web.Request) -> web.Response:
+    """
+    POST TG_WEBHOOK_PATH
+    Обновления Telegram в режиме вебхука. Проверяем X-Telegram-Bot-Api-Secret-Token
+    и кладём Update в очередь PTB — обработка идёт параллельно (concurrent_updates).
+    """
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not WEBHOOK_SECRET or not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return web.Response(status=403, text="bad secret token")
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400, text="invalid json")
+    if not isinstance(data, dict):
+        return web.Response(status=400, text="invalid update")
+    tg_app = request.app[TG_APP_KEY]
+    try:
+        update = Update.de_json(data, tg_app.bot)
+    except (TypeError, ValueError, KeyError, AttributeError):
+        return web.Response(status=400, text="invalid update")
+    if update is None:
+        return web.Response(status=400, text="invalid update")
+    await tg_app.update_queue.put(update)
+    return web.Response(text="ok")
+
+
 async def http_telegram_link(request: web.Request) -> web.Response:
     """
     GET /api/telegram-link
@@ -581,8 +1138,82 @@ async def http_telegram_link(request: web.Request) -> web.Response:
     return web.json_response({"url": get_telegram_link_url()}, status=200)
 
 
-async def start_http_api():
-    app_http = web.Application()
+TG_APP_KEY = web.AppKey("tg_app", Application)
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler):
+    """Время обработки по маршруту (шаблону пути, не самому пути) и статусу."""
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else "*"
+    status = 500
+    start = time.perf_counter()
+    try:
+        resp = await handler(request)
+        status = resp.status
+        return resp
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_SECONDS.observe(time.perf_counter() - start, route=route, status=status)
+
+
+async def http_metrics(request: web.Request) -> web.Response:
+    """GET /metrics — текстовый формат Prometheus. С METRICS_TOKEN нужен заголовок Authorization: Bearer."""
+    if METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}",
+    ):
+        return web.Response(status=401, text="unauthorized")
+    return web.Response(
+        body=REGISTRY.render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def http_healthz(request: web.Request) -> web.Response:
+    """GET /healthz — процесс жив и event loop отвечает (для перезапуска супервизором)."""
+    return web.json_response({"status": "ok"})
+
+
+async def http_readyz(request: web.Request) -> web.Response:
+    """
+    GET /readyz — 200, когда состояние загружено и бот принимает обновления; до этого 503
+    (балансировщику и супервизору — ждать, а не перезапускать).
+    """
+    tg_app = request.app[TG_APP_KEY]
+    if USERS is None:
+        return web.json_response({"ready": False, "stage": "loading"}, status=503)
+    if tg_app is not None and not tg_app.running:
+        return web.json_response({"ready": False, "stage": "starting"}, status=503)
+    return web.json_response({"ready": True, "state_load_sec": STATE_LOAD_SECONDS})
+
+
+@web.middleware
+async def readiness_middleware(request: web.Request, handler):
+    """Пока грузится состояние, отвечают только пробы и метрики; остальным — 503 с Retry-After."""
+    if USERS is None:
+        resource = request.match_info.route.resource
+        if resource is None or resource.canonical not in NOT_READY_ROUTES:
+            return web.Response(status=503, text="starting", headers={"Retry-After": "5"})
+    return await handler(request)
+
+
+@web.middleware
+async def rate_limit_middleware(request: web.Request, handler):
+    """Тот же token bucket, что и у команд бота: бюджет на маршрут и IP клиента (за прокси — см. _client_ip)."""
+    resource = request.match_info.route.resource
+    path = resource.canonical if resource is not None else None
+    if path not in RATE_LIMIT_EXEMPT:
+        scope = f"http:{path}" if path is not None else "http:*"
+        if wait := RATE_LIMITS.check(scope, _client_ip(request)):
+            return web.Response(status=429, text="too many requests", headers={"Retry-After": str(int(wait) + 1)})
+    return await handler(request)
+
+
+def make_http_app(tg_app: Application, webhook: bool = False) -> web.Application:
+    app_http = web.Application(middlewares=[metrics_middleware, readiness_middleware, rate_limit_middleware])
+    app_http[TG_APP_KEY] = tg_app
     # Старый маршрут, который уже был:
     app_http.router.add_get("/api/v1/config/wg", http_get_wg_config)
 
@@ -590,41 +1221,139 @@ async def start_http_api():
     app_http.router.add_post("/api/validate", http_validate)
     app_http.router.add_get("/api/config", http_get_config_plain)
     app_http.router.add_get("/api/telegram-link", http_telegram_link)
+    app_http.router.add_post("/api/cryptopay/webhook", http_cryptopay_webhook)
+    app_http.router.add_get("/metrics", http_metrics)
+    app_http.router.add_get("/healthz", http_healthz)
+    app_http.router.add_get("/readyz", http_readyz)
+    if webhook:
+        app_http.router.add_post(TG_WEBHOOK_PATH, http_telegram_webhook)
+    return app_http
+
+
+_http_runner: web.AppRunner | None = None
 
-    runner = web.AppRunner(app_http)
-    await runner.setup()
-    site = web.TCPSite(runner, host="0.0.0.0", port=8080)
-    await site.start()
-    log.info("HTTP API started on http://0.0.0.0:8080")
 
+async def start_http_api(tg_app: Application):
+    global _http_runner
+    _http_runner = web.AppRunner(make_http_app(tg_app, webhook=bool(TG_WEBHOOK_URL)))
+    await _http_runner.setup()
+    site = web.TCPSite(_http_runner, host=HTTP_HOST, port=HTTP_PORT)
+    await site.start()
+    log.info(f"HTTP API started on http://{HTTP_HOST}:{HTTP_PORT}")
 
-from telegram.ext import Application  # добавь к импортам сверху
 
 async def _post_init(app: Application) -> None:
-    # здесь event loop уже запущен и можно стартовать aiohttp
-    app.create_task(start_http_api())
+    # здесь event loop уже запущен: сначала HTTP-сервер (пробы отвечают сразу,
+    # а в режиме вебхука он нужен до set_webhook), потом состояние — в WORKERS, не блокируя loop
+    await start_http_api(app)
+    await run_blocking(load_state)
+    # планировщик: проверка подписок в момент ближайшего истечения
+    schedule_expiry_check(app.job_queue)
+    app.create_task(KEYPAIRS.run(WORKERS))
+    for sync in PEERS.values():
+        app.create_task(sync.run(WORKERS))
+    if PEERS and WG_SYNC_FULL_ON_START:
+        app.create_task(_resync_peers())
+    app.create_task(NOTIFIER.run(app.bot))
+
+
+async def _resync_peers() -> None:
+    for name, sync in PEERS.items():
+        try:
+            added, removed = await sync.resync(WORKERS)
+            log.info(f"WG peers on {name} resynced: {added} added/fixed, {removed} removed")
+        except Exception:
+            log.exception(f"WG full resync failed on {name}")
 
 
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).post_init(_post_init).build()
+async def _post_shutdown(app: Application) -> None:
+    if _http_runner is not None:
+        await _http_runner.cleanup()
+    # последние изменения — на серверы, пока WORKERS ещё работают
+    for name, sync in PEERS.items():
+        try:
+            await sync.flush(WORKERS)
+        except Exception:
+            log.exception(f"WG peer sync failed on shutdown ({name})")
+    await CRYPTOPAY.close()
+    INVOICES.close()
+    if USERS is not None:
+        USERS.close()
+    WORKERS.shutdown(wait=True)
+    if PACK is not None:
+        PACK.close()
+    NOTIFIER.close()
+
+
+async def run_webhook(app: Application) -> None:
+    """
+    Режим вебхука: без Updater'а, обновления принимает http_telegram_webhook
+    на общем aiohttp-сервере. Работает до SIGINT/SIGTERM.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: остаётся KeyboardInterrupt
+    await app.initialize()
+    try:
+        await _post_init(app)
+        await app.bot.set_webhook(
+            url=TG_WEBHOOK_URL + TG_WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        await app.start()
+        log.info(f"Бот запущен (webhook {TG_WEBHOOK_URL + TG_WEBHOOK_PATH})")
+        await stop.wait()
+    finally:
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        await _post_shutdown(app)
+
+
+def build_app(request: BaseRequest | None = None) -> Application:
+    """
+    Application со всеми обработчиками и фоновыми задачами.
+    request — свой транспорт Bot API (нагрузочный стенд benchmarks/loadtest.py); тогда без Updater'а.
+    """
+    builder = (
+        ApplicationBuilder().token(BOT_TOKEN)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        # независимые пользователи обрабатываются параллельно, один и тот же — по очереди (USER_LOCKS)
+        .concurrent_updates(TG_CONCURRENT_UPDATES)
+    )
+    if TG_WEBHOOK_URL or request is not None:
+        builder = builder.updater(None)  # свой Updater не нужен
+    if request is not None:
+        builder = builder.request(request)
+    app = builder.build()
 
 
     app.add_error_handler(on_error)
 
     # основные команды
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("buy", buy))
-    app.add_handler(CommandHandler("check", check))
-    app.add_handler(CommandHandler("status", status))
-    app.add_handler(CommandHandler("app_code", app_code))
-    app.add_handler(CommandHandler("vpn_wg", vpn_wg))
-    app.add_handler(CommandHandler("vpn", vpn))
-    app.add_handler(CommandHandler("help", help_cmd))
+    app.add_handler(CommandHandler("start", _timed("start", start)))
+    app.add_handler(CommandHandler("buy", _timed("buy", buy)))
+    app.add_handler(CommandHandler("check", _timed("check", check)))
+    app.add_handler(CommandHandler("status", _timed("status", status)))
+    app.add_handler(CommandHandler("app_code", _timed("app_code", app_code)))
+    app.add_handler(CommandHandler("vpn_wg", _timed("vpn_wg", vpn_wg)))
+    app.add_handler(CommandHandler("vpn", _timed("vpn", vpn)))
+    app.add_handler(CommandHandler("help", _timed("help", help_cmd)))
+    app.add_handler(CommandHandler("wg_sync", _timed("wg_sync", wg_sync)))
+    app.add_handler(CommandHandler("nodes", _timed("nodes", nodes_cmd)))
+    app.add_handler(CommandHandler("drain", _timed("drain", drain)))
+    app.add_handler(CommandHandler("undrain", _timed("undrain", undrain)))
 
     # DEV команды
     if DEV_MODE:
-        app.add_handler(CommandHandler("dev_paid", dev_paid))
-        app.add_handler(CommandHandler("grant", grant))
+        app.add_handler(CommandHandler("dev_paid", _timed("dev_paid", dev_paid)))
+        app.add_handler(CommandHandler("grant", _timed("grant", grant)))
 
         # быстрая проверка подписок в DEV-режиме
         async def dev_checksubs(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -638,14 +1367,29 @@ def main():
     # unknown — СТРОГО ПОСЛЕДНИМ!
     app.add_handler(MessageHandler(filters.COMMAND, unknown))
 
-    # планировщик: проверка подписок раз в час, первая через 60 секунд
+    # проверку подписок ставит post_init — после загрузки пользователей
+    # фоновый опрос неоплаченных счетов (без вебхука подписка включится сама)
+    if INVOICE_POLL_SEC > 0:
+        app.job_queue.run_repeating(
+            poll_pending_invoices,
+            interval=INVOICE_POLL_SEC,
+            first=INVOICE_POLL_SEC,
+            name="invoice_poller",
+        )
     app.job_queue.run_repeating(
-        check_subscriptions,
-        interval=3600,
-        first=60,
-        name="sub_checker",
+        send_expiry_reminders, interval=REMIND_CHECK_SEC, first=REMIND_CHECK_SEC, name="expiry_reminders",
     )
+    app.job_queue.run_repeating(sweep_login_codes, interval=60, first=60, name="login_codes")
+    # раз в час: снимок индекса пака, при необходимости — компакция
+    app.job_queue.run_repeating(compact_config_pack, interval=3600, first=3600, name="config_pack")
+    return app
+
 
+def main():
+    app = build_app()
+    if TG_WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+        return
     log.info("Бот запущен")
     app.run_polling()
 
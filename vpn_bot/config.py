@@ -28,23 +28,10 @@ if missing:
         ". Создай/проверь файл .env на основе .env.example"
     )
 
-# ... существующие импорты и load_dotenv()
-
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-CRYPTOBOT_TOKEN = os.getenv("CRYPTOBOT_TOKEN")
-
-PRICE_USDT = float(os.getenv("PRICE_USDT", "5"))
-SUB_DAYS = int(os.getenv("SUB_DAYS", "7"))
-
-DEV_MODE = os.getenv("DEV_MODE", "false").lower() in ("1", "true", "yes", "on")
-OWNER_ID = int(os.getenv("OWNER_ID", "0")) if os.getenv("OWNER_ID") else None
-
-# ↓↓↓ новое
+# OpenVPN-сервер для клиентских конфигов
 SERVER_HOST = os.getenv("SERVER_HOST", "127.0.0.1")
 SERVER_PORT = int(os.getenv("SERVER_PORT", "1194"))
 
-# ... проверки missing как были
-
 WG_ENDPOINT_HOST = os.getenv("WG_ENDPOINT_HOST", "127.0.0.1")
 WG_ENDPOINT_PORT = int(os.getenv("WG_ENDPOINT_PORT", "51820"))
 WG_ALLOWED_IPS = os.getenv("WG_ALLOWED_IPS", "0.0.0.0/0, ::/0")
@@ -56,3 +43,68 @@ WG_SERVER_PUBLIC_KEY = os.getenv("WG_SERVER_PUBLIC_KEY", "")
 WG_ADDRESS_PREFIX = os.getenv("WG_ADDRESS_PREFIX", "10.66.0")
 WG_ADDRESS_CIDR = int(os.getenv("WG_ADDRESS_CIDR", "32"))
 WG_START_HOST = int(os.getenv("WG_START_HOST", "2"))  # с какого host-октета начинать
+# Пул клиентских адресов; по умолчанию — /24 из WG_ADDRESS_PREFIX, можно задать шире: 10.66.0.0/16
+WG_POOL = os.getenv("WG_POOL") or f"{WG_ADDRESS_PREFIX}.0/24"
+# Через сколько дней после окончания подписки адрес и ключи пользователя возвращаются в пул
+WG_RECLAIM_DAYS = int(os.getenv("WG_RECLAIM_DAYS", "30"))
+# Запас заранее сгенерированных ключей: доливается в фоне, когда опускается ниже LOW, до HIGH
+WG_KEYPOOL_LOW = int(os.getenv("WG_KEYPOOL_LOW", "64"))
+WG_KEYPOOL_HIGH = int(os.getenv("WG_KEYPOOL_HIGH", "256"))
+
+# --- Пиры WireGuard-сервера ---
+# off — бот сервер не трогает; wg — изменения через `wg set`; syncconf — файл пиров + `wg syncconf`;
+# record — без wg, команды только записываются (стенд)
+WG_SYNC = os.getenv("WG_SYNC", "off").lower()
+WG_INTERFACE = os.getenv("WG_INTERFACE", "wg0")
+# Пиров на один вызов `wg set`
+WG_SYNC_BATCH = int(os.getenv("WG_SYNC_BATCH", "256"))
+# syncconf: куда писать пиров и откуда брать секцию [Interface] сервера (формат wg, не wg-quick)
+WG_SYNC_CONF = os.getenv("WG_SYNC_CONF", f"/etc/wireguard/{WG_INTERFACE}.peers.conf")
+WG_SYNC_HEADER = os.getenv("WG_SYNC_HEADER", "")
+# Полная сверка с сервером при старте (иначе — только по /wg_sync full)
+WG_SYNC_FULL_ON_START = os.getenv("WG_SYNC_FULL_ON_START", "false").lower() in ("1", "true", "yes", "on")
+# JSON-список VPN-узлов (см. vpn_bot/nodes.py); пусто — один узел из настроек выше
+WG_NODES_FILE = os.getenv("WG_NODES_FILE", "")
+
+# Как часто фоновая задача опрашивает неоплаченные счета (сек); 0 — выключено (только webhook и /check)
+INVOICE_POLL_SEC = int(os.getenv("INVOICE_POLL_SEC", "20"))
+
+# --- Хранилище пользователей ---
+# json — бинарный снапшот users.snap + журнал изменений (всё в памяти), sqlite — users.db в режиме WAL
+USER_STORE = os.getenv("USER_STORE", "json").lower()
+USERS_DB = os.getenv("USERS_DB", os.path.join(os.path.dirname(__file__), "users.db"))
+
+# Сколько байт отрендеренных конфигов держать в памяти (LRU)
+CONFIG_CACHE_MAX_BYTES = int(os.getenv("CONFIG_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# HTTP API (/api/*, вебхуки Crypto Pay и Telegram)
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("HTTP_PORT", "8080"))
+# Адреса/подсети обратных прокси через запятую (например 127.0.0.1, 10.0.0.0/8): только от них
+# принимается X-Forwarded-For; пусто — клиент определяется по адресу соединения
+HTTP_TRUSTED_PROXIES = os.getenv("HTTP_TRUSTED_PROXIES", "")
+# Если задан — GET /metrics требует Authorization: Bearer <METRICS_TOKEN>
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# --- Режим вебхука Telegram (по умолчанию — long polling) ---
+# Публичный https-адрес, на который Telegram шлёт обновления, например https://vpn.example.com
+TG_WEBHOOK_URL = os.getenv("TG_WEBHOOK_URL", "").rstrip("/")
+TG_WEBHOOK_PATH = os.getenv("TG_WEBHOOK_PATH", "/telegram/webhook")
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token (1-256 символов A-Z a-z 0-9 _ -);
+# обязателен с TG_WEBHOOK_URL и одинаков на всех экземплярах за балансировщиком
+TG_WEBHOOK_SECRET = os.getenv("TG_WEBHOOK_SECRET", "")
+if TG_WEBHOOK_URL and not TG_WEBHOOK_SECRET:
+    raise RuntimeError(
+        "TG_WEBHOOK_URL задан без TG_WEBHOOK_SECRET: Telegram принимает один секрет на бота, "
+        "и экземпляры со случайными секретами отвечали бы 403. Задай общий TG_WEBHOOK_SECRET в .env"
+    )
+# Сколько обновлений обрабатывать параллельно
+TG_CONCURRENT_UPDATES = int(os.getenv("TG_CONCURRENT_UPDATES", "64"))
+# Потоки для генерации ключей, рендеринга и записи конфигов (event loop их не ждёт)
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", str(min(8, (os.cpu_count() or 1) + 2))))
+
+# Адрес Crypto Pay API: тестовая сеть — https://testnet-pay.crypt.bot/api/,
+# локальный стенд — python -m benchmarks.fake_cryptopay (http://127.0.0.1:8090/api/)
+CRYPTOPAY_API_URL = os.getenv("CRYPTOPAY_API_URL", "https://pay.crypt.bot/api/").rstrip("/") + "/"
+
+# Все персональные конфиги в одном упакованном файле (+ индекс рядом)
+CONFIG_PACK = os.getenv("CONFIG_PACK", os.path.join(os.path.dirname(__file__), "vpn_configs", "users.pack"))
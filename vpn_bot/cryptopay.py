@@ -1,23 +1,193 @@
 # vpn_bot/cryptopay.py
+import asyncio, hashlib, hmac, random
 from typing import Optional, Tuple
-import requests
-from vpn_bot.config import CRYPTOBOT_TOKEN
+import aiohttp
+from vpn_bot.config import CRYPTOBOT_TOKEN, CRYPTOPAY_API_URL
+from vpn_bot.metrics import REGISTRY
 
-API_URL = "https://pay.crypt.bot/api/"
-HEADERS = {"Crypto-Pay-API-Token": CRYPTOBOT_TOKEN}
+API_URL = CRYPTOPAY_API_URL
+# Максимум счетов в одном ответе getInvoices
+INVOICES_PAGE_SIZE = 1000
+
+CALL_SECONDS = REGISTRY.histogram(
+    "vpn_cryptopay_request_seconds", "Длительность вызова Crypto Pay API вместе с повторами", labels=("method",),
+)
+# kind: http — 429/5xx, network — сеть/таймаут, api — ответ ok=false
+CALL_ERRORS = REGISTRY.counter("vpn_cryptopay_errors_total", "Ошибки вызовов Crypto Pay API", labels=("method", "kind"))
 
 
 class CryptoPayError(Exception):
     pass
 
 
+class CryptoPayClient:
+    """
+    Асинхронный клиент Crypto Pay API. Одна долгоживущая aiohttp-сессия
+    (пул соединений + keep-alive), таймаут на каждый вызов, ограничение числа
+    одновременных запросов и повтор с jitter на 429/5xx.
+    """
+
+    def __init__(
+        self,
+        token: str = CRYPTOBOT_TOKEN,
+        api_url: str = API_URL,
+        timeout: float = 15.0,
+        max_concurrency: int = 10,
+        retries: int = 3,
+        backoff: float = 0.5,
+    ):
+        self.api_url = api_url
+        self._headers = {"Crypto-Pay-API-Token": token}
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._max_concurrency = max_concurrency
+        self._retries = retries
+        self._backoff = backoff
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers=self._headers,
+                timeout=self._timeout,
+                connector=aiohttp.TCPConnector(limit=self._max_concurrency, keepalive_timeout=60),
+            )
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def _call(self, http_method: str, api_method: str, **kwargs) -> dict:
+        with CALL_SECONDS.time(method=api_method):
+            return await self._call_with_retries(http_method, api_method, **kwargs)
+
+    async def _call_with_retries(
+        self,
+        http_method: str,
+        api_method: str,
+        *,
+        params: Optional[dict] = None,
+        body: Optional[dict] = None,
+        timeout: Optional[float] = None,
+        idempotent: bool = True,
+    ) -> dict:
+        """
+        Делает запрос и возвращает resp["result"]. Повторяет на 429/5xx;
+        сетевые ошибки и таймауты повторяются только для идемпотентных вызовов,
+        чтобы не создать счёт дважды.
+        """
+        session = self._get_session()
+        url = self.api_url + api_method
+        req_timeout = aiohttp.ClientTimeout(total=timeout) if timeout else None
+        last_error: object = None
+        for attempt in range(self._retries + 1):
+            delay = None
+            async with self._sem:
+                try:
+                    async with session.request(
+                        http_method, url, params=params, json=body, timeout=req_timeout,
+                    ) as resp:
+                        if resp.status == 429 or resp.status >= 500:
+                            CALL_ERRORS.inc(method=api_method, kind="http")
+                            last_error = f"HTTP {resp.status} from {api_method}"
+                            retry_after = resp.headers.get("Retry-After", "")
+                            delay = float(retry_after) if retry_after.isdigit() else None
+                        else:
+                            data = await resp.json(content_type=None)
+                            if not data.get("ok"):
+                                CALL_ERRORS.inc(method=api_method, kind="api")
+                                raise CryptoPayError(data)
+                            return data["result"]
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    CALL_ERRORS.inc(method=api_method, kind="network")
+                    if not idempotent:
+                        raise CryptoPayError(f"{api_method}: {e!r}") from e
+                    last_error = e
+            if attempt < self._retries:
+                # экспоненциальная пауза с полным jitter, чтобы повторы не шли волной
+                await asyncio.sleep(delay if delay is not None else random.uniform(0, self._backoff * 2 ** attempt))
+        raise CryptoPayError(f"{api_method}: {last_error}")
+
+    async def get_me(self) -> dict:
+        """Проверка токена приложения. Возвращает dict с инфой об аппе."""
+        return await self._call("GET", "getMe")
+
+    async def create_invoice(
+        self,
+        amount: float,
+        asset: str = "USDT",
+        description: str = "VPN подписка",
+        payload: Optional[str] = None,
+        expires_in: Optional[int] = 15 * 60,  # 15 минут
+    ) -> Tuple[str, int]:
+        """
+        Создаёт счёт. Возвращает (invoice_url, invoice_id).
+        """
+        body = {
+            "currency_type": "crypto",
+            "asset": asset,
+            "amount": str(amount),  # API требует строку
+            "description": description,
+            "allow_comments": False,
+            "allow_anonymous": True,
+        }
+        if payload:
+            body["payload"] = payload
+        if expires_in:
+            body["expires_in"] = expires_in
+
+        item = await self._call("POST", "createInvoice", body=body, idempotent=False)
+        invoice_url = item.get("bot_invoice_url") or item.get("pay_url")
+        return invoice_url, item["invoice_id"]
+
+    async def get_invoices(self, invoice_ids: list[int]) -> list[dict]:
+        """Счета по списку id — один запрос на пачку (до INVOICES_PAGE_SIZE)."""
+        if len(invoice_ids) > INVOICES_PAGE_SIZE:
+            raise ValueError(f"не больше {INVOICES_PAGE_SIZE} счетов за запрос")
+        params = {"invoice_ids": ",".join(map(str, invoice_ids)), "count": str(len(invoice_ids))}
+        result = await self._call("GET", "getInvoices", params=params)
+        return result["items"]
+
+    async def get_invoice(self, invoice_id: int) -> dict:
+        """Полный объект счёта (status, payload, ...)."""
+        result = await self._call("GET", "getInvoices", params={"invoice_ids": str(invoice_id)})
+        items = result["items"]
+        if not items:
+            raise CryptoPayError(f"Invoice {invoice_id} not found")
+        return items[0]
+
+    async def get_invoice_status(self, invoice_id: int) -> str:
+        """
+        Получает статус счёта: active / paid / expired
+        """
+        return (await self.get_invoice(invoice_id))["status"]
+
+
+def webhook_signature(body: bytes, token: str = CRYPTOBOT_TOKEN) -> str:
+    """Подпись вебхука Crypto Pay: HMAC-SHA256(key=SHA256(token), body) в hex."""
+    secret = hashlib.sha256(token.encode("utf-8")).digest()
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def verify_webhook_signature(body: bytes, signature: str, token: str = CRYPTOBOT_TOKEN) -> bool:
+    return hmac.compare_digest(webhook_signature(body, token), signature or "")
+
+
+# --- синхронные обёртки (для скриптов вроде test_crypto.py) ---
+def _run_once(call):
+    async def run():
+        client = CryptoPayClient()
+        try:
+            return await call(client)
+        finally:
+            await client.close()
+    return asyncio.run(run())
+
+
 def get_me() -> dict:
     """Проверка токена приложения. Возвращает dict с инфой об аппе."""
-    url = API_URL + "getMe"
-    resp = requests.get(url, headers=HEADERS, timeout=15).json()
-    if not resp.get("ok"):
-        raise CryptoPayError(resp)
-    return resp["result"]
+    return _run_once(lambda c: c.get_me())
 
 
 def create_invoice(
@@ -30,38 +200,11 @@ def create_invoice(
     """
     Создаёт счёт. Возвращает (invoice_url, invoice_id).
     """
-    url = API_URL + "createInvoice"
-    body = {
-        "currency_type": "crypto",
-        "asset": asset,
-        "amount": str(amount),  # API требует строку
-        "description": description,
-        "allow_comments": False,
-        "allow_anonymous": True,
-    }
-    if payload:
-        body["payload"] = payload
-    if expires_in:
-        body["expires_in"] = expires_in
-
-    resp = requests.post(url, json=body, headers=HEADERS, timeout=15).json()
-    if not resp.get("ok"):
-        raise CryptoPayError(resp)
-    item = resp["result"]
-    invoice_url = item.get("bot_invoice_url") or item.get("pay_url")
-    return invoice_url, item["invoice_id"]
+    return _run_once(lambda c: c.create_invoice(amount, asset, description, payload, expires_in))
 
 
 def get_invoice_status(invoice_id: int) -> str:
     """
     Получает статус счёта: active / paid / expired
     """
-    url = API_URL + "getInvoices"
-    params = {"invoice_ids": invoice_id}
-    resp = requests.get(url, params=params, headers=HEADERS, timeout=15).json()
-    if not resp.get("ok"):
-        raise CryptoPayError(resp)
-    items = resp["result"]["items"]
-    if not items:
-        raise CryptoPayError(f"Invoice {invoice_id} not found")
-    return items[0]["status"]
+    return _run_once(lambda c: c.get_invoice_status(invoice_id))
@@ -0,0 +1,117 @@
+# vpn_bot/invoices.py
+from __future__ import annotations
+import json, os, tempfile, threading
+
+from vpn_bot.writebehind import WriteBehind
+
+BASE_DIR = os.path.dirname(__file__)
+INVOICES_FILE = os.getenv("INVOICES_FILE") or os.path.join(BASE_DIR, "invoices.journal")
+SAVE_DEBOUNCE_SEC = float(os.getenv("USERS_SAVE_DEBOUNCE_SEC", "0.5"))
+# Сколько закрытых ожидающих счетов копится в журнале до его перезаписи
+COMPACT_AFTER_RESOLVED = 10_000
+
+
+class InvoiceBook:
+    """
+    Учёт счетов Crypto Pay: ожидающие оплаты (их опрашивает фоновая задача)
+    и уже зачтённые. Зачтённые нужны, чтобы активация была идемпотентной —
+    webhook может прийти повторно, а /check можно отправить с тем же счётом ещё раз.
+    Хранится как журнал: по строке на событие, запись — фоновым потоком (как у users).
+    """
+
+    def __init__(self, path: str = INVOICES_FILE):
+        self.path = path
+        self._paid: set[int] = set()
+        self._pending: dict[int, tuple[int, float]] = {}  # invoice_id -> (user_id, expires_at)
+        self._resolved = 0  # закрытых pending-записей в журнале (мусор для компакции)
+        self._lock = threading.Lock()
+        self._buf: list[str] = []
+        self._needs_nl = False
+        self._load()
+        self._writer = WriteBehind(self.flush, SAVE_DEBOUNCE_SEC, "invoices-writer")
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            line = ""
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # оборванная запись
+                op, inv = rec.get("op"), int(rec.get("id", 0))
+                if op == "pending":
+                    self._pending[inv] = (int(rec["user_id"]), float(rec["exp"]))
+                elif op == "paid":
+                    self._paid.add(inv)
+                    self._resolved += self._pending.pop(inv, None) is not None
+                elif op == "drop":
+                    self._resolved += self._pending.pop(inv, None) is not None
+            # последняя строка оборвана — следующая запись начнётся с новой строки
+            self._needs_nl = bool(line) and not line.endswith("\n")
+
+    def _append(self, rec: dict) -> None:
+        with self._lock:
+            self._buf.append(json.dumps(rec, separators=(",", ":")) + "\n")
+        self._writer.mark()
+
+    def flush(self) -> None:
+        with self._lock:
+            lines, self._buf = self._buf, []
+        if not lines:
+            return
+        if self._needs_nl:
+            lines.insert(0, "\n")
+            self._needs_nl = False
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(lines))
+        if self._resolved >= COMPACT_AFTER_RESOLVED:
+            self._compact()
+
+    def _compact(self) -> None:
+        """Перезаписывает журнал текущим состоянием (tmp + os.replace)."""
+        with self._lock:
+            # буфер сбрасываем вместе со снапшотом, чтобы не дописать его в старый файл
+            self._buf = []
+            paid = list(self._paid)
+            pending = list(self._pending.items())
+            self._resolved = 0
+        fd, tmp = tempfile.mkstemp(prefix="invoices_", dir=os.path.dirname(self.path) or ".")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for inv in paid:
+                f.write(json.dumps({"op": "paid", "id": inv}, separators=(",", ":")) + "\n")
+            for inv, (uid, exp) in pending:
+                f.write(json.dumps(
+                    {"op": "pending", "id": inv, "user_id": uid, "exp": exp}, separators=(",", ":"),
+                ) + "\n")
+        os.replace(tmp, self.path)
+
+    def is_paid(self, invoice_id: int) -> bool:
+        return invoice_id in self._paid
+
+    def add_pending(self, invoice_id: int, user_id: int, expires_at: float) -> None:
+        self._pending[invoice_id] = (user_id, expires_at)
+        self._append({"op": "pending", "id": invoice_id, "user_id": user_id, "exp": expires_at})
+
+    def pending(self) -> list[tuple[int, int, float]]:
+        """(invoice_id, user_id, expires_at) всех ожидающих оплаты счетов."""
+        return [(inv, uid, exp) for inv, (uid, exp) in list(self._pending.items())]
+
+    def drop_pending(self, invoice_id: int) -> None:
+        if self._pending.pop(invoice_id, None) is None:
+            return
+        self._resolved += 1
+        self._append({"op": "drop", "id": invoice_id})
+
+    def claim_paid(self, invoice_id: int, user_id: int) -> bool:
+        """Отмечает оплату зачтённой. True — если впервые (можно активировать)."""
+        if invoice_id in self._paid:
+            return False
+        self._paid.add(invoice_id)
+        self._resolved += self._pending.pop(invoice_id, None) is not None
+        self._append({"op": "paid", "id": invoice_id, "user_id": user_id})
+        return True
+
+    def close(self) -> None:
+        self._writer.close()
@@ -0,0 +1,37 @@
+# vpn_bot/locks.py
+from __future__ import annotations
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Hashable
+
+
+class KeyedLocks:
+    """
+    asyncio.Lock на ключ (user_id): обработчики одного пользователя идут по очереди,
+    разных — параллельно. Лок существует, только пока его держат или ждут,
+    так что словарь не растёт с числом пользователей.
+    Используется только из потока event loop'а.
+    """
+
+    def __init__(self):
+        self._locks: dict[Hashable, list] = {}  # key -> [Lock, сколько держат/ждут]
+        self.contended = 0  # сколько раз пришлось ждать чужой обработчик
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            if entry[0].locked():
+                self.contended += 1
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
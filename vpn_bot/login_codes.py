@@ -0,0 +1,167 @@
+# vpn_bot/login_codes.py
+from __future__ import annotations
+import heapq, secrets, threading, time
+from collections import OrderedDict
+from typing import Optional
+
+
+class CodeStoreFull(Exception):
+    pass
+
+
+class LoginCodeStore:
+    """
+    Одноразовые коды входа из приложения: code -> (user_id, exp).
+    Истёкшие коды вычищаются по min-куче сроков (sweep), живых кодов не больше capacity.
+    У пользователя одновременно живёт один код — новый заменяет старый.
+    """
+
+    def __init__(self, ttl: float, capacity: int = 100_000, digits: int = 6, max_tries: int = 32):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.digits = digits
+        self.max_tries = max_tries
+        self._space = 10 ** digits
+        self._codes: dict[str, tuple[int, float]] = {}
+        self._by_user: dict[int, str] = {}
+        self._heap: list[tuple[float, str]] = []
+        self._lock = threading.Lock()
+        # счётчики для метрик
+        self.issued = 0
+        self.consumed = 0
+        self.expired = 0
+        self.collisions = 0
+        self.rejected = 0
+
+    def _drop(self, code: str) -> Optional[tuple[int, float]]:
+        entry = self._codes.pop(code, None)
+        if entry is not None and self._by_user.get(entry[0]) == code:
+            del self._by_user[entry[0]]
+        return entry
+
+    def _sweep(self, now: float) -> int:
+        n = 0
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            exp, code = heapq.heappop(heap)
+            entry = self._codes.get(code)
+            # запись в куче могла устареть: код уже погашен или выдан заново
+            if entry is not None and entry[1] == exp:
+                self._drop(code)
+                n += 1
+        # погашенные коды оставляют в куче мусор — пересобираем, когда его много
+        if len(heap) > 2 * len(self._codes) + 1024:
+            self._heap = [(exp, code) for code, (_, exp) in self._codes.items()]
+            heapq.heapify(self._heap)
+        self.expired += n
+        return n
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Удаляет истёкшие коды; возвращает, сколько удалено."""
+        with self._lock:
+            return self._sweep(time.time() if now is None else now)
+
+    def issue(self, user_id: int) -> str:
+        now = time.time()
+        with self._lock:
+            self._sweep(now)
+            old = self._by_user.get(user_id)
+            if old is not None:
+                self._drop(old)
+            if len(self._codes) >= self.capacity:
+                self.rejected += 1
+                raise CodeStoreFull("слишком много активных кодов входа")
+            for _ in range(self.max_tries):
+                code = f"{secrets.randbelow(self._space):0{self.digits}d}"
+                if code not in self._codes:
+                    break
+                self.collisions += 1
+            else:
+                self.rejected += 1
+                raise CodeStoreFull("не удалось подобрать свободный код")
+            exp = now + self.ttl
+            self._codes[code] = (user_id, exp)
+            self._by_user[user_id] = code
+            heapq.heappush(self._heap, (exp, code))
+            self.issued += 1
+            return code
+
+    def peek(self, code: str) -> Optional[int]:
+        """user_id по живому коду, код не расходуется (для /api/validate)."""
+        entry = self._codes.get(code)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def take(self, code: str) -> Optional[int]:
+        """user_id по живому коду; код гасится."""
+        with self._lock:
+            entry = self._codes.get(code)
+            if entry is None or entry[1] <= time.time():
+                return None
+            self._drop(code)
+            self.consumed += 1
+            return entry[0]
+
+    def __len__(self) -> int:
+        return len(self._codes)
+
+    def stats(self) -> dict:
+        with self._lock:
+            next_exp = self._heap[0][0] - time.time() if self._heap else None
+            return {
+                "size": len(self._codes),
+                "capacity": self.capacity,
+                "heap": len(self._heap),
+                "issued": self.issued,
+                "consumed": self.consumed,
+                "expired": self.expired,
+                "collisions": self.collisions,
+                "rejected": self.rejected,
+                "next_expiry_sec": max(0.0, next_exp) if next_exp is not None else None,
+            }
+
+
+class AttemptLimiter:
+    """
+    Ограничение неудачных попыток ввода кода с одного клиента: не больше limit
+    за окно window секунд, дальше — отказ до конца окна. Клиентов помнит не больше
+    max_clients (вытесняются самые давние).
+    """
+
+    def __init__(self, limit: int = 10, window: float = 600.0, max_clients: int = 50_000):
+        self.limit = limit
+        self.window = window
+        self.max_clients = max_clients
+        self._fails: OrderedDict[str, tuple[float, int]] = OrderedDict()  # client -> (начало окна, неудач)
+        self._lock = threading.Lock()
+        self.blocked_total = 0
+
+    def retry_after(self, client: str) -> float:
+        """0 — можно пробовать; иначе сколько секунд ждать."""
+        now = time.time()
+        with self._lock:
+            entry = self._fails.get(client)
+            if entry is None:
+                return 0.0
+            start, n = entry
+            if now - start >= self.window:
+                del self._fails[client]
+                return 0.0
+            if n < self.limit:
+                return 0.0
+            self.blocked_total += 1
+            return start + self.window - now
+
+    def fail(self, client: str) -> None:
+        now = time.time()
+        with self._lock:
+            start, n = self._fails.pop(client, (now, 0))
+            if now - start >= self.window:
+                start, n = now, 0
+            self._fails[client] = (start, n + 1)
+            while len(self._fails) > self.max_clients:
+                self._fails.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._fails)
@@ -0,0 +1,182 @@
+# vpn_bot/metrics.py
+"""
+Метрики в текстовом формате Prometheus — без внешних зависимостей.
+
+Счётчики и гистограммы обновляются на горячем пути (дёшево, под коротким локом),
+а значения, которые модули и так считают сами (хиты кэша, размер хранилища кодов...),
+снимаются функциями в момент запроса /metrics.
+"""
+from __future__ import annotations
+import bisect, threading, time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Sequence
+
+# Границы по умолчанию (секунды): от долей миллисекунды до десятков секунд
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[n]) for n in self.labels)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_labels(self.labels, k)} {_num(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}  # labels -> [счётчики по корзинам..., sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        s = self._series.get(self._key(labels))
+        return s[-1] if s else 0
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            series = [(k, list(s)) for k, s in self._series.items()]
+        out = []
+        for key, s in series:
+            acc = 0
+            for le, n in zip(self.buckets, s):
+                acc += n
+                le_label = 'le="%s"' % _num(float(le))
+                out.append(f"{self.name}_bucket{_labels(self.labels, key, le_label)} {acc}")
+            inf_label = 'le="+Inf"'
+            plain = _labels(self.labels, key)
+            out.append(f"{self.name}_bucket{_labels(self.labels, key, inf_label)} {s[-1]}")
+            out.append(f"{self.name}_sum{plain} {_num(float(s[-2]))}")
+            out.append(f"{self.name}_count{plain} {s[-1]}")
+        return out
+
+
+class Collected(_Metric):
+    """
+    Значения, снимаемые функцией при каждом запросе /metrics. fn возвращает число
+    или, если задана метка, dict {значение метки: число}.
+    """
+
+    def __init__(self, name: str, help: str, fn: Callable[[], object], type: str = "gauge", label: str = ""):
+        super().__init__(name, help, (label,) if label else ())
+        self.type = type
+        self._fn = fn
+
+    def samples(self) -> list[str]:
+        value = self._fn()
+        if value is None:
+            return []
+        if not self.labels:
+            return [f"{self.name} {_num(value)}"]
+        return [f"{self.name}{_labels(self.labels, (k,))} {_num(v)}" for k, v in dict(value).items()]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"метрика {metric.name} уже зарегистрирована")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def collect(self, name: str, help: str, fn: Callable[[], object], type: str = "gauge", label: str = "") -> Collected:
+        return self._add(Collected(name, help, fn, type, label))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for m in metrics:
+            try:
+                samples = m.samples()
+            except Exception as e:  # сломанный сборщик не должен ронять весь /metrics
+                samples = []
+                lines.append(f"# {m.name}: {e!r}")
+            lines += m.header()
+            lines += samples
+        return "\n".join(lines) + "\n"
+
+
+# Общий реестр процесса
+REGISTRY = Registry()
@@ -0,0 +1,210 @@
+# vpn_bot/nodes.py
+"""
+Реестр VPN-узлов: у каждого свой endpoint, публичный ключ сервера, пул адресов и ёмкость.
+
+Без WG_NODES_FILE узел один ("default") и собирается из прежних настроек
+(WG_ENDPOINT_HOST, WG_SERVER_PUBLIC_KEY, SERVER_HOST, WG_POOL) — конфиги не меняются.
+С файлом — JSON-список узлов:
+
+    [{"name": "ams1", "endpoint_host": "ams1.example.com", "public_key": "...",
+      "pool": "10.66.0.0/16", "capacity": 5000},
+     {"name": "fra1", "endpoint_host": "fra1.example.com", "public_key": "...",
+      "pool": "10.67.0.0/16", "wg": "ssh root@fra1 wg", "drained": true}]
+
+Необязательные поля: endpoint_port, ovpn_host, ovpn_port, interface, wg (команда wg,
+в том числе через ssh), sync_conf и sync_header (для WG_SYNC=syncconf, только локальные
+узлы), capacity (по умолчанию — размер пула), drained.
+Пулы узлов не должны пересекаться: адрес однозначно указывает на пользователя.
+Пользователи без записанного узла (выданные до реестра) считаются на первом узле.
+"""
+from __future__ import annotations
+import heapq, json
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
+
+from vpn_bot.config import (
+    SERVER_HOST, SERVER_PORT, WG_ENDPOINT_HOST, WG_ENDPOINT_PORT, WG_SERVER_PUBLIC_KEY,
+    WG_POOL, WG_START_HOST, WG_INTERFACE, WG_NODES_FILE, WG_SYNC_CONF, WG_SYNC_HEADER,
+)
+from vpn_bot.users import NODE_NAME_MAX
+from vpn_bot.wg_pool import WgAddressPool
+
+
+@dataclass(slots=True, eq=False)
+class Node:
+    name: str
+    endpoint_host: str
+    endpoint_port: int
+    public_key: str
+    pool: WgAddressPool
+    capacity: int
+    ovpn_host: str
+    ovpn_port: int
+    interface: str = "wg0"
+    wg: str = "wg"
+    sync_conf: str = ""
+    sync_header: str = ""
+    drained: bool = False
+    version: int = 0  # меняется при каждом изменении нагрузки: записи кучи с другой версией устарели
+
+    @property
+    def used(self) -> int:
+        return self.pool.used
+
+    @property
+    def full(self) -> bool:
+        return self.pool.used >= self.capacity
+
+    @property
+    def score(self) -> float:
+        """Доля занятой ёмкости: чем меньше, тем охотнее узел получает новых пользователей."""
+        return self.pool.used / self.capacity if self.capacity else 1.0
+
+
+class NodeRegistry:
+    """
+    Узлы и min-куча (загрузка, имя, версия) для выбора наименее загруженного: O(log n)
+    на выдачу и возврат адреса. Устаревшие записи отбрасываются при извлечении (как в
+    users._TimeIndex), переполненные и выведенные узлы в куче не держатся.
+    Используется только из потока event loop'а (кроме load() при старте).
+    """
+
+    def __init__(self, nodes: list[Node]):
+        if not nodes:
+            raise ValueError("Нужен хотя бы один узел")
+        self._nodes: dict[str, Node] = {}
+        for node in nodes:
+            if node.name in self._nodes:
+                raise ValueError(f"Узел {node.name!r} описан дважды")
+            if not node.name or len(node.name.encode("utf-8")) > NODE_NAME_MAX:
+                raise ValueError(f"Имя узла {node.name!r}: от 1 до {NODE_NAME_MAX} байт")
+            self._nodes[node.name] = node
+        nets = sorted((n.pool.network, n.name) for n in nodes)
+        for (a, a_name), (b, b_name) in zip(nets, nets[1:]):
+            if a.overlaps(b):
+                raise ValueError(f"Пулы узлов {a_name} ({a}) и {b_name} ({b}) пересекаются")
+        self.default = nodes[0]
+        self.orphans = 0  # адресов на узлах, которых больше нет в конфиге
+        self._heap: list[tuple[float, str, int]] = []
+        self.rebuild()
+
+    def __iter__(self) -> Iterator[Node]:
+        return iter(self._nodes.values())
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def get(self, name: str) -> Optional[Node]:
+        return self._nodes.get(name)
+
+    def resolve(self, name: Optional[str]) -> Node:
+        """Узел пользователя; без записанного узла или с удалённым из конфига — узел по умолчанию."""
+        if name is None:
+            return self.default
+        return self._nodes.get(name) or self.default
+
+    # --- куча ---
+    def rebuild(self) -> None:
+        # O(n) вместо n вставок; заодно выбрасывает накопившиеся устаревшие записи
+        self._heap = [(n.score, n.name, n.version) for n in self._nodes.values() if not n.drained and not n.full]
+        heapq.heapify(self._heap)
+
+    def _changed(self, node: Node) -> None:
+        node.version += 1
+        if node.drained or node.full:
+            return
+        heapq.heappush(self._heap, (node.score, node.name, node.version))
+        if len(self._heap) > 4 * len(self._nodes) + 64:
+            self.rebuild()
+
+    def load(self, assignments: Iterable[tuple[Optional[str], int]]) -> None:
+        """Занятые адреса при старте: (узел из записи пользователя, адрес)."""
+        for name, addr in assignments:
+            node = self._nodes.get(name) if name is not None else self.default
+            if node is None:
+                self.orphans += 1
+                continue
+            node.pool.mark_used(addr)
+        self.rebuild()
+
+    def allocate(self, exclude: Optional[Node] = None) -> tuple[Node, int]:
+        """Наименее загруженный узел (кроме exclude) и свободный адрес на нём."""
+        heap = self._heap
+        held = None
+        try:
+            while heap:
+                _, name, version = heap[0]
+                node = self._nodes[name]
+                if version != node.version or node.drained or node.full:
+                    heapq.heappop(heap)
+                    continue
+                if node is exclude:
+                    held = heapq.heappop(heap)
+                    continue
+                addr = node.pool.allocate()
+                self._changed(node)
+                return node, addr
+        finally:
+            if held is not None:
+                heapq.heappush(heap, held)
+        raise RuntimeError("Нет узла со свободным местом")
+
+    def release(self, name: Optional[str], addr: int) -> None:
+        node = self.resolve(name)
+        before = node.used
+        node.pool.release(addr)
+        if node.used != before:
+            self._changed(node)
+
+    def set_drained(self, name: str, drained: bool = True) -> Node:
+        """Выведенный узел не получает новых пользователей; уже выданные адреса остаются."""
+        node = self._nodes.get(name)
+        if node is None:
+            raise KeyError(name)
+        node.drained = drained
+        self._changed(node)
+        return node
+
+    @property
+    def used(self) -> int:
+        return sum(n.used for n in self._nodes.values())
+
+    @property
+    def capacity(self) -> int:
+        return sum(n.capacity for n in self._nodes.values())
+
+
+def _node(spec: dict) -> Node:
+    pool = WgAddressPool(spec["pool"], start_host=int(spec.get("start_host", WG_START_HOST)))
+    host = spec["endpoint_host"]
+    interface = spec.get("interface", WG_INTERFACE)
+    return Node(
+        name=spec["name"],
+        endpoint_host=host,
+        endpoint_port=int(spec.get("endpoint_port", WG_ENDPOINT_PORT)),
+        public_key=spec["public_key"],
+        pool=pool,
+        capacity=min(int(spec.get("capacity", pool.capacity)), pool.capacity),
+        ovpn_host=spec.get("ovpn_host", host),
+        ovpn_port=int(spec.get("ovpn_port", SERVER_PORT)),
+        interface=interface,
+        wg=spec.get("wg", "wg"),
+        sync_conf=spec.get("sync_conf", f"/etc/wireguard/{interface}.peers.conf"),
+        sync_header=spec.get("sync_header", ""),
+        drained=bool(spec.get("drained", False)),
+    )
+
+
+def load_nodes(path: str = WG_NODES_FILE) -> NodeRegistry:
+    if not path:
+        return NodeRegistry([_node({
+            "name": "default", "endpoint_host": WG_ENDPOINT_HOST, "public_key": WG_SERVER_PUBLIC_KEY,
+            "pool": WG_POOL, "ovpn_host": SERVER_HOST,
+            "sync_conf": WG_SYNC_CONF, "sync_header": WG_SYNC_HEADER,
+        })])
+    with open(path, "r", encoding="utf-8") as f:
+        specs = json.load(f)
+    try:
+        return NodeRegistry([_node(s) for s in specs])
+    except KeyError as e:
+        raise ValueError(f"{path}: у узла нет обязательного поля {e}") from None
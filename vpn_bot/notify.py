@@ -0,0 +1,179 @@
+# vpn_bot/notify.py
+from __future__ import annotations
+import asyncio, json, logging, os, tempfile, threading
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from vpn_bot.writebehind import WriteBehind
+
+log = logging.getLogger("vpn_bot")
+
+BASE_DIR = os.path.dirname(__file__)
+BLOCKED_FILE = os.path.join(BASE_DIR, "blocked.json")
+
+
+class Notifier:
+    """
+    Очередь рассылки уведомлений. Несколько воркеров отправляют параллельно,
+    но не быстрее rate сообщений в секунду на весь бот и не чаще раза
+    в per_chat_interval секунд в один чат. RetryAfter приостанавливает всю
+    рассылку на указанное время, сетевые ошибки повторяются с паузой,
+    заблокировавшие бота пользователи запоминаются и пропускаются.
+    submit() не ждёт отправки — задача, которая ставит уведомления, завершается сразу.
+    """
+
+    def __init__(
+        self,
+        rate: float = 30.0,
+        per_chat_interval: float = 1.0,
+        concurrency: int = 16,
+        retries: int = 3,
+        backoff: float = 1.0,
+        max_queue: int = 1_000_000,
+        blocked_path: str = BLOCKED_FILE,
+    ):
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.blocked_path = blocked_path
+        self._queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self._next_slot = 0.0     # loop.time() следующего разрешённого отправления
+        self._paused_until = 0.0  # после RetryAfter
+        self._chat_next: dict[int, float] = {}
+        self._blocked: set[int] = set()
+        self._blocked_lock = threading.Lock()
+        self._load_blocked()
+        self._writer = WriteBehind(self._save_blocked, 1.0, "blocked-writer")
+        self._bot = None
+        # счётчики для метрик
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.throttled = 0
+        self.dropped = 0
+
+    # --- заблокировавшие бота ---
+    def _load_blocked(self) -> None:
+        try:
+            with open(self.blocked_path, "r", encoding="utf-8") as f:
+                self._blocked = set(json.load(f))
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            log.warning("%s повреждён, список заблокировавших начат заново", self.blocked_path)
+
+    def _save_blocked(self) -> None:
+        with self._blocked_lock:
+            data = sorted(self._blocked)
+        fd, tmp = tempfile.mkstemp(prefix="blocked_", dir=os.path.dirname(self.blocked_path) or ".")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, self.blocked_path)
+
+    def is_blocked(self, chat_id: int) -> bool:
+        return chat_id in self._blocked
+
+    def mark_blocked(self, chat_id: int) -> None:
+        with self._blocked_lock:
+            if chat_id in self._blocked:
+                return
+            self._blocked.add(chat_id)
+        self._writer.mark()
+
+    def unblock(self, chat_id: int) -> None:
+        """Пользователь снова пишет боту — значит, разблокировал."""
+        if chat_id not in self._blocked:
+            return
+        with self._blocked_lock:
+            self._blocked.discard(chat_id)
+        self._writer.mark()
+
+    # --- очередь ---
+    def submit(self, chat_id: int, text: str, **kwargs) -> bool:
+        """Ставит сообщение в очередь. False — пользователь заблокировал бота или очередь полна."""
+        if chat_id in self._blocked:
+            return False
+        try:
+            self._queue.put_nowait((chat_id, text, kwargs))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        return True
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    async def run(self, bot) -> None:
+        """Воркеры рассылки; запускается из post_init."""
+        self._bot = bot
+        await asyncio.gather(*(self._worker() for _ in range(self.concurrency)))
+
+    async def join(self) -> None:
+        await self._queue.join()
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id, text, kwargs = await self._queue.get()
+            try:
+                await self._deliver(chat_id, text, kwargs)
+            except Exception:
+                self.failed += 1
+                log.exception("notify %s failed", chat_id)
+            finally:
+                self._queue.task_done()
+
+    async def _pace(self, chat_id: int) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next_slot, self._paused_until)
+        self._next_slot = slot + 1.0 / self.rate
+        slot = max(slot, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = slot + self.per_chat_interval
+        if len(self._chat_next) > 10_000:
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _deliver(self, chat_id: int, text: str, kwargs: dict) -> None:
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.retried += 1
+            await self._pace(chat_id)
+            try:
+                await self._bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                self.sent += 1
+                return
+            except RetryAfter as e:
+                # флуд-контроль Telegram: ждут все воркеры, а не только этот
+                self.throttled += 1
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                self._paused_until = max(self._paused_until, asyncio.get_running_loop().time() + float(delay))
+            except Forbidden:
+                self.mark_blocked(chat_id)
+                return
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    self.mark_blocked(chat_id)
+                else:
+                    self.failed += 1
+                    log.warning("notify %s rejected: %s", chat_id, e)
+                return
+            except NetworkError:
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+        self.failed += 1
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "throttled": self.throttled,
+            "dropped": self.dropped,
+            "blocked": len(self._blocked),
+        }
+
+    def close(self) -> None:
+        self._writer.close()
@@ -0,0 +1,317 @@
+# vpn_bot/packstore.py
+"""
+Упакованное хранилище персональных конфигов вместо тысяч файлов в vpn_configs/users/.
+
+users.pack      — журнал записей: [заголовок][конфиг], только дозапись
+users.pack.idx  — снимок индекса (user_id, kind) -> смещение, чтобы не сканировать журнал при старте
+
+Чтение — через mmap, get() отдаёт memoryview прямо на страницы файла (без копирования).
+Записи за концом отображения читаются копией; файл отображается заново, только когда
+такой хвост дорастёт до размера отображения, — живых mmap остаётся O(log размера).
+Устаревшие версии остаются в журнале мусором, пока compact() не перепишет файл.
+
+    python -m vpn_bot.packstore stats|compact|import [DIR]
+"""
+from __future__ import annotations
+import mmap, os, struct, sys, threading
+from pathlib import Path
+from typing import Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: без межпроцессной блокировки
+    fcntl = None
+
+KINDS = {"ovpn": 1, "wg": 2}
+_KIND_NAMES = {v: k for k, v in KINDS.items()}
+_TOMBSTONE = 0x80
+
+# user_id, kind (старший бит — удаление), длина данных, штамп (8 байт)
+_REC = struct.Struct("<qBI8s")
+# индекс: сигнатура, размер журнала на момент снимка, inode журнала, затем записи.
+# После компакции журнал — новый файл (новый inode): индекс от старого, оставшийся
+# из-за падения между заменой пака и записью индекса, не подойдёт и будет отброшен.
+_IDX_HEAD = struct.Struct("<8sQQ")
+_IDX_REC = struct.Struct("<qBQI8s")
+_IDX_MAGIC = b"VPNPACK2"
+_NO_STAMP = b"\0" * 8
+
+# Компакция, когда мусора больше, чем живых данных, и он больше этого порога
+COMPACT_MIN_GARBAGE = 4 * 1024 * 1024
+# Новый mmap — когда неотображённый хвост не меньше max(отображённого, порога)
+REMAP_MIN_TAIL = 1024 * 1024
+
+
+def _stamp_bytes(stamp: Optional[str]) -> bytes:
+    try:
+        raw = bytes.fromhex(stamp or "")
+    except ValueError:
+        raw = b""
+    return raw if len(raw) == 8 else _NO_STAMP
+
+
+class ConfigPack:
+    """
+    Append-only файл конфигов + индекс в памяти: поиск O(1) без обращения к каталогу.
+    Одновременно писать в пак может только один процесс (flock на POSIX).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = path + ".idx"
+        self._lock = threading.Lock()
+        # (user_id, kind) -> (смещение данных, длина, штамп)
+        self._index: dict[tuple[int, int], tuple[int, int, bytes]] = {}
+        self._live = 0
+        self._mm: Optional[mmap.mmap] = None
+        self._view: Optional[memoryview] = None
+        self._mapped = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # блокировка — на отдельном файле: mmap держит копию дескриптора пака и с ней flock
+        self._lockf = open(path + ".lock", "a+b")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lockf.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lockf.close()
+                raise RuntimeError(f"{path} уже открыт другим процессом (бот запущен?)")
+        self._f = open(path, "a+b")
+        self._size = os.fstat(self._f.fileno()).st_size
+        self._load()
+
+    # --- загрузка ---
+    def _load(self) -> None:
+        start = self._load_index()
+        end = self._scan(start)
+        if end < self._size:
+            # оборванная последняя запись (падение во время дозаписи)
+            self._f.truncate(end)
+            self._size = end
+
+    def _load_index(self) -> int:
+        """Читает снимок индекса; возвращает, с какого смещения досканировать журнал."""
+        try:
+            with open(self.index_path, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return 0
+        if len(raw) < _IDX_HEAD.size:
+            return 0
+        magic, data_size, ino = _IDX_HEAD.unpack_from(raw)
+        # индекс старого формата или от другого файла — журнал сканируется целиком
+        if magic != _IDX_MAGIC or data_size > self._size or ino != os.fstat(self._f.fileno()).st_ino:
+            return 0
+        for uid, kind, off, length, stamp in _IDX_REC.iter_unpack(raw[_IDX_HEAD.size:]):
+            self._index[(uid, kind)] = (off, length, stamp)
+            self._live += _REC.size + length
+        return data_size
+
+    def _scan(self, pos: int) -> int:
+        """Применяет записи журнала начиная с pos; возвращает конец последней целой записи."""
+        if pos >= self._size:
+            return pos
+        self._f.seek(pos)
+        while pos + _REC.size <= self._size:
+            head = self._f.read(_REC.size)
+            uid, kind, length, stamp = _REC.unpack(head)
+            if pos + _REC.size + length > self._size:
+                break
+            self._f.seek(length, os.SEEK_CUR)
+            self._apply(uid, kind, pos + _REC.size, length, stamp)
+            pos += _REC.size + length
+        return pos
+
+    def _apply(self, uid: int, kind: int, off: int, length: int, stamp: bytes) -> None:
+        key = (uid, kind & ~_TOMBSTONE)
+        old = self._index.pop(key, None)
+        if old is not None:
+            self._live -= _REC.size + old[1]
+        if not kind & _TOMBSTONE:
+            self._index[key] = (off, length, stamp)
+            self._live += _REC.size + length
+
+    # --- чтение ---
+    def _remap(self) -> None:
+        # старый mmap не закрываем: на него могут ссылаться уже отданные memoryview
+        # (он закроется сам, когда их не останется); отображение растёт вдвое и больше,
+        # так что одновременно живых — O(log размера пака)
+        self._f.flush()
+        if self._size:
+            self._mm = mmap.mmap(self._f.fileno(), self._size, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mm)
+        self._mapped = self._size
+
+    def get(self, user_id: int, kind: str) -> Optional[memoryview]:
+        """Конфиг без копирования (срез mmap) или None; свежая запись за концом отображения — копией."""
+        with self._lock:
+            entry = self._index.get((user_id, KINDS[kind]))
+            if entry is None:
+                return None
+            off, length, _ = entry
+            if off + length > self._mapped:
+                if self._mapped and self._size - self._mapped < max(self._mapped, REMAP_MIN_TAIL):
+                    self._f.flush()
+                    return memoryview(os.pread(self._f.fileno(), length, off))
+                self._remap()
+            return self._view[off:off + length]
+
+    def stamp(self, user_id: int, kind: str) -> Optional[str]:
+        entry = self._index.get((user_id, KINDS[kind]))
+        if entry is None or entry[2] == _NO_STAMP:
+            return None
+        return entry[2].hex()
+
+    def __contains__(self, key: tuple[int, str]) -> bool:
+        return (key[0], KINDS[key[1]]) in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def keys(self) -> Iterator[tuple[int, str]]:
+        return ((uid, _KIND_NAMES[k]) for uid, k in list(self._index))
+
+    # --- запись ---
+    def _append(self, uid: int, kind: int, stamp: bytes, data: bytes) -> None:
+        self._f.seek(0, os.SEEK_END)
+        self._f.write(_REC.pack(uid, kind, len(data), stamp))
+        self._f.write(data)
+        off = self._size + _REC.size
+        self._size = off + len(data)
+        self._apply(uid, kind, off, len(data), stamp)
+
+    def put(self, user_id: int, kind: str, stamp: Optional[str], data: bytes) -> None:
+        with self._lock:
+            self._append(user_id, KINDS[kind], _stamp_bytes(stamp), data)
+            self._f.flush()
+
+    def put_many(self, records) -> int:
+        """Пачка (user_id, kind, stamp, data) — один flush на всю пачку."""
+        n = 0
+        with self._lock:
+            for uid, kind, stamp, data in records:
+                self._append(uid, KINDS[kind], _stamp_bytes(stamp), data)
+                n += 1
+            self._f.flush()
+        return n
+
+    def delete(self, user_id: int, kind: str) -> None:
+        with self._lock:
+            if (user_id, KINDS[kind]) in self._index:
+                self._append(user_id, KINDS[kind] | _TOMBSTONE, _NO_STAMP, b"")
+                self._f.flush()
+
+    # --- обслуживание ---
+    @property
+    def garbage(self) -> int:
+        return self._size - self._live
+
+    def _write_index(self) -> None:
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(_IDX_HEAD.pack(_IDX_MAGIC, self._size, os.fstat(self._f.fileno()).st_ino))
+            f.write(b"".join(
+                _IDX_REC.pack(uid, kind, off, length, stamp)
+                for (uid, kind), (off, length, stamp) in self._index.items()
+            ))
+        os.replace(tmp, self.index_path)
+
+    def flush(self) -> None:
+        with self._lock:
+            self._f.flush()
+            self._write_index()
+
+    def maybe_compact(self) -> bool:
+        if self.garbage < max(self._live, COMPACT_MIN_GARBAGE):
+            return False
+        self.compact()
+        return True
+
+    def compact(self) -> None:
+        """
+        Переписывает пак только живыми записями. Основной объём копируется без
+        блокировки (записи неизменяемы); под блокировкой — только дописанное за это время.
+        """
+        with self._lock:
+            self._f.flush()
+            end0 = self._size
+            snapshot = list(self._index.items())
+        tmp = self.path + ".tmp"
+        moved: dict[int, int] = {}
+        with open(self.path, "rb") as src, open(tmp, "wb") as dst:
+            pos = 0
+            for (uid, kind), (off, length, stamp) in snapshot:
+                src.seek(off)
+                dst.write(_REC.pack(uid, kind, length, stamp))
+                dst.write(src.read(length))
+                moved[off] = pos + _REC.size
+                pos += _REC.size + length
+            with self._lock:
+                self._f.flush()
+                index = {}
+                for key, (off, length, stamp) in self._index.items():
+                    if off < end0:
+                        index[key] = (moved[off], length, stamp)
+                        continue
+                    src.seek(off)
+                    dst.write(_REC.pack(key[0], key[1], length, stamp))
+                    dst.write(src.read(length))
+                    index[key] = (pos + _REC.size, length, stamp)
+                    pos += _REC.size + length
+                dst.flush()
+                os.fsync(dst.fileno())
+                os.replace(tmp, self.path)
+                old = self._f
+                self._f = open(self.path, "a+b")
+                old.close()
+                self._index = index
+                self._size = self._live = pos
+                self._mapped = 0
+                self._write_index()
+
+    def import_dir(self, directory: Path) -> int:
+        """
+        Переносит конфиги из каталога с файлами <user_id>.ovpn / <user_id>.conf.
+        Штамп берётся из строки '# config-stamp' в конце файла, если она есть.
+        """
+        from vpn_bot.render import data_stamp
+        records = []
+        for p in directory.iterdir():
+            kind = {".ovpn": "ovpn", ".conf": "wg"}.get(p.suffix)
+            if kind is None or not p.stem.isdigit():
+                continue
+            data = p.read_bytes()
+            records.append((int(p.stem), kind, data_stamp(data), data))
+        n = self.put_many(records)
+        self.flush()
+        return n
+
+    def close(self) -> None:
+        with self._lock:
+            if self._f.closed:
+                return
+            self._f.flush()
+            self._write_index()
+            self._f.close()
+            self._lockf.close()
+
+
+def main() -> None:
+    from vpn_bot.config import CONFIG_PACK
+    from vpn_bot.render import USER_CFG_DIR
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    pack = ConfigPack(CONFIG_PACK)
+    try:
+        if cmd == "import":
+            src = Path(sys.argv[2]) if len(sys.argv) > 2 else USER_CFG_DIR
+            print(f"импортировано {pack.import_dir(src)} конфигов из {src}")
+        elif cmd == "compact":
+            before = pack.garbage
+            pack.compact()
+            print(f"компакция: освобождено {before} байт")
+        print(f"{len(pack)} конфигов, {pack._live} байт живых данных, {pack.garbage} байт мусора")
+    finally:
+        pack.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# vpn_bot/ratelimit.py
+from __future__ import annotations
+import threading, time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+
+class RateLimiter:
+    """
+    Token bucket на ключ (user_id, IP клиента) отдельно для каждой области —
+    команды бота или HTTP-маршрута. Бюджет области: (скорость в запросах/сек, ёмкость).
+    Ведра хранятся в одном LRU: при переполнении вытесняется самое давнее, так что
+    память ограничена max_keys независимо от числа пользователей.
+    Вытесненное ведро при следующем запросе создаётся полным. Для уже восполнившегося
+    ведра это ничего не меняет (evicted["refilled"]), но если ключей больше max_keys
+    приходит быстрее, чем ведра восполняются, вытесняются и неполные (evicted["early"]):
+    перебором ключей можно сбросить чужие вёдра. evicted["early"] > 0 — повод поднять max_keys.
+    """
+
+    def __init__(
+        self,
+        budgets: dict[str, tuple[float, float]],
+        default: tuple[float, float],
+        max_keys: int = 100_000,
+    ):
+        self.budgets = dict(budgets)
+        self.default = default
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[tuple[str, Hashable], list[float]] = OrderedDict()  # -> [токены, время]
+        self._lock = threading.Lock()
+        self.rejected: dict[str, int] = {}
+        self.evicted: dict[str, int] = {"refilled": 0, "early": 0}
+
+    def _evict(self, now: float) -> None:
+        (scope, _), (tokens, last) = self._buckets.popitem(last=False)
+        rate, burst = self.budgets.get(scope, self.default)
+        refilled = tokens + (now - last) * rate >= burst
+        self.evicted["refilled" if refilled else "early"] += 1
+
+    def check(self, scope: str, key: Hashable, cost: float = 1.0, now: Optional[float] = None) -> float:
+        """Списывает cost токенов. 0 — запрос разрешён, иначе сколько секунд подождать."""
+        rate, burst = self.budgets.get(scope, self.default)
+        now = time.monotonic() if now is None else now
+        bkey = (scope, key)
+        with self._lock:
+            bucket = self._buckets.get(bkey)
+            if bucket is None:
+                bucket = [burst, now]
+                self._buckets[bkey] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._evict(now)
+            else:
+                self._buckets.move_to_end(bkey)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0.0
+            self.rejected[scope] = self.rejected.get(scope, 0) + 1
+            return (cost - bucket[0]) / rate if rate > 0 else float("inf")
+
+    def __len__(self) -> int:
+        return len(self._buckets)
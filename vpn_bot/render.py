@@ -0,0 +1,167 @@
+# vpn_bot/render.py
+"""
+Рендер персональных конфигов: общий для бота и для массовой перегенерации.
+
+    python -m vpn_bot.render [--workers N] [--force]
+
+перегенерирует конфиги всех активных пользователей в паке (например, после смены
+WG_SERVER_PUBLIC_KEY, WG_ENDPOINT_HOST, SERVER_HOST, описания узлов или шаблона). Конфиги,
+штамп которых совпадает с текущим, не трогаются. Пак пишет один процесс —
+бот на время перегенерации нужно остановить.
+"""
+from __future__ import annotations
+import argparse, ipaddress, time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from vpn_bot.config import WG_ALLOWED_IPS, WG_DNS, WG_ADDRESS_CIDR, USER_STORE, USERS_DB, CONFIG_PACK
+from vpn_bot.nodes import Node, NodeRegistry, load_nodes
+from vpn_bot.packstore import ConfigPack
+from vpn_bot.templates import CompiledTemplate, TemplateFile
+from vpn_bot.users import User, key_to_b64, open_user_store, sub_end_iso
+
+# Пути к шаблонам; users/ — старый формат «файл на пользователя», только для импорта в пак
+CFG_DIR = Path(__file__).with_name("vpn_configs")
+USER_CFG_DIR = CFG_DIR / "users"
+
+TEMPLATE_OVPN = TemplateFile(
+    CFG_DIR / "default.ovpn",
+    allowed={"SERVER_HOST", "SERVER_PORT", "USER_ID", "SUB_END"},
+)
+TEMPLATE_WG = TemplateFile(
+    CFG_DIR / "default_wg.conf",
+    allowed={
+        "USER_ID", "SUB_END", "WG_ENDPOINT_HOST", "WG_ENDPOINT_PORT", "WG_ALLOWED_IPS",
+        "WG_DNS", "WG_SERVER_PUBLIC_KEY", "CLIENT_PRIVATE_KEY", "CLIENT_ADDRESS",
+    },
+    # без ключа и адреса клиента конфиг бесполезен
+    required={"CLIENT_PRIVATE_KEY", "CLIENT_ADDRESS"},
+)
+
+# Последняя строка каждого конфига — комментарий со штампом (обе программы его игнорируют)
+STAMP_PREFIX = b"# config-stamp: "
+
+
+def ovpn_values(user_id: int, u: Optional[User], node: Node) -> dict[str, str]:
+    return {
+        "SERVER_HOST": node.ovpn_host,
+        "SERVER_PORT": str(node.ovpn_port),
+        "USER_ID": str(user_id),
+        "SUB_END": sub_end_iso(u),
+    }
+
+
+def wg_values(user_id: int, u: User, node: Node) -> dict[str, str]:
+    return {
+        "USER_ID": str(user_id),
+        "SUB_END": sub_end_iso(u),
+        "WG_ENDPOINT_HOST": node.endpoint_host,
+        "WG_ENDPOINT_PORT": str(node.endpoint_port),
+        "WG_ALLOWED_IPS": WG_ALLOWED_IPS,
+        "WG_DNS": WG_DNS,
+        "WG_SERVER_PUBLIC_KEY": node.public_key,
+        "CLIENT_PRIVATE_KEY": key_to_b64(u.wg_private_key) or "<MISSING_PRIV>",
+        "CLIENT_ADDRESS": (
+            f"{ipaddress.IPv4Address(u.wg_address)}/{WG_ADDRESS_CIDR}"
+            if u.wg_address is not None else "<MISSING_ADDR>"
+        ),
+    }
+
+
+def render_config(tpl: CompiledTemplate, values: dict[str, str], stamp: Optional[str] = None) -> bytes:
+    """Рендерит шаблон и дописывает строку со штампом."""
+    data = tpl.render(values)
+    if data and not data.endswith(b"\n"):
+        data += b"\n"
+    return data + STAMP_PREFIX + (stamp or tpl.stamp(values)).encode("ascii") + b"\n"
+
+
+def data_stamp(data: bytes) -> Optional[str]:
+    """Штамп из хвоста отрендеренного конфига (None — конфиг без штампа)."""
+    i = data.rfind(STAMP_PREFIX, max(0, len(data) - 64))
+    return data[i + len(STAMP_PREFIX):].strip().decode("ascii", "replace") if i >= 0 else None
+
+
+# --- массовая перегенерация ---
+def _render_chunk(jobs: list[tuple], force: bool) -> tuple[list[tuple[int, str, str, bytes]], int]:
+    """
+    Выполняется в процессе-воркере: рендерит устаревшие конфиги пачки.
+    Возвращает (записи для пака, сколько уже актуальны).
+    """
+    ovpn, wg = TEMPLATE_OVPN.get(), TEMPLATE_WG.get()
+    out = []
+    skipped = 0
+    for uid, ov, ov_old, wv, wv_old in jobs:
+        for kind, tpl, values, old in (("ovpn", ovpn, ov, ov_old), ("wg", wg, wv, wv_old)):
+            if values is None:
+                continue
+            stamp = tpl.stamp(values)
+            if not force and old == stamp:
+                skipped += 1
+                continue
+            out.append((uid, kind, stamp, render_config(tpl, values, stamp)))
+    return out, skipped
+
+
+def rerender_all(store, pack, nodes: NodeRegistry, workers: Optional[int] = None, force: bool = False,
+                 chunk: int = 2000) -> dict:
+    """
+    Перегенерирует конфиги всех активных пользователей пачками в пуле процессов.
+    WG-конфиг пишется только тем, у кого уже есть WG-профиль (новые адреса здесь не выдаются).
+    """
+    # ошибки шаблона — сразу, а не в каждом воркере
+    TEMPLATE_OVPN.get()
+    TEMPLATE_WG.get()
+
+    started = time.perf_counter()
+    now = time.time()
+    jobs = []
+    for uid, u in store.items():
+        if u.subscription_end is None or now >= u.subscription_end:
+            continue
+        node = nodes.resolve(u.node)
+        wv = wg_values(uid, u, node) if u.wg_private_key and u.wg_address is not None else None
+        jobs.append((uid, ovpn_values(uid, u, node), pack.stamp(uid, "ovpn"), wv, pack.stamp(uid, "wg")))
+    chunks = [jobs[i:i + chunk] for i in range(0, len(jobs), chunk)]
+
+    written = skipped = 0
+    if chunks:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for records, s in pool.map(_render_chunk, chunks, [force] * len(chunks)):
+                written += pack.put_many(records)
+                skipped += s
+    pack.flush()
+    elapsed = time.perf_counter() - started
+    return {
+        "users": len(jobs),
+        "written": written,
+        "up_to_date": skipped,
+        "seconds": round(elapsed, 3),
+        "users_per_sec": round(len(jobs) / elapsed) if elapsed > 0 else 0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Перегенерация конфигов активных пользователей")
+    parser.add_argument("--workers", type=int, default=None, help="число процессов (по умолчанию — по числу CPU)")
+    parser.add_argument("--force", action="store_true", help="перезаписать даже актуальные конфиги")
+    parser.add_argument("--chunk", type=int, default=2000, help="пользователей на одну задачу воркера")
+    args = parser.parse_args()
+
+    nodes = load_nodes()
+    pack = ConfigPack(CONFIG_PACK)
+    store = open_user_store(USER_STORE, USERS_DB)
+    try:
+        r = rerender_all(store, pack, nodes, args.workers, args.force, args.chunk)
+    finally:
+        store.close()
+        pack.close()
+    print(
+        f"{r['users']} активных пользователей: записано {r['written']} конфигов, "
+        f"актуальны {r['up_to_date']}, {r['seconds']:.2f} с ({r['users_per_sec']} польз./с)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# vpn_bot/templates.py
+from __future__ import annotations
+import hashlib, re, threading, time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+_PLACEHOLDER = re.compile(r"\{\{(\w+)\}\}")
+
+
+class TemplateError(Exception):
+    pass
+
+
+class CompiledTemplate:
+    """
+    Шаблон, разобранный один раз на сегменты: чётные — литералы, нечётные —
+    имена плейсхолдеров. Рендер — один join без повторных str.replace.
+    """
+    __slots__ = ("version", "digest", "names", "_order", "_parts")
+
+    def __init__(self, text: str, version: int, allowed: set[str], required: set[str], name: str):
+        parts = _PLACEHOLDER.split(text)
+        names = set(parts[1::2])
+        unknown = names - allowed
+        if unknown:
+            raise TemplateError(f"{name}: неизвестные плейсхолдеры {sorted(unknown)}")
+        missing = required - names
+        if missing:
+            raise TemplateError(f"{name}: нет обязательных плейсхолдеров {sorted(missing)}")
+        for lit in parts[0::2]:
+            if "{{" in lit or "}}" in lit:
+                raise TemplateError(f"{name}: незакрытый плейсхолдер рядом с {lit.strip()[:40]!r}")
+        self.version = version
+        self.digest = hashlib.sha256(text.encode("utf-8")).digest()
+        self.names = names
+        self._order = sorted(names)
+        self._parts = parts
+
+    def stamp(self, values: dict[str, str]) -> str:
+        """Хэш текста шаблона и подставляемых значений: изменился — конфиг устарел."""
+        h = hashlib.blake2b(self.digest, digest_size=8)
+        for name in self._order:
+            h.update(b"\0")
+            h.update(values[name].encode("utf-8"))
+        return h.hexdigest()
+
+    def render(self, values: dict[str, str]) -> bytes:
+        parts = list(self._parts)
+        for i in range(1, len(parts), 2):
+            parts[i] = values[parts[i]]
+        return "".join(parts).encode("utf-8")
+
+
+class TemplateFile:
+    """
+    Шаблон на диске. Компилируется при первом обращении; mtime проверяется
+    не чаще раза в check_interval секунд и при изменении шаблон перечитывается.
+    """
+
+    def __init__(self, path: Path, allowed: set[str], required: set[str] = frozenset(),
+                 check_interval: float = 2.0):
+        self.path = path
+        self.allowed = set(allowed)
+        self.required = set(required)
+        self.check_interval = check_interval
+        self._compiled: Optional[CompiledTemplate] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> CompiledTemplate:
+        now = time.monotonic()
+        compiled = self._compiled
+        if compiled is not None and now - self._checked_at < self.check_interval:
+            return compiled
+        with self._lock:
+            if not self.path.exists():
+                raise FileNotFoundError(f"Шаблон {self.path.name} не найден в {self.path.parent}")
+            mtime = self.path.stat().st_mtime_ns
+            if self._compiled is None or self._compiled.version != mtime:
+                text = self.path.read_text(encoding="utf-8")
+                self._compiled = CompiledTemplate(text, mtime, self.allowed, self.required, self.path.name)
+            self._checked_at = now
+            return self._compiled
+
+
+class RenderCache:
+    """
+    LRU отрендеренных конфигов (bytes / memoryview) с ограничением по суммарному размеру.
+    Ключ — (user_id, kind); запись валидна только пока совпадает версия
+    (штамп шаблона и входных данных), с которой её отрендерили.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: OrderedDict[tuple[int, str], tuple[object, bytes | memoryview]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int, kind: str, version) -> Optional[bytes | memoryview]:
+        key = (user_id, kind)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] != version:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, user_id: int, kind: str, version, data: bytes | memoryview) -> None:
+        key = (user_id, kind)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old[1])
+            self._items[key] = (version, data)
+            self._size += len(data)
+            while self._size > self.max_bytes and self._items:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self._lock:
+            for key in [k for k in ((user_id, "ovpn"), (user_id, "wg")) if k in self._items]:
+                self._size -= len(self._items.pop(key)[1])
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._size
@@ -0,0 +1,80 @@
+# vpn_bot/tg_files.py
+from __future__ import annotations
+import hashlib, threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from telegram import Message
+from telegram.error import BadRequest
+
+
+def content_hash(data: bytes | memoryview) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class FileIdCache:
+    """
+    file_id документов, уже загруженных в Telegram: (user_id, kind) -> (хэш содержимого, file_id).
+    Пока конфиг не изменился, его можно переслать по file_id без повторной загрузки.
+    """
+
+    def __init__(self, max_items: int = 200_000):
+        self.max_items = max_items
+        self._items: OrderedDict[tuple[int, str], tuple[bytes, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.uploads = 0
+
+    def get(self, user_id: int, kind: str, digest: bytes) -> Optional[str]:
+        key = (user_id, kind)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] != digest:
+                return None
+            self._items.move_to_end(key)
+            return item[1]
+
+    def put(self, user_id: int, kind: str, digest: bytes, file_id: str) -> None:
+        key = (user_id, kind)
+        with self._lock:
+            self._items[key] = (digest, file_id)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def discard(self, user_id: int, kind: str) -> None:
+        with self._lock:
+            self._items.pop((user_id, kind), None)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+async def send_config(
+    send: Callable[..., Awaitable[Message]],
+    cache: FileIdCache,
+    user_id: int,
+    kind: str,
+    data: bytes | memoryview,
+    filename: str,
+    **kwargs,
+) -> Message:
+    """
+    Отправляет конфиг через send (reply_document или bot.send_document с chat_id).
+    Если такой же конфиг уже загружался — по file_id; иначе загружает и запоминает file_id.
+    """
+    digest = content_hash(data)
+    file_id = cache.get(user_id, kind, digest)
+    if file_id is not None:
+        try:
+            msg = await send(document=file_id, **kwargs)
+            cache.hits += 1
+            return msg
+        except BadRequest:
+            # file_id больше не принимается — загрузим заново
+            cache.discard(user_id, kind)
+    msg = await send(document=bytes(data), filename=filename, **kwargs)
+    cache.uploads += 1
+    if msg is not None and msg.document is not None:
+        cache.put(user_id, kind, digest, msg.document.file_id)
+    return msg
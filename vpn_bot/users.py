@@ -1,22 +1,55 @@
 # vpn_bot/users.py
 from __future__ import annotations
-import json, os, tempfile
-from dataclasses import dataclass, asdict
-from datetime import datetime, timedelta, timezone
-from typing import Dict, Optional
+import base64, heapq, ipaddress, json, os, sqlite3, struct, sys, tempfile, threading, time, zlib
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, Iterator, Optional
+
+from vpn_bot.metrics import REGISTRY
+from vpn_bot.writebehind import WriteBehind
 
 BASE_DIR = os.path.dirname(__file__)
-USERS_FILE = os.path.join(BASE_DIR, "users.json")
+USERS_FILE = os.getenv("USERS_FILE") or os.path.join(BASE_DIR, "users.json")
+
+# Бинарный снапшот (users.snap) и журнал изменений (по компактной записи на мутацию):
+# при загрузке журнал проигрывается поверх снапшота. users.json читается, только если
+# снапшота ещё нет (первый запуск после обновления), и пишется только экспортом.
+USERS_SNAPSHOT = os.path.splitext(USERS_FILE)[0] + ".snap"
+USERS_JOURNAL = os.path.splitext(USERS_FILE)[0] + ".journal"
+JOURNAL_COMPACT_BYTES = int(os.getenv("USERS_JOURNAL_COMPACT_BYTES", str(8 * 1024 * 1024)))
+# Окно, за которое все изменения сливаются в одну запись на диск (делает фоновый поток)
+SAVE_DEBOUNCE_SEC = float(os.getenv("USERS_SAVE_DEBOUNCE_SEC", "0.5"))
+
+# op: journal — дозапись журнала, snapshot — полный users.json, sqlite — транзакция
+SAVE_SECONDS = REGISTRY.histogram("vpn_users_save_seconds", "Длительность записи пользователей на диск", labels=("op",))
+SAVE_BYTES = REGISTRY.counter("vpn_users_save_bytes_total", "Записано байт пользователей", labels=("op",))
+SAVE_RECORDS = REGISTRY.counter("vpn_users_save_records_total", "Записано пользователей", labels=("op",))
 
+# снапшот: сигнатура, число записей, crc32 записей; затем записи фиксированной длины
+_SNAP_HEAD = struct.Struct("<8sQI")
+# user_id, флаги, start, end, адрес, приватный ключ, публичный ключ, имя узла (v2)
+_SNAP_REC = struct.Struct("<qBqqI32s32s16s")
+_SNAP_REC_V1 = struct.Struct("<qBqqI32s32s")
+_SNAP_MAGIC = b"VPNUSER2"
+_SNAP_MAGIC_V1 = b"VPNUSER1"
+_F_SUBSCRIBED, _F_START, _F_END, _F_PRIV, _F_PUB, _F_ADDR = 1, 2, 4, 8, 16, 32
+_NO_KEY = b"\0" * 32
+NODE_NAME_MAX = 16  # байт UTF-8: столько места под имя узла в записи снапшота
 
-@dataclass
+
+@dataclass(slots=True)
 class User:
+    """
+    Компактная запись в памяти: даты — epoch-секунды, ключи — сырые 32 байта,
+    адрес — IPv4 как int. ISO-строки и base64 появляются только при сериализации.
+    """
     subscribed: bool = False
-    subscription_start: Optional[str] = None  # ISO
-    subscription_end: Optional[str] = None    # ISO
-    wg_private_key: Optional[str] = None
-    wg_public_key: Optional[str] = None
-    wg_address: Optional[str] = None  # например "10.66.0.2/32"
+    subscription_start: Optional[int] = None  # epoch, сек
+    subscription_end: Optional[int] = None    # epoch, сек
+    wg_private_key: Optional[bytes] = None
+    wg_public_key: Optional[bytes] = None
+    wg_address: Optional[int] = None  # например int("10.66.0.2"); префикс — WG_ADDRESS_CIDR
+    node: Optional[str] = None  # узел (vpn_bot.nodes), на котором выдан адрес; None — узел по умолчанию
 
 
 def _to_iso(dt: datetime) -> str:
@@ -25,69 +58,865 @@ def _to_iso(dt: datetime) -> str:
     return dt.astimezone(timezone.utc).isoformat()
 
 
-def load_users() -> Dict[int, User]:
-    if not os.path.exists(USERS_FILE):
-        return {}
-    with open(USERS_FILE, "r", encoding="utf-8") as f:
-        raw = json.load(f)
-    users: Dict[int, User] = {}
-    for k, v in raw.items():
-        users[int(k)] = User(**v)
-    return users
+def _iso_to_ts(iso: Optional[str]) -> Optional[int]:
+    if not iso:
+        return None
+    return int(datetime.fromisoformat(iso).timestamp())
 
 
-def save_users(users: Dict[int, User]) -> None:
-    tmp_fd, tmp_path = tempfile.mkstemp(prefix="users_", suffix=".json", dir=BASE_DIR)
-    os.close(tmp_fd)
-    data = {str(uid): asdict(u) for uid, u in users.items()}
-    with open(tmp_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    os.replace(tmp_path, USERS_FILE)
+def _ts_to_iso(ts: Optional[int]) -> Optional[str]:
+    if ts is None:
+        return None
+    return _to_iso(datetime.fromtimestamp(ts, timezone.utc))
 
 
-def register_user(users: Dict[int, User], user_id: int) -> None:
-    users.setdefault(user_id, User())
-    save_users(users)
+def key_to_b64(key: Optional[bytes]) -> Optional[str]:
+    return base64.b64encode(key).decode("ascii") if key is not None else None
 
 
-def activate_subscription(users: Dict[int, User], user_id: int, days: int) -> None:
-    start = datetime.now(timezone.utc)
-    end = start + timedelta(days=days)
-    u = users.setdefault(user_id, User())
-    u.subscribed = True
-    u.subscription_start = _to_iso(start)
-    u.subscription_end = _to_iso(end)
-    save_users(users)
+def key_from_b64(key: Optional[str]) -> Optional[bytes]:
+    return base64.b64decode(key) if key else None
+
+
+def addr_to_str(addr: Optional[int]) -> Optional[str]:
+    return str(ipaddress.IPv4Address(addr)) if addr is not None else None
+
+
+def addr_from_str(addr: Optional[str]) -> Optional[int]:
+    # старый формат хранил адрес вместе с префиксом: "10.66.0.2/32"
+    return int(ipaddress.IPv4Address(addr.split("/", 1)[0])) if addr else None
+
+
+def sub_end_iso(u: Optional[User]) -> str:
+    """Дата окончания подписки в ISO (для шаблонов и сообщений) или пустая строка."""
+    return (_ts_to_iso(u.subscription_end) or "") if u else ""
+
+
+def user_to_json(u: User) -> dict:
+    return {
+        "subscribed": u.subscribed,
+        "subscription_start": _ts_to_iso(u.subscription_start),
+        "subscription_end": _ts_to_iso(u.subscription_end),
+        "wg_private_key": key_to_b64(u.wg_private_key),
+        "wg_public_key": key_to_b64(u.wg_public_key),
+        "wg_address": addr_to_str(u.wg_address),
+        "node": u.node,
+    }
+
+
+def _pack_user(uid: int, u: User) -> bytes:
+    flags = (
+        (_F_SUBSCRIBED if u.subscribed else 0)
+        | (_F_START if u.subscription_start is not None else 0)
+        | (_F_END if u.subscription_end is not None else 0)
+        | (_F_PRIV if u.wg_private_key is not None else 0)
+        | (_F_PUB if u.wg_public_key is not None else 0)
+        | (_F_ADDR if u.wg_address is not None else 0)
+    )
+    for key in (u.wg_private_key, u.wg_public_key):
+        if key is not None and len(key) != 32:
+            raise ValueError(f"user {uid}: ключ WireGuard должен быть 32 байта, а не {len(key)}")
+    node = u.node.encode("utf-8") if u.node else b""
+    if len(node) > NODE_NAME_MAX:
+        raise ValueError(f"user {uid}: имя узла длиннее {NODE_NAME_MAX} байт: {u.node!r}")
+    return _SNAP_REC.pack(
+        uid, flags, u.subscription_start or 0, u.subscription_end or 0, u.wg_address or 0,
+        u.wg_private_key or _NO_KEY, u.wg_public_key or _NO_KEY, node,
+    )
+
+
+def pack_snapshot(users: Dict[int, User]) -> bytes:
+    body = b"".join([_pack_user(uid, u) for uid, u in users.items()])
+    return _SNAP_HEAD.pack(_SNAP_MAGIC, len(users), zlib.crc32(body)) + body
+
+
+def unpack_snapshot(data: bytes) -> Iterator[tuple[int, User]]:
+    """Записи снапшота; испорченный файл — ValueError (молча начинать с пустой базы нельзя)."""
+    if len(data) < _SNAP_HEAD.size:
+        raise ValueError("снапшот пользователей обрезан")
+    magic, count, crc = _SNAP_HEAD.unpack_from(data)
+    body = memoryview(data)[_SNAP_HEAD.size:]
+    if magic == _SNAP_MAGIC:
+        rec = _SNAP_REC
+    elif magic == _SNAP_MAGIC_V1:  # до узлов: все пользователи — на узле по умолчанию
+        rec = _SNAP_REC_V1
+    else:
+        raise ValueError("не снапшот пользователей (неверная сигнатура)")
+    if len(body) != count * rec.size or zlib.crc32(body) != crc:
+        raise ValueError("снапшот пользователей повреждён (размер или crc32)")
+    names: dict[bytes, Optional[str]] = {b"": None}  # имён узлов единицы — не плодим строки
+    for uid, flags, start, end, addr, priv, pub, *node in rec.iter_unpack(body):
+        raw = node[0].rstrip(b"\0") if node else b""
+        name = names.get(raw)
+        if name is None and raw:
+            name = names[raw] = raw.decode("utf-8")
+        yield uid, User(
+            bool(flags & _F_SUBSCRIBED),
+            start if flags & _F_START else None,
+            end if flags & _F_END else None,
+            priv if flags & _F_PRIV else None,
+            pub if flags & _F_PUB else None,
+            addr if flags & _F_ADDR else None,
+            name,
+        )
+
+
+def user_from_json(d: dict) -> User:
+    return User(
+        subscribed=bool(d.get("subscribed", False)),
+        subscription_start=_iso_to_ts(d.get("subscription_start")),
+        subscription_end=_iso_to_ts(d.get("subscription_end")),
+        wg_private_key=key_from_b64(d.get("wg_private_key")),
+        wg_public_key=key_from_b64(d.get("wg_public_key")),
+        wg_address=addr_from_str(d.get("wg_address")),
+        node=d.get("node") or None,
+    )
+
+
+class UserStore:
+    """
+    Интерфейс хранилища пользователей. Бот работает только через него,
+    поэтому бэкенд (JSON в памяти или SQLite) выбирается в конфиге.
+    Изменённого пользователя нужно явно сохранить через put().
+    """
+
+    def get(self, user_id: int) -> Optional[User]:
+        raise NotImplementedError
+
+    def put(self, user_id: int, u: User) -> None:
+        raise NotImplementedError
+
+    def items(self) -> Iterator[tuple[int, User]]:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def __contains__(self, user_id: int) -> bool:
+        return self.get(user_id) is not None
+
+    def is_active(self, user_id: int, now: float) -> bool:
+        raise NotImplementedError
+
+    def wg_addresses(self) -> Iterator[int]:
+        """Все выданные WG-адреса — для заполнения пула при старте."""
+        raise NotImplementedError
 
-def assigned_wg_addresses(users: Dict[int, User]) -> set[str]:
-    return {u.wg_address for u in users.values() if getattr(u, "wg_address", None)}
+    def wg_assignments(self) -> Iterator[tuple[Optional[str], int]]:
+        """(узел, адрес) всех выданных WG-адресов — для пулов узлов при старте."""
+        raise NotImplementedError
 
-def next_wg_address(users: Dict[int, User], prefix: str, cidr: int, start_host: int = 2) -> str:
+    def on_node(self, node: Optional[str]) -> list[int]:
+        """user_id с WG-адресом на узле node (None — узел не записан, то есть по умолчанию)."""
+        raise NotImplementedError
+
+    def take_expired(self, now: float) -> list[int]:
+        """
+        user_id тех, у кого subscribed=True, но срок уже вышел.
+        Вызывающий обязан сразу отключить их подписку (expire_subscription).
+        """
+        raise NotImplementedError
+
+    def next_expiry(self) -> Optional[int]:
+        """Ближайший subscription_end (epoch) среди активных подписок или None."""
+        raise NotImplementedError
+
+    def expiring_between(self, after: float, until: float) -> list[int]:
+        """user_id активных подписок с after < subscription_end <= until (для напоминаний)."""
+        raise NotImplementedError
+
+    def take_reclaimable(self, ended_before: float) -> list[int]:
+        """
+        user_id неактивных пользователей с WG-адресом, чья подписка кончилась до ended_before.
+        Вызывающий обязан сразу освободить их адрес (release_wg_profile).
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class _TimeIndex:
+    """
+    min-куча (ts, user_id) с ленивым удалением: действительна только последняя
+    запись пользователя, устаревшие отбрасываются при извлечении.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[int, int]] = []
+        self._ts: Dict[int, int] = {}  # user_id -> ts последней записи
+
+    def set(self, user_id: int, ts: int, push: bool = True) -> None:
+        if self._ts.get(user_id) != ts:
+            self._ts[user_id] = ts
+            if push:
+                heapq.heappush(self._heap, (ts, user_id))
+
+    def discard(self, user_id: int) -> None:
+        self._ts.pop(user_id, None)
+
+    def rebuild(self) -> None:
+        # O(n) вместо n вставок — после загрузки
+        self._heap = [(ts, uid) for uid, ts in self._ts.items()]
+        heapq.heapify(self._heap)
+
+    def _drop_stale(self) -> None:
+        heap = self._heap
+        while heap and self._ts.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def between(self, after: float, until: float) -> list[int]:
+        """Полный проход: user_id с after < ts <= until."""
+        return [uid for uid, ts in list(self._ts.items()) if after < ts <= until]
+
+    def peek(self) -> Optional[int]:
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_until(self, now: float) -> list[int]:
+        """O(k log n): извлекает только тех, чьё время уже наступило."""
+        out = []
+        heap = self._heap
+        while True:
+            self._drop_stale()
+            if not heap or heap[0][0] > now:
+                return out
+            _, uid = heapq.heappop(heap)
+            del self._ts[uid]
+            out.append(uid)
+
+
+class JsonUserStore(UserStore):
     """
-    Ищет свободный адрес в подсети prefix.X/cidr, начиная с start_host.
-    Пример: prefix="10.66.0", cidr=32 -> 10.66.0.2/32, 10.66.0.3/32, ...
+    Все пользователи в памяти; users.snap — бинарный снапшот, users.journal — журнал мутаций
+    (JSON-строки). put() только помечает пользователя изменённым: записи дописываются в журнал
+    фоновым потоком пачкой раз в окно, там же журнал сворачивается в снапшот
+    при превышении JOURNAL_COMPACT_BYTES. path — users.json: импорт, если снапшота нет.
     """
-    used = assigned_wg_addresses(users)
-    host = start_host
-    while host < 255:  # простой линейный перебор
-        candidate = f"{prefix}.{host}/{cidr}"
-        if candidate not in used:
-            return candidate
-        host += 1
-    raise RuntimeError("Не осталось свободных WG адресов в пуле")
-
-def set_wg_profile(users: Dict[int, User], user_id: int, priv: str, pub: str, addr: str) -> None:
-    u = users.setdefault(user_id, User())
+
+    def __init__(self, path: str = USERS_FILE, journal_path: str = USERS_JOURNAL, snapshot_path: Optional[str] = None):
+        self.path = path
+        self.snapshot_path = snapshot_path or os.path.splitext(path)[0] + ".snap"
+        self.journal_path = journal_path
+        self.journal_old_path = journal_path + ".old"  # журнал, который сейчас сворачивается
+        self._users: Dict[int, User] = {}
+        self._expiry = _TimeIndex()   # активные подписки по subscription_end
+        self._reclaim = _TimeIndex()  # неактивные с WG-адресом по subscription_end
+        self._lock = threading.Lock()     # только _dirty: берётся в put() из потока event loop'а
+        self._io_lock = threading.Lock()  # файл журнала и сворачивание; put() его не ждёт
+        self._journal_fh = None
+        self._dirty: set[int] = set()
+        self._load()
+        self._writer = WriteBehind(self.flush, SAVE_DEBOUNCE_SEC, "users-writer")
+
+    # --- загрузка ---
+    def _set(self, user_id: int, u: User, index_expiry: bool = True) -> None:
+        self._users[user_id] = u
+        end = u.subscription_end
+        if u.subscribed and end is not None:
+            self._expiry.set(user_id, end, push=index_expiry)
+        else:
+            self._expiry.discard(user_id)
+        if not u.subscribed and end is not None and u.wg_address is not None:
+            self._reclaim.set(user_id, end, push=index_expiry)
+        else:
+            self._reclaim.discard(user_id)
+
+    def _replay_journal(self, path: str) -> None:
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                    uid = int(rec.pop("id"))
+                except (ValueError, KeyError):
+                    # оборванная запись (падение посреди append) — пропускаем
+                    continue
+                self._set(uid, user_from_json(rec), index_expiry=False)
+
+    def _load(self) -> None:
+        from_json = False
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                data = f.read()
+            for uid, u in unpack_snapshot(data):
+                self._set(uid, u, index_expiry=False)
+        elif os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            for k, v in raw.items():
+                self._set(int(k), user_from_json(v), index_expiry=False)
+            from_json = True
+        # порядок важен: сначала недосвёрнутый журнал, потом текущий
+        self._replay_journal(self.journal_old_path)
+        self._replay_journal(self.journal_path)
+        # кучи строим один раз после загрузки — O(n) вместо n вставок
+        self._expiry.rebuild()
+        self._reclaim.rebuild()
+        if from_json:
+            # следующий старт прочитает уже бинарный снапшот; users.json остаётся как был
+            self.compact()
+
+    # --- журнал ---
+    def _open_journal(self):
+        if self._journal_fh is None:
+            # если прошлый процесс упал посреди записи, дописываем перевод строки,
+            # чтобы новая запись не склеилась с оборванной
+            needs_nl = False
+            if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) > 0:
+                with open(self.journal_path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    needs_nl = f.read(1) != b"\n"
+            self._journal_fh = open(self.journal_path, "a", encoding="utf-8")
+            if needs_nl:
+                self._journal_fh.write("\n")
+        return self._journal_fh
+
+    def _close_journal(self) -> None:
+        if self._journal_fh is not None:
+            self._journal_fh.close()
+            self._journal_fh = None
+
+    def _rotate_journal(self) -> None:
+        """Откладывает текущий журнал в .old; новые записи пойдут в пустой журнал."""
+        self._close_journal()
+        if not os.path.exists(self.journal_path):
+            return
+        if os.path.exists(self.journal_old_path):
+            # прошлое сворачивание не завершилось — сливаем журналы, чтобы не потерять записи
+            with open(self.journal_path, "r", encoding="utf-8") as src, \
+                    open(self.journal_old_path, "a", encoding="utf-8") as dst:
+                dst.write(src.read())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self.journal_old_path)
+
+    def _write_snapshot(self, users: Dict[int, User]) -> None:
+        tmp_fd, tmp_path = tempfile.mkstemp(
+            prefix="users_", suffix=".snap", dir=os.path.dirname(self.snapshot_path) or "."
+        )
+        with SAVE_SECONDS.time(op="snapshot"):
+            data = pack_snapshot(users)
+            with os.fdopen(tmp_fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.snapshot_path)
+        SAVE_BYTES.inc(len(data), op="snapshot")
+        SAVE_RECORDS.inc(len(users), op="snapshot")
+
+    def export_json(self, path: str) -> int:
+        """Все пользователи в JSON прежнего формата users.json (атомарно). Возвращает их число."""
+        users = dict(self._users)
+        tmp_fd, tmp_path = tempfile.mkstemp(prefix="users_", suffix=".json", dir=os.path.dirname(path) or ".")
+        with os.fdopen(tmp_fd, "w", encoding="utf-8") as f:
+            json.dump({str(uid): user_to_json(u) for uid, u in users.items()}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+        return len(users)
+
+    def compact(self) -> None:
+        """
+        Полный снапшот: журнал откладывается, users.snap перезаписывается атомарно,
+        после чего отложенный журнал удаляется. Падение на любом шаге не теряет данных:
+        при загрузке снапшот + .old + журнал дают то же состояние.
+        """
+        with self._io_lock:
+            self._rotate_journal()
+            self._write_snapshot(dict(self._users))
+            if os.path.exists(self.journal_old_path):
+                os.remove(self.journal_old_path)
+
+    def flush(self) -> None:
+        """Дописывает в журнал текущее состояние всех изменённых с прошлого раза пользователей."""
+        with self._lock:
+            ids, self._dirty = self._dirty, set()
+        if not ids:
+            return
+        start = time.perf_counter()
+        lines = []
+        for uid in ids:
+            u = self._users.get(uid)
+            if u is not None:
+                rec = {"id": uid, **user_to_json(u)}
+                lines.append(json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n")
+        with self._io_lock:
+            try:
+                fh = self._open_journal()
+                pos = fh.tell()
+                fh.write("".join(lines))
+                fh.flush()
+                end = fh.tell()
+            except Exception:
+                # не теряем изменения: следующий сброс запишет их заново (текущее состояние)
+                with self._lock:
+                    self._dirty |= ids
+                # хвост мог остаться оборванным — при переоткрытии _open_journal допишет перевод строки
+                try:
+                    self._close_journal()
+                except OSError:
+                    self._journal_fh = None
+                raise
+            too_big = end >= JOURNAL_COMPACT_BYTES
+        SAVE_SECONDS.observe(time.perf_counter() - start, op="journal")
+        SAVE_BYTES.inc(end - pos, op="journal")
+        SAVE_RECORDS.inc(len(lines), op="journal")
+        if too_big:
+            self.compact()
+
+    # --- UserStore ---
+    def get(self, user_id: int) -> Optional[User]:
+        return self._users.get(user_id)
+
+    def put(self, user_id: int, u: User) -> None:
+        """Обновляет запись в памяти и помечает её для фоновой записи; диск не трогает."""
+        self._set(user_id, u)
+        with self._lock:
+            self._dirty.add(user_id)
+        self._writer.mark()
+
+    def items(self) -> Iterator[tuple[int, User]]:
+        return iter(list(self._users.items()))
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def is_active(self, user_id: int, now: float) -> bool:
+        u = self._users.get(user_id)
+        return u is not None and u.subscription_end is not None and now < u.subscription_end
+
+    def wg_addresses(self) -> Iterator[int]:
+        return (u.wg_address for u in list(self._users.values()) if u.wg_address is not None)
+
+    def wg_assignments(self) -> Iterator[tuple[Optional[str], int]]:
+        return ((u.node, u.wg_address) for u in list(self._users.values()) if u.wg_address is not None)
+
+    def on_node(self, node: Optional[str]) -> list[int]:
+        return [uid for uid, u in list(self._users.items()) if u.wg_address is not None and u.node == node]
+
+    def take_expired(self, now: float) -> list[int]:
+        return self._expiry.pop_until(now)
+
+    def next_expiry(self) -> Optional[int]:
+        return self._expiry.peek()
+
+    def expiring_between(self, after: float, until: float) -> list[int]:
+        # вызывается редко (раз в несколько минут), так что полный проход допустим
+        return self._expiry.between(after, until)
+
+    def take_reclaimable(self, ended_before: float) -> list[int]:
+        return self._reclaim.pop_until(ended_before)
+
+    def close(self) -> None:
+        """Финальный сброс изменений на диск; безопасно вызывать повторно."""
+        self._writer.close()
+        with self._io_lock:
+            self._close_journal()
+
+
+class SqliteUserStore(UserStore):
+    """
+    SQLite в режиме WAL: в памяти держим только ещё не записанные изменения.
+    put() кладёт запись в буфер, фоновый поток раз в окно делает UPSERT пачкой
+    через отдельное соединение (WAL не блокирует читателей).
+    Даты хранятся как epoch-секунды, ключи — BLOB, адрес — INTEGER;
+    по subscription_end, wg_address и узлу есть индексы.
+    """
+
+    SCHEMA_VERSION = 2
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        id                 INTEGER PRIMARY KEY,
+        subscribed         INTEGER NOT NULL DEFAULT 0,
+        subscription_start INTEGER,
+        subscription_end   INTEGER,
+        wg_private_key     BLOB,
+        wg_public_key      BLOB,
+        wg_address         INTEGER,
+        node               TEXT
+    );
+    CREATE INDEX IF NOT EXISTS users_sub_end ON users(subscription_end) WHERE subscribed = 1;
+    CREATE UNIQUE INDEX IF NOT EXISTS users_wg_address ON users(wg_address) WHERE wg_address IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS users_node ON users(node) WHERE wg_address IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS users_reclaim ON users(subscription_end)
+        WHERE subscribed = 0 AND wg_address IS NOT NULL;
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._upgrade_schema()
+        # отдельное соединение для фонового писателя
+        self._wdb = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._wdb.execute("PRAGMA synchronous=NORMAL")
+        self._wlock = threading.Lock()
+        self._plock = threading.Lock()
+        self._pending: Dict[int, User] = {}   # ждут записи
+        self._inflight: Dict[int, User] = {}  # пишутся прямо сейчас
+        self._writer = WriteBehind(self.flush, SAVE_DEBOUNCE_SEC, "users-writer")
+
+    def _create_schema(self) -> None:
+        for stmt in self._SCHEMA.split(";"):
+            if stmt.strip():
+                self._db.execute(stmt)
+
+    def _upgrade_schema(self) -> None:
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        legacy = version == 0 and self._db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'"
+        ).fetchone()
+        if legacy:
+            # v0: ключи base64 (TEXT), адрес "10.66.0.2/32" (TEXT) — переливаем в новую таблицу
+            self._db.execute("BEGIN")
+            self._db.execute("DROP INDEX IF EXISTS users_wg_address")
+            self._db.execute("DROP INDEX IF EXISTS users_sub_end")
+            self._db.execute("ALTER TABLE users RENAME TO users_v0")
+            self._create_schema()
+            for row in self._db.execute("SELECT * FROM users_v0").fetchall():
+                uid, subscribed, start, end, priv, pub, addr = row
+                self._db.execute(self._UPSERT, (
+                    uid, subscribed, start, end,
+                    key_from_b64(priv), key_from_b64(pub), addr_from_str(addr), None,
+                ))
+            self._db.execute("DROP TABLE users_v0")
+            self._db.execute("COMMIT")
+        elif version == 1:
+            # v1: без узла — все пользователи на узле по умолчанию (NULL)
+            self._db.execute("ALTER TABLE users ADD COLUMN node TEXT")
+            self._create_schema()
+        else:
+            self._create_schema()
+        self._db.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    @staticmethod
+    def _row(u: User) -> tuple:
+        return (
+            int(u.subscribed), u.subscription_start, u.subscription_end,
+            u.wg_private_key, u.wg_public_key, u.wg_address, u.node,
+        )
+
+    @staticmethod
+    def _row_bytes(row: tuple) -> int:
+        """Оценка записанных байт: полезная нагрузка строки (страницы WAL и индексы не считаем)."""
+        return sum(len(v) if isinstance(v, (bytes, str)) else 8 for v in row if v is not None)
+
+    @staticmethod
+    def _user(row: tuple) -> User:
+        return User(bool(row[0]), *row[1:])
+
+    def _query(self, sql: str, params: tuple = ()) -> list[tuple]:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _buffered(self, user_id: int) -> Optional[User]:
+        with self._plock:
+            return self._pending.get(user_id) or self._inflight.get(user_id)
+
+    def get(self, user_id: int) -> Optional[User]:
+        u = self._buffered(user_id)
+        if u is not None:
+            return u
+        rows = self._query(
+            "SELECT subscribed, subscription_start, subscription_end,"
+            " wg_private_key, wg_public_key, wg_address, node FROM users WHERE id = ?",
+            (user_id,),
+        )
+        return self._user(rows[0]) if rows else None
+
+    _UPSERT = (
+        "INSERT INTO users (id, subscribed, subscription_start, subscription_end,"
+        " wg_private_key, wg_public_key, wg_address, node) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+        " ON CONFLICT(id) DO UPDATE SET subscribed = excluded.subscribed,"
+        " subscription_start = excluded.subscription_start,"
+        " subscription_end = excluded.subscription_end,"
+        " wg_private_key = excluded.wg_private_key,"
+        " wg_public_key = excluded.wg_public_key,"
+        " wg_address = excluded.wg_address,"
+        " node = excluded.node"
+    )
+
+    def put(self, user_id: int, u: User) -> None:
+        with self._plock:
+            self._pending[user_id] = u
+        self._writer.mark()
+
+    def put_many(self, items: list[tuple[int, User]]) -> None:
+        with self._wlock:
+            self._wdb.execute("BEGIN")
+            try:
+                self._wdb.executemany(self._UPSERT, [(uid, *self._row(u)) for uid, u in items])
+            except Exception:
+                self._wdb.execute("ROLLBACK")
+                raise
+            self._wdb.execute("COMMIT")
+
+    def flush(self) -> None:
+        """Записывает буфер одной транзакцией."""
+        with self._wlock:
+            with self._plock:
+                batch, self._pending = self._pending, {}
+                self._inflight = batch
+            if not batch:
+                return
+            start = time.perf_counter()
+            rows = [(uid, *self._row(u)) for uid, u in batch.items()]
+            try:
+                self._wdb.execute("BEGIN")
+                self._wdb.executemany(self._UPSERT, rows)
+                self._wdb.execute("COMMIT")
+                SAVE_SECONDS.observe(time.perf_counter() - start, op="sqlite")
+                SAVE_BYTES.inc(sum(map(self._row_bytes, rows)), op="sqlite")
+                SAVE_RECORDS.inc(len(batch), op="sqlite")
+            except Exception:
+                self._wdb.execute("ROLLBACK")
+                with self._plock:
+                    # не теряем записи: вернём в буфер те, что не успели обновить заново
+                    for uid, u in batch.items():
+                        self._pending.setdefault(uid, u)
+                raise
+            finally:
+                with self._plock:
+                    self._inflight = {}
+
+    # Сканы не сбрасывают буфер (это транзакция с fsync, а вызываются они и из event loop'а):
+    # читают записанное и накладывают поверх ещё не записанные версии пользователей.
+    def _buffer(self) -> Dict[int, User]:
+        with self._plock:
+            buf = dict(self._inflight)
+            buf.update(self._pending)
+        return buf
+
+    def _merged(self, sql: str, params: tuple, match) -> list[int]:
+        """id из запроса (первая колонка), кроме буферизованных, плюс буферизованные, где match(u)."""
+        buf = self._buffer()
+        ids = [r[0] for r in self._query(sql, params) if r[0] not in buf]
+        ids += [uid for uid, u in buf.items() if match(u)]
+        return ids
+
+    def items(self) -> Iterator[tuple[int, User]]:
+        # постранично по первичному ключу, чтобы не тянуть всю таблицу в память
+        buf = self._buffer()
+        unseen = set(buf)
+        last = None
+        while True:
+            rows = self._query(
+                "SELECT id, subscribed, subscription_start, subscription_end,"
+                " wg_private_key, wg_public_key, wg_address, node FROM users"
+                " WHERE ? IS NULL OR id > ? ORDER BY id LIMIT 1000",
+                (last, last),
+            )
+            if not rows:
+                break
+            for row in rows:
+                uid = row[0]
+                if uid in buf:
+                    unseen.discard(uid)
+                    yield uid, buf[uid]
+                else:
+                    yield uid, self._user(row[1:])
+            last = rows[-1][0]
+        # новые пользователи, ещё не записанные в базу
+        for uid in sorted(unseen):
+            yield uid, buf[uid]
+
+    def __len__(self) -> int:
+        buf = self._buffer()
+        count = self._query("SELECT COUNT(*) FROM users")[0][0]
+        ids = list(buf)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            known = self._query(
+                f"SELECT COUNT(*) FROM users WHERE id IN ({','.join('?' * len(chunk))})", tuple(chunk)
+            )[0][0]
+            count += len(chunk) - known
+        return count
+
+    def is_active(self, user_id: int, now: float) -> bool:
+        u = self._buffered(user_id)
+        if u is not None:
+            return u.subscription_end is not None and now < u.subscription_end
+        rows = self._query(
+            "SELECT 1 FROM users WHERE id = ? AND subscription_end > ?",
+            (user_id, now),
+        )
+        return bool(rows)
+
+    def wg_addresses(self) -> Iterator[int]:
+        return (addr for _, addr in self.wg_assignments())
+
+    def wg_assignments(self) -> Iterator[tuple[Optional[str], int]]:
+        buf = self._buffer()
+        rows = self._query("SELECT id, node, wg_address FROM users WHERE wg_address IS NOT NULL")
+        out = [(node, addr) for uid, node, addr in rows if uid not in buf]
+        out += [(u.node, u.wg_address) for u in buf.values() if u.wg_address is not None]
+        return iter(out)
+
+    def on_node(self, node: Optional[str]) -> list[int]:
+        return self._merged(
+            "SELECT id FROM users WHERE wg_address IS NOT NULL AND node IS ?", (node,),
+            lambda u: u.wg_address is not None and u.node == node,
+        )
+
+    def take_expired(self, now: float) -> list[int]:
+        return self._merged(
+            "SELECT id FROM users WHERE subscribed = 1 AND subscription_end <= ?", (now,),
+            lambda u: u.subscribed and u.subscription_end is not None and u.subscription_end <= now,
+        )
+
+    def next_expiry(self) -> Optional[int]:
+        buf = self._buffer()
+        # первая по сроку запись, которую буфер не переопределяет; хватает len(buf) + 1 строк
+        rows = self._query(
+            "SELECT id, subscription_end FROM users WHERE subscribed = 1"
+            " AND subscription_end IS NOT NULL ORDER BY subscription_end LIMIT ?",
+            (len(buf) + 1,),
+        )
+        ends = [end for uid, end in rows if uid not in buf][:1]
+        ends += [u.subscription_end for u in buf.values() if u.subscribed and u.subscription_end is not None]
+        return min(ends) if ends else None
+
+    def expiring_between(self, after: float, until: float) -> list[int]:
+        return self._merged(
+            "SELECT id FROM users WHERE subscribed = 1 AND subscription_end > ? AND subscription_end <= ?",
+            (after, until),
+            lambda u: u.subscribed and u.subscription_end is not None and after < u.subscription_end <= until,
+        )
+
+    def take_reclaimable(self, ended_before: float) -> list[int]:
+        return self._merged(
+            "SELECT id FROM users WHERE subscribed = 0 AND wg_address IS NOT NULL"
+            " AND subscription_end <= ?",
+            (ended_before,),
+            lambda u: (not u.subscribed and u.wg_address is not None
+                       and u.subscription_end is not None and u.subscription_end <= ended_before),
+        )
+
+    def close(self) -> None:
+        """Финальный сброс буфера; безопасно вызывать повторно."""
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._writer = None
+        with self._wlock:
+            self._wdb.close()
+        with self._lock:
+            self._db.close()
+
+
+def migrate_json_to_sqlite(store: SqliteUserStore, json_path: str = USERS_FILE) -> int:
+    """
+    Разовый перенос users.snap или users.json (+ журнал) в SQLite. После переноса файлы
+    переименовываются в *.migrated, чтобы повторно не импортировались.
+    Возвращает число перенесённых пользователей.
+    """
+    src = JsonUserStore(json_path, USERS_JOURNAL)
+    items = list(src.items())
+    src.close()
+    store.put_many(items)
+    for p in (json_path, src.snapshot_path, src.journal_old_path, src.journal_path):
+        if os.path.exists(p):
+            os.replace(p, p + ".migrated")
+    return len(items)
+
+
+def open_user_store(backend: str = "json", db_path: Optional[str] = None) -> UserStore:
+    if backend == "json":
+        return JsonUserStore()
+    if backend == "sqlite":
+        store = SqliteUserStore(db_path or os.path.join(BASE_DIR, "users.db"))
+        if len(store) == 0 and (os.path.exists(USERS_FILE) or os.path.exists(USERS_SNAPSHOT)):
+            migrate_json_to_sqlite(store)
+        return store
+    raise ValueError(f"Неизвестный USER_STORE: {backend}")
+
+
+def load_users() -> JsonUserStore:
+    return JsonUserStore()
+
+
+def save_users(users: JsonUserStore) -> None:
+    users.compact()
+
+
+def register_user(users: UserStore, user_id: int) -> None:
+    if user_id in users:
+        return
+    users.put(user_id, User())
+
+
+def activate_subscription(users: UserStore, user_id: int, days: int) -> None:
+    start = int(time.time())
+    u = users.get(user_id) or User()
+    u.subscribed = True
+    u.subscription_start = start
+    u.subscription_end = start + days * 86400
+    users.put(user_id, u)
+
+def set_wg_profile(users: UserStore, user_id: int, priv: bytes, pub: bytes, addr: int,
+                   node: Optional[str] = None) -> None:
+    u = users.get(user_id) or User()
     u.wg_private_key = priv
     u.wg_public_key = pub
     u.wg_address = addr
-    save_users(users)
+    u.node = node
+    users.put(user_id, u)
 
 
+def release_wg_profile(users: UserStore, user_id: int) -> Optional[int]:
+    """Снимает с пользователя WG-ключи, адрес и узел. Возвращает освободившийся адрес."""
+    u = users.get(user_id)
+    if u is None or u.wg_address is None:
+        return None
+    addr = u.wg_address
+    u.wg_private_key = None
+    u.wg_public_key = None
+    u.wg_address = None
+    u.node = None
+    users.put(user_id, u)
+    return addr
+
 
-def is_subscription_active(users: Dict[int, User], user_id: int) -> bool:
+def expire_subscription(users: UserStore, user_id: int) -> None:
     u = users.get(user_id)
-    if not u or not u.subscription_end:
-        return False
-    end = datetime.fromisoformat(u.subscription_end)
-    return datetime.now(timezone.utc) < end
+    if u is None or not u.subscribed:
+        return
+    u.subscribed = False
+    users.put(user_id, u)
+
+
+def is_subscription_active(users: UserStore, user_id: int) -> bool:
+    return users.is_active(user_id, time.time())
+
+
+def main() -> None:
+    """
+    python -m vpn_bot.users stats|export [PATH]|import PATH — при остановленном боте.
+    export пишет users.json (по умолчанию рядом со снапшотом), import заменяет им снапшот и журнал.
+    """
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    if cmd == "import":
+        if len(sys.argv) < 3:
+            sys.exit("укажите JSON для импорта")
+        for p in (USERS_SNAPSHOT, USERS_JOURNAL + ".old", USERS_JOURNAL):
+            if os.path.exists(p):
+                os.replace(p, p + ".bak")
+        store = JsonUserStore(sys.argv[2], USERS_JOURNAL, USERS_SNAPSHOT)
+        print(f"импортировано {len(store)} пользователей из {sys.argv[2]} (прежние файлы — *.bak)")
+    else:
+        store = JsonUserStore()
+    try:
+        if cmd == "export":
+            path = sys.argv[2] if len(sys.argv) > 2 else USERS_FILE
+            print(f"экспортировано {store.export_json(path)} пользователей в {path}")
+        active = sum(1 for _, u in store.items() if u.subscribed)
+        print(f"{len(store)} пользователей, активных подписок {active}")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# vpn_bot/wg_pool.py
+from __future__ import annotations
+import ipaddress
+from typing import Iterable
+
+
+class WgAddressPool:
+    """
+    Пул клиентских адресов внутри сети (например 10.66.0.0/16).
+    Занятость хранится битмапом, освобождённые адреса — стеком (free-list),
+    ни разу не выданные — курсором. Выдача и возврат адреса — O(1).
+    Источник истины — адреса в UserStore: при старте пул заполняется через load().
+    """
+
+    def __init__(self, network: str, start_host: int = 2):
+        self.network = ipaddress.IPv4Network(network, strict=False)
+        self._base = int(self.network.network_address)
+        size = self.network.num_addresses
+        # .0 — адрес сети, последний — broadcast, первые хосты (сервер) — до start_host
+        self._first = min(start_host, size - 1)
+        self._last = size - 2 if size > 2 else size - 1
+        self._bits = bytearray((size + 7) // 8)
+        self._free: list[int] = []
+        self._cursor = self._first
+        self.used = 0
+
+    def _offset(self, addr: int) -> int | None:
+        off = addr - self._base
+        if off < self._first or off > self._last:
+            return None
+        return off
+
+    def _is_set(self, off: int) -> bool:
+        return bool(self._bits[off >> 3] & (1 << (off & 7)))
+
+    def load(self, addresses: Iterable[int]) -> None:
+        for addr in addresses:
+            self.mark_used(addr)
+
+    def mark_used(self, addr: int) -> bool:
+        """Помечает адрес занятым. Адреса вне пула игнорируются (False)."""
+        off = self._offset(addr)
+        if off is None or self._is_set(off):
+            return False
+        self._bits[off >> 3] |= 1 << (off & 7)
+        self.used += 1
+        return True
+
+    def allocate(self) -> int:
+        # сперва возвращённые адреса; запись в стеке могла устареть, если адрес заняли через mark_used
+        while self._free:
+            off = self._free.pop()
+            if not self._is_set(off):
+                self._bits[off >> 3] |= 1 << (off & 7)
+                self.used += 1
+                return self._base + off
+        # затем ни разу не выданные; курсор только растёт, так что в сумме это O(1)
+        while self._cursor <= self._last:
+            off = self._cursor
+            self._cursor += 1
+            if not self._is_set(off):
+                self._bits[off >> 3] |= 1 << (off & 7)
+                self.used += 1
+                return self._base + off
+        raise RuntimeError("Не осталось свободных WG адресов в пуле")
+
+    def release(self, addr: int) -> None:
+        off = self._offset(addr)
+        if off is None or not self._is_set(off):
+            return
+        self._bits[off >> 3] &= ~(1 << (off & 7)) & 0xFF
+        self.used -= 1
+        if off < self._cursor:
+            self._free.append(off)
+
+    @property
+    def capacity(self) -> int:
+        return self._last - self._first + 1
@@ -0,0 +1,341 @@
+# vpn_bot/wg_sync.py
+"""
+Синхронизация пиров WireGuard-сервера с подписками.
+
+Желаемое состояние — {публичный ключ: адрес} активных пользователей с WG-профилем.
+Бот меняет его на активации и истечении (add/remove), фоновая задача раз в окно
+применяет к серверу только изменившиеся ключи, пачками. Полная сверка (resync) читает
+текущих пиров сервера и приводит их к желаемому набору — нужна после ручных правок
+или первого включения, но для корректности не обязательна.
+
+Сервером управляет сменный исполнитель:
+    WgSetExecutor     — `wg set <iface> peer ... allowed-ips ... / peer ... remove`
+    SyncConfExecutor  — файл пиров в формате `wg setconf` + `wg syncconf` (дельту считает wg);
+                        чужие пиры переносятся в файл из `wg showconf`
+    RecordingExecutor — без wg: команды записываются, пиры хранятся в памяти (тесты, стенд)
+
+На каждый VPN-узел (vpn_bot/nodes.py) — свой PeerSync. Трогаются только пиры с одним
+адресом /32 из пула узла: остальные (серверные, добавленные вручную) сверка не удаляет.
+"""
+from __future__ import annotations
+import asyncio, base64, ipaddress, logging, os, shlex, subprocess, tempfile, time
+from typing import Iterable, Iterator, Optional
+
+from vpn_bot.metrics import REGISTRY
+
+log = logging.getLogger("vpn_bot")
+
+# op: delta — фоновое применение изменений, full — полная сверка
+SYNC_SECONDS = REGISTRY.histogram("vpn_wg_sync_seconds", "Применение пиров на WG-сервере", labels=("op",))
+SYNC_PEERS = REGISTRY.counter("vpn_wg_sync_peers_total", "Пиров отправлено на WG-сервер", labels=("action",))
+SYNC_ERRORS = REGISTRY.counter("vpn_wg_sync_errors_total", "Неудачных применений пиров")
+
+
+def _key(pub: bytes) -> str:
+    return base64.b64encode(pub).decode("ascii")
+
+
+def _allowed_ip(addr: int) -> str:
+    return f"{ipaddress.IPv4Address(addr)}/32"
+
+
+def _parse_allowed_ips(value: str) -> Optional[int]:
+    """Адрес пира, если у него ровно один IPv4 /32; иначе None (такой пир не наш)."""
+    parts = [p.strip() for p in value.split(",") if p.strip()]
+    if len(parts) != 1:
+        return None
+    try:
+        net = ipaddress.ip_network(parts[0], strict=False)
+    except ValueError:
+        return None
+    if net.version != 4 or net.prefixlen != 32:
+        return None
+    return int(net.network_address)
+
+
+class PeerExecutor:
+    """Применяет изменения к WG-серверу. Вызывается из потоков WORKERS, не из event loop'а."""
+
+    # apply() нужен весь желаемый набор, а не только дельта (syncconf)
+    full_state = False
+
+    def apply(self, upsert: dict[bytes, int], remove: list[bytes], desired: Optional[dict[bytes, int]] = None) -> None:
+        raise NotImplementedError
+
+    def dump(self) -> dict[bytes, Optional[int]]:
+        """Текущие пиры сервера: ключ -> адрес (None — не один /32)."""
+        raise NotImplementedError
+
+
+class WgSetExecutor(PeerExecutor):
+    """
+    `wg set` по batch пиров на вызов: длина командной строки ограничена, а вызовы дороги.
+    wg — команда целиком, например "ssh root@fra1 wg" для удалённого узла.
+    """
+
+    def __init__(self, interface: str = "wg0", batch: int = 256, wg: str = "wg"):
+        self.interface = interface
+        self.batch = max(1, batch)
+        self.wg = shlex.split(wg)
+
+    def _run(self, args: list[str]) -> str:
+        return subprocess.run(args, check=True, capture_output=True, text=True).stdout
+
+    def commands(self, upsert: dict[bytes, int], remove: list[bytes]) -> Iterator[list[str]]:
+        ops = [["peer", _key(pub), "allowed-ips", _allowed_ip(addr)] for pub, addr in upsert.items()]
+        ops += [["peer", _key(pub), "remove"] for pub in remove]
+        for i in range(0, len(ops), self.batch):
+            cmd = [*self.wg, "set", self.interface]
+            for op in ops[i:i + self.batch]:
+                cmd += op
+            yield cmd
+
+    def apply(self, upsert: dict[bytes, int], remove: list[bytes], desired: Optional[dict[bytes, int]] = None) -> None:
+        for cmd in self.commands(upsert, remove):
+            self._run(cmd)
+
+    def dump(self) -> dict[bytes, Optional[int]]:
+        peers: dict[bytes, Optional[int]] = {}
+        lines = self._run([*self.wg, "show", self.interface, "dump"]).splitlines()
+        # первая строка — сам интерфейс; дальше: ключ, psk, endpoint, allowed-ips, ...
+        for line in lines[1:]:
+            fields = line.split("\t")
+            if len(fields) < 4:
+                continue
+            peers[base64.b64decode(fields[0])] = _parse_allowed_ips(fields[3])
+        return peers
+
+
+class SyncConfExecutor(WgSetExecutor):
+    """
+    Пишет весь набор пиров в path (атомарно) и вызывает `wg syncconf`: wg сам применяет
+    только разницу. header_path — секция [Interface] сервера в формате wg (PrivateKey,
+    ListenPort; без полей wg-quick вроде Address), например из `wg-quick strip wg0`.
+    syncconf удаляет всех пиров, которых нет в файле, поэтому чужие пиры (не один /32
+    из network — серверные, добавленные вручную) перед записью читаются из `wg showconf`
+    и переносятся в файл как есть.
+    """
+
+    full_state = True
+
+    def __init__(self, path: str, interface: str = "wg0", header_path: str = "", wg: str = "wg",
+                 network: Optional[str] = None):
+        super().__init__(interface, wg=wg)
+        self.path = path
+        self.header_path = header_path
+        self.network = ipaddress.IPv4Network(network, strict=False) if network else None
+
+    def foreign_peers(self, desired: dict[bytes, int]) -> list[str]:
+        """Секции [Peer] из `wg showconf`, которыми бот не управляет."""
+        sections: list[list[str]] = []
+        for line in self._run([*self.wg, "showconf", self.interface]).splitlines():
+            if line.strip().startswith("["):
+                sections.append([])
+            if sections:
+                sections[-1].append(line)
+        out = []
+        for lines in sections:
+            if lines[0].strip().lower() != "[peer]":
+                continue
+            fields = {}
+            for line in lines[1:]:
+                name, sep, value = line.partition("=")
+                if sep:
+                    fields[name.strip().lower()] = value.strip()
+            try:
+                pub = base64.b64decode(fields.get("publickey", ""))
+            except ValueError:
+                pub = b""
+            if pub in desired:
+                continue
+            addr = _parse_allowed_ips(fields.get("allowedips", ""))
+            if addr is not None and self.network is not None and ipaddress.IPv4Address(addr) in self.network:
+                continue  # наш бывший пир — его и нужно убрать
+            out.append("\n".join(line.rstrip() for line in lines).strip() + "\n\n")
+        return out
+
+    def render(self, desired: dict[bytes, int], foreign: Iterable[str] = ()) -> str:
+        header = ""
+        if self.header_path:
+            with open(self.header_path, "r", encoding="utf-8") as f:
+                header = f.read().rstrip() + "\n\n"
+        peers = "".join(
+            f"[Peer]\nPublicKey = {_key(pub)}\nAllowedIPs = {_allowed_ip(addr)}\n\n"
+            for pub, addr in desired.items()
+        )
+        return header + "".join(foreign) + peers
+
+    def apply(self, upsert: dict[bytes, int], remove: list[bytes], desired: Optional[dict[bytes, int]] = None) -> None:
+        desired = desired or {}
+        text = self.render(desired, self.foreign_peers(desired))
+        fd, tmp = tempfile.mkstemp(prefix="wg_peers_", suffix=".conf", dir=os.path.dirname(self.path) or ".")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.chmod(tmp, 0o600)
+        os.replace(tmp, self.path)
+        self._run([*self.wg, "syncconf", self.interface, self.path])
+
+
+class RecordingExecutor(WgSetExecutor):
+    """Без wg: команды записываются в commands, их эффект — в peers (dump() читает его же)."""
+
+    def __init__(self, interface: str = "wg0", batch: int = 256, wg: str = "wg"):
+        super().__init__(interface, batch, wg)
+        self.commands_run: list[list[str]] = []
+        self.peers: dict[bytes, str] = {}  # ключ -> allowed-ips
+
+    def _run(self, args: list[str]) -> str:
+        self.commands_run.append(list(args))
+        n = len(self.wg)
+        if args[n] == "show":
+            rows = ["priv\tpub\t51820\toff"]
+            rows += [f"{_key(pub)}\t(none)\t(none)\t{ips}\t0\t0\t0\toff" for pub, ips in self.peers.items()]
+            return "\n".join(rows) + "\n"
+        i = n + 2
+        while i < len(args):
+            pub = base64.b64decode(args[i + 1])
+            if args[i + 2] == "remove":
+                self.peers.pop(pub, None)
+                i += 3
+            else:
+                self.peers[pub] = args[i + 3]
+                i += 4
+        return ""
+
+
+class PeerSync:
+    """
+    Желаемый набор пиров и ещё не применённые изменения. add()/remove() — только
+    из потока event loop'а (как и прочие записи пользователей); к серверу изменения
+    уходят из фоновой задачи run() одной дельтой раз в delay секунд.
+    """
+
+    def __init__(self, executor: PeerExecutor, network: str, delay: float = 0.5, retry: float = 5.0):
+        self.executor = executor
+        self.network = ipaddress.IPv4Network(network, strict=False)
+        self.delay = delay
+        self.retry = retry
+        self.desired: dict[bytes, int] = {}
+        self._dirty: set[bytes] = set()  # ключи, изменившиеся с последнего применения
+        self._apply_lock: Optional[asyncio.Lock] = None
+        self._wake: Optional[asyncio.Event] = None
+        self.applied = 0
+        self.failures = 0
+        self.last_full: Optional[float] = None  # когда была последняя полная сверка (epoch)
+
+    def __len__(self) -> int:
+        return len(self.desired)
+
+    @property
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def load(self, peers: Iterable[tuple[bytes, int]]) -> None:
+        """Начальный набор при старте; сервер считается уже приведённым к нему."""
+        for pub, addr in peers:
+            self.desired[pub] = addr
+
+    def _mark(self, pub: bytes) -> None:
+        self._dirty.add(pub)
+        if self._wake is not None:
+            self._wake.set()
+
+    def add(self, pub: bytes, addr: int) -> None:
+        if self.desired.get(pub) != addr:
+            self.desired[pub] = addr
+            self._mark(pub)
+
+    def remove(self, pub: bytes) -> None:
+        if self.desired.pop(pub, None) is not None:
+            self._mark(pub)
+
+    def _take_delta(self) -> tuple[dict[bytes, int], list[bytes]]:
+        keys, self._dirty = self._dirty, set()
+        upsert = {k: self.desired[k] for k in keys if k in self.desired}
+        remove = [k for k in keys if k not in self.desired]
+        return upsert, remove
+
+    def _lock(self) -> asyncio.Lock:
+        if self._apply_lock is None:
+            self._apply_lock = asyncio.Lock()
+        return self._apply_lock
+
+    async def _apply(self, op: str, upsert: dict[bytes, int], remove: list[bytes], workers) -> None:
+        loop = asyncio.get_running_loop()
+        desired = dict(self.desired) if self.executor.full_state else None
+        start = time.perf_counter()
+        try:
+            await loop.run_in_executor(workers, self.executor.apply, upsert, remove, desired)
+        except Exception:
+            SYNC_ERRORS.inc()
+            self.failures += 1
+            # вернём ключи в очередь: следующая попытка возьмёт их текущее желаемое состояние
+            self._dirty.update(upsert)
+            self._dirty.update(remove)
+            raise
+        SYNC_SECONDS.observe(time.perf_counter() - start, op=op)
+        SYNC_PEERS.inc(len(upsert), action="upsert")
+        SYNC_PEERS.inc(len(remove), action="remove")
+        self.applied += len(upsert) + len(remove)
+
+    async def flush(self, workers=None) -> int:
+        """Применяет накопленные изменения; возвращает число затронутых пиров."""
+        async with self._lock():
+            upsert, remove = self._take_delta()
+            if upsert or remove:
+                await self._apply("delta", upsert, remove, workers)
+            return len(upsert) + len(remove)
+
+    async def resync(self, workers=None) -> tuple[int, int]:
+        """
+        Полная сверка: читает пиров сервера и применяет разницу с желаемым набором.
+        Возвращает (добавлено/исправлено, удалено).
+        """
+        loop = asyncio.get_running_loop()
+        async with self._lock():
+            current = await loop.run_in_executor(workers, self.executor.dump)
+            net = self.network
+            upsert = {k: v for k, v in self.desired.items() if current.get(k) != v}
+            remove = [
+                k for k, v in current.items()
+                if k not in self.desired and v is not None and ipaddress.IPv4Address(v) in net
+            ]
+            # всё, что было в очереди, покрыто сверкой
+            self._dirty.clear()
+            if upsert or remove:
+                await self._apply("full", upsert, remove, workers)
+            self.last_full = time.time()
+            return len(upsert), len(remove)
+
+    async def run(self, workers=None) -> None:
+        """Фоновая задача; запускается из post_init."""
+        self._wake = asyncio.Event()
+        if self._dirty:
+            self._wake.set()
+        while True:
+            await self._wake.wait()
+            # копим изменения в течение окна — на сервер уходит одна пачка
+            await asyncio.sleep(self.delay)
+            self._wake.clear()
+            try:
+                await self.flush(workers)
+            except Exception:
+                log.exception("WG peer sync failed, retry in %.0fs", self.retry)
+                await asyncio.sleep(self.retry)
+                self._wake.set()
+
+
+def make_peer_sync(mode: str, network: str, interface: str = "wg0", batch: int = 256,
+                   conf_path: str = "", header_path: str = "", wg: str = "wg") -> Optional[PeerSync]:
+    """По WG_SYNC: off — None (сервер не трогаем), wg, syncconf или record (без wg, для стенда)."""
+    if mode in ("", "off"):
+        return None
+    if mode == "wg":
+        executor: PeerExecutor = WgSetExecutor(interface, batch, wg)
+    elif mode == "syncconf":
+        executor = SyncConfExecutor(conf_path, interface, header_path, wg, network)
+    elif mode == "record":
+        executor = RecordingExecutor(interface, batch, wg)
+    else:
+        raise ValueError(f"Неизвестный WG_SYNC: {mode}")
+    return PeerSync(executor, network)
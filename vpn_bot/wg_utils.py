@@ -1,24 +1,91 @@
 # vpn_bot/wg_utils.py
-import base64, os
+import asyncio, base64, collections, logging
+from typing import Optional
+from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
 
+log = logging.getLogger("vpn_bot")
+
+_RAW = serialization.Encoding.Raw
+_PRIV_RAW = serialization.PrivateFormat.Raw
+_PUB_RAW = serialization.PublicFormat.Raw
+_NO_ENC = serialization.NoEncryption()
+
 def _b64(data: bytes) -> str:
     return base64.b64encode(data).decode("ascii")
 
+def gen_wg_keypair_raw() -> tuple[bytes, bytes]:
+    """Возвращает (private_key, public_key) — сырые 32 байта X25519."""
+    priv = X25519PrivateKey.generate()
+    return (
+        priv.private_bytes(encoding=_RAW, format=_PRIV_RAW, encryption_algorithm=_NO_ENC),
+        priv.public_key().public_bytes(encoding=_RAW, format=_PUB_RAW),
+    )
+
+def gen_wg_keypairs(n: int) -> list[tuple[bytes, bytes]]:
+    """Пачка из n сырых пар (для пула и массовой миграции)."""
+    gen = X25519PrivateKey.generate
+    out = []
+    for _ in range(n):
+        priv = gen()
+        out.append((
+            priv.private_bytes(_RAW, _PRIV_RAW, _NO_ENC),
+            priv.public_key().public_bytes(_RAW, _PUB_RAW),
+        ))
+    return out
+
 def gen_wg_keypair() -> tuple[str, str]:
     """
     Возвращает (private_key_base64, public_key_base64) как в WireGuard.
     Это эквивалент wg genkey | wg pubkey
     """
-    priv = X25519PrivateKey.generate()
-    pub = priv.public_key()
-    priv_b64 = _b64(priv.private_bytes(
-        encoding=__import__("cryptography.hazmat.primitives.serialization", fromlist=["serialization"]).serialization.Encoding.Raw,
-        format=__import__("cryptography.hazmat.primitives.serialization", fromlist=["serialization"]).serialization.PrivateFormat.Raw,
-        encryption_algorithm=__import__("cryptography.hazmat.primitives.serialization", fromlist=["serialization"]).serialization.NoEncryption(),
-    ))
-    pub_b64 = _b64(pub.public_bytes(
-        encoding=__import__("cryptography.hazmat.primitives.serialization", fromlist=["serialization"]).serialization.Encoding.Raw,
-        format=__import__("cryptography.hazmat.primitives.serialization", fromlist=["serialization"]).serialization.PublicFormat.Raw,
-    ))
-    return priv_b64, pub_b64
+    priv, pub = gen_wg_keypair_raw()
+    return _b64(priv), _b64(pub)
+
+
+class KeypairPool:
+    """
+    Запас готовых пар ключей. pop() не генерирует ничего на пути активации,
+    пока пул не пуст; фоновая задача доливает пул пачками в executor, когда он
+    опускается ниже low, до уровня high.
+    """
+
+    def __init__(self, low: int = 64, high: int = 256, batch: int = 64):
+        self.low = low
+        self.high = high
+        self.batch = batch
+        self._pairs: collections.deque[tuple[bytes, bytes]] = collections.deque()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self.misses = 0  # сколько раз пул оказался пуст и пару сгенерировали на месте
+
+    def __len__(self) -> int:
+        return len(self._pairs)
+
+    def pop(self) -> tuple[bytes, bytes]:
+        try:
+            pair = self._pairs.popleft()
+        except IndexError:
+            self.misses += 1
+            pair = gen_wg_keypair_raw()
+        if len(self._pairs) < self.low and self._loop is not None:
+            # pop может вызываться и из потоков executor'а
+            self._loop.call_soon_threadsafe(self._wake.set)
+        return pair
+
+    async def run(self, executor=None) -> None:
+        """Фоновая задача доливки; запускается из post_init."""
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._wake.set()
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            while len(self._pairs) < self.high:
+                n = min(self.batch, self.high - len(self._pairs))
+                try:
+                    pairs = await self._loop.run_in_executor(executor, gen_wg_keypairs, n)
+                except Exception:
+                    log.exception("keypair pool refill failed")
+                    break
+                self._pairs.extend(pairs)
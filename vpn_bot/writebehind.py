@@ -0,0 +1,55 @@
+# vpn_bot/writebehind.py
+import logging, threading
+from typing import Callable
+
+log = logging.getLogger("vpn_bot")
+
+
+class WriteBehind:
+    """
+    Фоновый писатель: mark() только помечает, что есть несохранённые изменения,
+    а поток через delay секунд вызывает flush() — одна запись на всё окно.
+    close() дожидается потока и делает финальный flush в вызывающем потоке.
+    """
+
+    def __init__(self, flush: Callable[[], None], delay: float, name: str):
+        self._flush = flush
+        self._delay = delay
+        self._cond = threading.Condition()
+        self._dirty = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def mark(self) -> None:
+        with self._cond:
+            if not self._dirty:
+                self._dirty = True
+                self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._dirty or self._closed)
+                if self._closed:
+                    return
+                # копим изменения в течение окна; close() прерывает ожидание
+                self._cond.wait_for(lambda: self._closed, timeout=self._delay)
+                if self._closed:
+                    return
+                self._dirty = False
+            try:
+                self._flush()
+            except Exception:
+                log.exception("%s flush failed, retry in %.1fs", self._thread.name, self._delay)
+                # хранилище вернуло несохранённое в буфер — повторим в следующем окне
+                self.mark()
+
+    def close(self) -> None:
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._flush()